@@ -0,0 +1,474 @@
+"""Interchangeable engines behind :class:`nbody.BarnesHutSimulation`.
+
+A backend stores the particle state and provides the three operations the
+integrators are written in: force evaluation (:meth:`Backend.accelerations`),
+velocity kicks (:meth:`Backend.kick`) and position drifts
+(:meth:`Backend.drift`). Accelerations are kept in the backend's native array
+type between steps. Everything else (recorder, diagnostics, streaming,
+checkpoints, GUI) reads the host copy ``backend.particles``. Backends with
+their own storage refresh that copy lazily after the state changes. Edits made
+through it are loaded back before the state is next used, so a
+:class:`particles.ParticleSet` behaves the same on every backend.
+
+- ``"python"``: lists of :class:`particles.Particle` with the recursive
+  :class:`OctreeNode` tree and a pure-Python direct sum. It is the
+  reference implementation for small systems.
+- ``"numpy"`` (default): the vectorized :class:`octree.LinearOctree` walks,
+  persistent tree refits and optional force workers.
+- ``"torch"`` and ``"cuda"``: tensors on the CPU or a CUDA device, using
+  the :mod:`gpu_sim` kernels. PyTorch is imported only when one of these is
+  selected.
+"""
+
+import math
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from particles import Particle, ParticleSet
+
+BACKENDS = ("python", "numpy", "torch", "cuda")
+
+
+class OctreeNode:
+    """Node of the recursive one-particle-per-leaf tree of the python backend."""
+
+    MIN_SIZE = 1e-5
+
+    def __init__(self, center: Tuple[float, float, float], half_size: float):
+        self.center = list(center)
+        self.half_size = half_size
+        self.particle: Optional[Particle] = None
+        self.children: List[Optional["OctreeNode"]] = [None] * 8
+        self.mass = 0.0
+        self.com = [0.0, 0.0, 0.0]
+
+    def _is_leaf(self) -> bool:
+        return all(child is None for child in self.children)
+
+    def _subdivide(self):
+        quarter = self.half_size / 2.0
+        for i in range(8):
+            offset = (
+                quarter if i & 1 else -quarter,
+                quarter if i & 2 else -quarter,
+                quarter if i & 4 else -quarter,
+            )
+            new_center = (
+                self.center[0] + offset[0],
+                self.center[1] + offset[1],
+                self.center[2] + offset[2],
+            )
+            self.children[i] = OctreeNode(new_center, quarter)
+
+    def _child_index(self, p: Particle) -> int:
+        idx = 0
+        if p.x > self.center[0]:
+            idx |= 1
+        if p.y > self.center[1]:
+            idx |= 2
+        if p.z > self.center[2]:
+            idx |= 4
+        return idx
+
+    def insert(self, p: Particle):
+        if self._is_leaf():
+            if self.particle is None:
+                self.particle = p
+                self.mass = p.mass
+                self.com = [p.mass * p.x, p.mass * p.y, p.mass * p.z]
+                return
+            elif self.half_size < self.MIN_SIZE:
+                # Avoid infinite subdivision when particles overlap closely
+                self.mass += p.mass
+                self.com[0] += p.mass * p.x
+                self.com[1] += p.mass * p.y
+                self.com[2] += p.mass * p.z
+                return
+            else:
+                self._subdivide()
+                existing = self.particle
+                self.particle = None
+                self.children[self._child_index(existing)].insert(existing)
+        self.children[self._child_index(p)].insert(p)
+        # Update center of mass and mass
+        self.mass += p.mass
+        self.com[0] += p.mass * p.x
+        self.com[1] += p.mass * p.y
+        self.com[2] += p.mass * p.z
+
+    def finalize(self):
+        if self.mass > 0:
+            self.com[0] /= self.mass
+            self.com[1] /= self.mass
+            self.com[2] /= self.mass
+        if not self._is_leaf():
+            for child in self.children:
+                if child:
+                    child.finalize()
+
+    def compute_force_on(
+        self, p: Particle, theta: float = 0.5, G: float = 1.0, eps: float = 0.05
+    ) -> Tuple[float, float, float]:
+        if self.mass == 0 or (self.particle is p and self._is_leaf()):
+            return 0.0, 0.0, 0.0
+        dx = self.com[0] - p.x
+        dy = self.com[1] - p.y
+        dz = self.com[2] - p.z
+        dist = math.sqrt(dx * dx + dy * dy + dz * dz + eps * eps)
+        if self._is_leaf() or self.half_size / dist < theta:
+            factor = G * self.mass / (dist ** 3)
+            return dx * factor, dy * factor, dz * factor
+        fx = fy = fz = 0.0
+        for child in self.children:
+            if child:
+                cfx, cfy, cfz = child.compute_force_on(p, theta, G, eps)
+                fx += cfx
+                fy += cfy
+                fz += cfz
+        return fx, fy, fz
+
+
+class Backend:
+    """Particle storage plus force, kick and drift operations.
+
+    ``index`` arguments are NumPy integer arrays of particle indices; ``dt``
+    is a scalar or one value per index.
+    """
+
+    name = ""
+    # Force modes of nbody.BarnesHutSimulation this backend implements
+    modes: Tuple[str, ...] = ("bh", "group", "direct")
+
+    def load(self, particles: ParticleSet):
+        """Take over ``particles`` as the current state."""
+        raise NotImplementedError
+
+    @property
+    def particles(self) -> ParticleSet:
+        """Host copy of the state; edits to it are used from the next operation on."""
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        """Number of particles, without handing out the host copy."""
+        raise NotImplementedError
+
+    def accelerations(self, sim, targets: Optional[np.ndarray] = None):
+        """Accelerations of all particles (or ``targets``) with the settings of ``sim``."""
+        raise NotImplementedError
+
+    def kick(self, acc, dt, index: Optional[np.ndarray] = None):
+        raise NotImplementedError
+
+    def drift(self, dt: float):
+        raise NotImplementedError
+
+    def set_rows(self, acc, index: np.ndarray, values):
+        """Store ``values``, the accelerations of ``index``, into ``acc`` in place."""
+        raise NotImplementedError
+
+    def to_host(self, acc) -> np.ndarray:
+        raise NotImplementedError
+
+    def from_host(self, acc: np.ndarray):
+        raise NotImplementedError
+
+
+class NumpyBackend(Backend):
+    """The vectorized engine; the state is the :class:`ParticleSet` itself."""
+
+    name = "numpy"
+
+    def __init__(self):
+        self._particles = ParticleSet(np.empty((0, 3)), np.empty((0, 3)))
+
+    def load(self, particles: ParticleSet):
+        self._particles = particles
+
+    @property
+    def particles(self) -> ParticleSet:
+        return self._particles
+
+    def __len__(self) -> int:
+        return len(self._particles)
+
+    def accelerations(self, sim, targets: Optional[np.ndarray] = None) -> np.ndarray:
+        if sim.mode == "direct":
+            with sim._phase("forces"):
+                return sim._direct_forces(targets)
+        with sim._phase("tree"):
+            tree = sim._build_tree()
+        walk = "group" if sim.mode == "group" else "particle"
+        counts = sim.profiler.counts if sim.profiler is not None else None
+        with sim._phase("forces"):
+            if sim.force_pool is not None:
+                return sim.force_pool.accelerations(tree, sim.theta, eps=sim.eps, targets=targets, mode=walk,
+                                                    group_size=sim.group_size, counts=counts)
+            return tree.accelerations(sim.theta, eps=sim.eps, targets=targets, mode=walk,
+                                      group_size=sim.group_size, counts=counts)
+
+    def kick(self, acc: np.ndarray, dt, index: Optional[np.ndarray] = None):
+        vel = self._particles.vel
+        if index is None:
+            vel += acc * dt
+        else:
+            vel[index] += acc[index] * (np.asarray(dt)[..., np.newaxis] if np.ndim(dt) else dt)
+
+    def drift(self, dt: float):
+        ps = self._particles
+        ps.pos += ps.vel * dt
+
+    def set_rows(self, acc: np.ndarray, index: np.ndarray, values: np.ndarray):
+        acc[index] = values
+
+    def to_host(self, acc: np.ndarray) -> np.ndarray:
+        return acc
+
+    def from_host(self, acc: np.ndarray) -> np.ndarray:
+        return np.asarray(acc, dtype=np.float64)
+
+
+class _HostCopy:
+    """Host :class:`ParticleSet` mirroring a backend's own storage.
+
+    The set is refreshed lazily after the state changes. Once it has been
+    handed out it may have been edited, so it is loaded back into the
+    storage before the next force evaluation, kick or drift.
+    """
+
+    def __init__(self):
+        self._host = ParticleSet(np.empty((0, 3)), np.empty((0, 3)))
+        self._stale = False
+        self._lent = False
+
+    def _store(self, particles: ParticleSet):
+        raise NotImplementedError
+
+    def _read_state(self):
+        raise NotImplementedError
+
+    def load(self, particles: ParticleSet):
+        self._host = particles
+        self._store(particles)
+        self._stale = self._lent = False
+
+    def _sync(self):
+        if self._lent:
+            self._store(self._host)
+            self._lent = False
+
+    def _mark_stale(self):
+        self._stale = True
+
+    @property
+    def particles(self) -> ParticleSet:
+        if self._stale:
+            # Refreshed in place, so callers holding the set see the new state
+            host = self._host
+            host.pos[...], host.vel[...] = self._read_state()
+            self._stale = False
+        self._lent = True
+        return self._host
+
+    def __len__(self) -> int:
+        return len(self._host)
+
+
+def _direct_python(plist: List[Particle], rows: List[int], G: float, eps: float) -> List[List[float]]:
+    eps2 = eps * eps
+    out = []
+    for i in rows:
+        p = plist[i]
+        ax = ay = az = 0.0
+        for q in plist:
+            dx = q.x - p.x
+            dy = q.y - p.y
+            dz = q.z - p.z
+            r2 = dx * dx + dy * dy + dz * dz + eps2
+            if q is p or r2 == 0.0:
+                continue
+            f = G * q.mass / (r2 * math.sqrt(r2))
+            ax += dx * f
+            ay += dy * f
+            az += dz * f
+        out.append([ax, ay, az])
+    return out
+
+
+class PythonBackend(_HostCopy, Backend):
+    """Pure-Python engine on a list of :class:`particles.Particle` objects.
+
+    ``"bh"`` mode walks the recursive :class:`OctreeNode` tree, which is
+    rebuilt for every evaluation; there is no group walk.
+    """
+
+    name = "python"
+    modes = ("bh", "direct")
+
+    def __init__(self):
+        super().__init__()
+        self._plist: List[Particle] = []
+
+    def _store(self, particles: ParticleSet):
+        self._plist = particles.to_particles()
+
+    def _read_state(self):
+        return ([(p.x, p.y, p.z) for p in self._plist], [(p.vx, p.vy, p.vz) for p in self._plist])
+
+    def _tree(self) -> OctreeNode:
+        lo = [min(getattr(p, axis) for p in self._plist) for axis in "xyz"]
+        hi = [max(getattr(p, axis) for p in self._plist) for axis in "xyz"]
+        half = 0.5 * max(h - l for l, h in zip(lo, hi)) or 1.0
+        root = OctreeNode(tuple(0.5 * (l + h) for l, h in zip(lo, hi)), half * (1.0 + 1e-9))
+        for p in self._plist:
+            root.insert(p)
+        root.finalize()
+        return root
+
+    def accelerations(self, sim, targets: Optional[np.ndarray] = None) -> List[List[float]]:
+        self._sync()
+        rows = range(len(self._plist)) if targets is None else np.asarray(targets).tolist()
+        if not len(rows):
+            return []
+        if sim.mode == "direct":
+            with sim._phase("forces"):
+                return _direct_python(self._plist, rows, 1.0, sim.eps)
+        with sim._phase("tree"):
+            root = self._tree()
+        with sim._phase("forces"):
+            return [list(root.compute_force_on(self._plist[i], sim.theta, eps=sim.eps)) for i in rows]
+
+    def kick(self, acc: List[List[float]], dt, index: Optional[np.ndarray] = None):
+        self._sync()
+        if index is None:
+            pairs = zip(self._plist, acc, [dt] * len(acc))
+        else:
+            index = np.asarray(index).tolist()
+            steps = np.broadcast_to(dt, (len(index),)).tolist()
+            pairs = zip([self._plist[i] for i in index], [acc[i] for i in index], steps)
+        for p, (ax, ay, az), h in pairs:
+            p.vx += ax * h
+            p.vy += ay * h
+            p.vz += az * h
+        self._mark_stale()
+
+    def drift(self, dt: float):
+        self._sync()
+        for p in self._plist:
+            p.x += p.vx * dt
+            p.y += p.vy * dt
+            p.z += p.vz * dt
+        self._mark_stale()
+
+    def set_rows(self, acc: List[List[float]], index: np.ndarray, values: List[List[float]]):
+        for i, row in zip(np.asarray(index).tolist(), values):
+            acc[i] = row
+
+    def to_host(self, acc: List[List[float]]) -> np.ndarray:
+        return np.array(acc, dtype=np.float64).reshape(-1, 3)
+
+    def from_host(self, acc: np.ndarray) -> List[List[float]]:
+        return np.asarray(acc, dtype=np.float64).tolist()
+
+
+class TorchBackend(_HostCopy, Backend):
+    """Tensors on ``device`` with the :mod:`gpu_sim` kernels.
+
+    Direct summation uses the memory-bounded tiles of
+    :func:`gpu_sim.direct_accelerations`. ``"bh"`` and ``"group"`` modes both
+    use :class:`gpu_sim.TensorOctree`, rebuilt for every evaluation. The
+    state is kept in ``dtype`` (float64 by default, like the NumPy backend).
+    """
+
+    name = "torch"
+
+    def __init__(self, device: Optional[str] = None, dtype=None):
+        super().__init__()
+        import torch
+
+        import gpu_sim
+
+        self.torch = torch
+        self.gpu_sim = gpu_sim
+        self.device = torch.device(device or "cpu")
+        if self.device.type == "cuda" and not torch.cuda.is_available():
+            raise RuntimeError("CUDA is not available")
+        self.dtype = dtype or torch.float64
+        self.pos = self.vel = self.mass = None
+
+    def _tensor(self, array):
+        # Always a copy, so the storage never aliases the host arrays
+        return self.torch.tensor(np.asarray(array), dtype=self.dtype, device=self.device)
+
+    def _index(self, index: np.ndarray):
+        return self.torch.as_tensor(np.asarray(index, dtype=np.int64), device=self.device)
+
+    def _store(self, particles: ParticleSet):
+        self.pos, self.vel, self.mass = (self._tensor(a) for a in (particles.pos, particles.vel, particles.mass))
+
+    def _read_state(self):
+        return self.pos.cpu().numpy(), self.vel.cpu().numpy()
+
+    def accelerations(self, sim, targets: Optional[np.ndarray] = None):
+        self._sync()
+        if targets is not None:
+            if not len(targets):
+                return self.pos.new_zeros((0, 3))
+            targets = self._index(targets)
+        if sim.mode == "direct":
+            with sim._phase("forces"):
+                return self.gpu_sim.direct_accelerations(self.pos, self.mass, eps=sim.eps, targets=targets)
+        with sim._phase("tree"):
+            tree = self.gpu_sim.TensorOctree(self.pos, self.mass, leaf_size=sim.leaf_size)
+        with sim._phase("forces"):
+            return tree.accelerations(sim.theta, eps=sim.eps, targets=targets)
+
+    def kick(self, acc, dt, index: Optional[np.ndarray] = None):
+        self._sync()
+        if index is None:
+            self.vel += acc * dt
+        else:
+            rows = self._index(index)
+            step = self._tensor(dt).unsqueeze(1) if np.ndim(dt) else dt
+            self.vel[rows] += acc[rows] * step
+        self._mark_stale()
+
+    def drift(self, dt: float):
+        self._sync()
+        self.pos += self.vel * dt
+        self._mark_stale()
+
+    def set_rows(self, acc, index: np.ndarray, values):
+        acc[self._index(index)] = values
+
+    def to_host(self, acc) -> np.ndarray:
+        return acc.cpu().numpy().astype(np.float64)
+
+    def from_host(self, acc: np.ndarray):
+        return self._tensor(acc)
+
+
+def make_backend(backend: Union[str, Backend] = "numpy") -> Backend:
+    """Backend for a name in :data:`BACKENDS`, or ``backend`` itself if it is one."""
+    if isinstance(backend, Backend):
+        return backend
+    if backend == "python":
+        return PythonBackend()
+    if backend == "numpy":
+        return NumpyBackend()
+    if backend in ("torch", "cuda"):
+        return TorchBackend("cpu" if backend == "torch" else "cuda")
+    raise ValueError("unknown backend %r (choose from %s)" % (backend, ", ".join(BACKENDS)))
+
+
+def available_backends() -> List[str]:
+    """Names in :data:`BACKENDS` usable on this machine."""
+    names = ["python", "numpy"]
+    try:
+        import torch
+    except ImportError:
+        return names
+    names.append("torch")
+    if torch.cuda.is_available():
+        names.append("cuda")
+    return names
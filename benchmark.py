@@ -0,0 +1,234 @@
+"""Benchmarks of the force backends across particle counts and settings.
+
+Every configuration (backend, integrator, N, theta, threads) runs in a fresh
+process so its peak resident memory can be reported on its own. Results are
+printed as they finish and written as JSON; a previous JSON file can be given
+as a baseline to flag configurations that became slower.
+
+Example::
+
+    python benchmark.py --cases nbody-bh gpu-bh --particles 1000 10000 \\
+        --theta 0.5 0.8 --threads 1 4 -o bench.json --baseline main.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# case name -> (implementation, force mode)
+CASES = {
+    "nbody-bh": ("nbody", "bh"),
+    "nbody-group": ("nbody", "group"),
+    "nbody-direct": ("nbody", "direct"),
+    "gpu-direct": ("gpu", "direct"),
+    "gpu-bh": ("gpu", "bh"),
+}
+INTEGRATORS = ("euler", "leapfrog")
+
+
+@dataclass
+class BenchmarkConfig:
+    case: str
+    particles: int
+    theta: Optional[float] = 0.5
+    threads: int = 1
+    integrator: str = "euler"
+    steps: int = 5
+    warmup: int = 1
+    seed: int = 0
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024.0
+
+
+def _stepper(config: BenchmarkConfig):
+    """Return ``(step, close)`` callables for one configuration."""
+    impl, mode = CASES[config.case]
+    theta = config.theta if config.theta is not None else 0.5
+    if impl == "nbody":
+        from nbody import BarnesHutSimulation
+
+        sim = BarnesHutSimulation(num_particles=config.particles, theta=theta, mode=mode,
+                                  integrator=config.integrator, workers=config.threads, seed=config.seed)
+        return sim.step, sim.close
+
+    import torch
+
+    import gpu_sim
+
+    torch.set_num_threads(config.threads)
+    pos, vel, mass = gpu_sim.generate_spiral_galaxy(config.particles, device="cpu", seed=config.seed)
+    if mode == "bh":
+        def step():
+            gpu_sim.step_bh(pos, vel, mass, 0.01, theta=theta)
+    else:
+        def step():
+            gpu_sim.step_direct(pos, vel, mass, 0.01)
+    return step, lambda: None
+
+
+def run_case(config: BenchmarkConfig) -> Dict:
+    """Time ``config.steps`` steps after ``config.warmup`` untimed ones."""
+    step, close = _stepper(config)
+    try:
+        for _ in range(config.warmup):
+            step()
+        times = []
+        for _ in range(config.steps):
+            t0 = time.perf_counter()
+            step()
+            times.append(time.perf_counter() - t0)
+    finally:
+        close()
+    median = statistics.median(times)
+    q1, _, q3 = statistics.quantiles(times, n=4) if len(times) > 1 else (times[0],) * 3
+    result = asdict(config)
+    result.update(
+        times=times,
+        median_s=median,
+        min_s=min(times),
+        max_s=max(times),
+        iqr_s=q3 - q1,
+        particles_per_s=config.particles / median if median > 0 else float("inf"),
+        peak_rss_mb=_peak_rss_mb(),
+    )
+    return result
+
+
+def run_isolated(config: BenchmarkConfig) -> Dict:
+    """Run one configuration in a freshly spawned process."""
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(run_case, config).result()
+
+
+def configurations(cases: Sequence[str], particles: Sequence[int], thetas: Sequence[float],
+                   threads: Sequence[int], integrators: Sequence[str], steps: int = 5,
+                   warmup: int = 1, seed: int = 0) -> List[BenchmarkConfig]:
+    """Expand the sweep, skipping axes that do not apply to a case.
+
+    Direct summation has no opening angle, ``gpu_sim`` only has its
+    Euler step and ``nbody`` force workers only split tree walks, so those
+    cases are not repeated over ``thetas``, ``integrators`` or ``threads``.
+    """
+    configs = []
+    for case in cases:
+        impl, mode = CASES[case]
+        case_thetas = [None] if mode == "direct" else list(thetas)
+        case_integrators = list(integrators) if impl == "nbody" else ["euler"]
+        case_threads = [1] if (impl, mode) == ("nbody", "direct") else list(threads)
+        for integrator in case_integrators:
+            for n in particles:
+                for theta in case_thetas:
+                    for t in case_threads:
+                        configs.append(BenchmarkConfig(case, n, theta, t, integrator, steps, warmup, seed))
+    return configs
+
+
+def metadata() -> Dict:
+    meta = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    try:
+        import torch
+
+        meta["torch"] = torch.__version__
+    except ImportError:
+        pass
+    return meta
+
+
+def compare(results: Sequence[Dict], baseline: Sequence[Dict], tolerance: float = 0.1) -> List[Dict]:
+    """Match results to baseline entries and flag slowdowns beyond ``tolerance``.
+
+    Returns one row per matched configuration with the median time ratio
+    (new / baseline) and whether it counts as a regression.
+    """
+    def key(r):
+        return (r["case"], r["integrator"], r["particles"], r["theta"], r["threads"])
+
+    base = {key(r): r for r in baseline}
+    rows = []
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        ratio = r["median_s"] / b["median_s"] if b["median_s"] > 0 else float("inf")
+        rows.append({"key": key(r), "baseline_s": b["median_s"], "median_s": r["median_s"],
+                     "ratio": ratio, "regression": ratio > 1.0 + tolerance})
+    return rows
+
+
+def _format(result: Dict) -> str:
+    theta = "-" if result["theta"] is None else "%.2f" % result["theta"]
+    return "%-13s %-8s %8d %5s %3d  %10.4f s  ±%8.4f  %12.0f p/s  %8.1f MB" % (
+        result["case"], result["integrator"], result["particles"], theta, result["threads"],
+        result["median_s"], result["iqr_s"], result["particles_per_s"], result["peak_rss_mb"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the N-body force backends")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=["nbody-bh", "nbody-direct"],
+                        help="Backends to run")
+    parser.add_argument("--particles", nargs="+", type=int, default=[1000, 4000], help="Particle counts")
+    parser.add_argument("--theta", nargs="+", type=float, default=[0.5], help="Opening angles")
+    parser.add_argument("--threads", nargs="+", type=int, default=[1],
+                        help="Worker processes (nbody) or torch threads (gpu)")
+    parser.add_argument("--integrators", nargs="+", choices=INTEGRATORS, default=["euler"],
+                        help="Integrators for the nbody cases")
+    parser.add_argument("--steps", type=int, default=5, help="Timed steps per configuration")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed steps before timing")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the initial conditions")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="Run in this process (peak memory is then cumulative)")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON results file")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed slowdown relative to the baseline (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    configs = configurations(args.cases, args.particles, args.theta, args.threads, args.integrators,
+                             args.steps, args.warmup, args.seed)
+    runner = run_case if args.no_isolate else run_isolated
+    results = []
+    for config in configs:
+        result = runner(config)
+        results.append(result)
+        print(_format(result), flush=True)
+
+    with open(args.output, "w") as f:
+        json.dump({"meta": metadata(), "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        rows = compare(results, baseline, args.tolerance)
+        for row in rows:
+            flag = "REGRESSION" if row["regression"] else "ok"
+            print("%-50s %10.4f -> %10.4f s  x%.2f  %s" % (row["key"], row["baseline_s"], row["median_s"],
+                                                         row["ratio"], flag))
+        if any(row["regression"] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
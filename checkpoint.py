@@ -0,0 +1,168 @@
+"""Checkpoint files holding the full state of a simulation.
+
+A checkpoint is an uncompressed ``.npz`` archive of named arrays:
+
+- ``pos``, ``vel``, ``mass``: particle state (float64),
+- ``step``, ``time``: counters,
+- ``params``: simulation parameters as a JSON string,
+- ``rng/python`` and ``rng/numpy*``: state of the ``random`` and NumPy
+  global generators,
+- optional integrator state such as ``accelerations``, ``levels`` and the
+  persistent tree (``tree/<attribute>``).
+
+Only the particle arrays are required, so other backends (``gpu_sim``) can
+read and write the same files. Files are written to a temporary name and
+renamed, so a crash never leaves a truncated checkpoint behind.
+:class:`Checkpointer` writes checkpoints on a background thread.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def rng_state() -> Dict[str, np.ndarray]:
+    """State of the ``random`` and NumPy global generators as arrays."""
+    version, internal, gauss = random.getstate()
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    return {
+        "rng/python": np.asarray(internal, dtype=np.int64),
+        "rng/python_meta": np.asarray(json.dumps([version, gauss])),
+        "rng/numpy_keys": np.asarray(keys),
+        "rng/numpy_meta": np.asarray(json.dumps([name, int(pos), int(has_gauss), float(cached)])),
+    }
+
+
+def set_rng_state(state: Dict[str, np.ndarray]):
+    if "rng/python" in state:
+        version, gauss = json.loads(str(state["rng/python_meta"]))
+        random.setstate((version, tuple(int(v) for v in state["rng/python"]), gauss))
+    if "rng/numpy_keys" in state:
+        name, pos, has_gauss, cached = json.loads(str(state["rng/numpy_meta"]))
+        np.random.set_state((name, state["rng/numpy_keys"], pos, has_gauss, cached))
+
+
+def write_checkpoint(path: str, state: Dict[str, np.ndarray]):
+    """Atomically write ``state`` (a mapping of names to arrays) to ``path``."""
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        np.savez(f, format_version=np.asarray(FORMAT_VERSION), **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_checkpoint(path: str) -> Dict[str, np.ndarray]:
+    """Load all arrays of a checkpoint into memory."""
+    with np.load(path, allow_pickle=False) as data:
+        state = {key: data[key] for key in data.files}
+    version = int(state.pop("format_version", 0))
+    if version != FORMAT_VERSION:
+        raise ValueError("unsupported checkpoint version %d in %s" % (version, path))
+    return state
+
+
+def particle_state(pos, vel, mass, step: int = 0, sim_time: float = 0.0,
+                   params: Optional[Dict] = None) -> Dict[str, np.ndarray]:
+    """Minimal checkpoint contents: particles, counters and parameters."""
+    return {
+        "pos": np.array(pos, dtype=np.float64),
+        "vel": np.array(vel, dtype=np.float64),
+        "mass": np.array(mass, dtype=np.float64),
+        "step": np.asarray(step, dtype=np.int64),
+        "time": np.asarray(sim_time, dtype=np.float64),
+        "params": np.asarray(json.dumps(params or {})),
+    }
+
+
+def params_of(state: Dict[str, np.ndarray]) -> Dict:
+    return json.loads(str(state["params"])) if "params" in state else {}
+
+
+class Checkpointer:
+    """Write checkpoints of a simulation every ``every`` steps or ``interval`` seconds.
+
+    :meth:`maybe_save` takes a snapshot (a copy of the state arrays) in the
+    calling thread and hands it to a writer thread. If a write is still
+    running when the next snapshot is due, the pending snapshot is replaced
+    by the newer one, so a slow disk never stalls the step loop. ``path`` may
+    contain ``{step}`` to keep one file per checkpoint.
+    """
+
+    def __init__(self, path: str, every: int = 0, interval: Optional[float] = None):
+        if not every and interval is None:
+            raise ValueError("give a step interval (every) or a wall-clock interval")
+        self.path = path
+        self.every = every
+        self.interval = interval
+        self.written = 0
+        self._last = time.monotonic()
+        self._cond = threading.Condition()
+        self._pending = None
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def due(self, step: int) -> bool:
+        if self.every and step % self.every == 0:
+            return True
+        return self.interval is not None and time.monotonic() - self._last >= self.interval
+
+    def maybe_save(self, sim) -> bool:
+        """Checkpoint ``sim`` if one is due; returns whether one was queued."""
+        if not self.due(sim.step_count):
+            return False
+        self.save(sim)
+        return True
+
+    def save(self, sim):
+        """Queue a checkpoint of ``sim`` regardless of the schedule."""
+        self._raise()
+        state = sim.checkpoint_state()
+        path = self.path.format(step=sim.step_count)
+        self._last = time.monotonic()
+        with self._cond:
+            self._pending = (path, state)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                path, state = self._pending
+                self._pending = None
+            try:
+                write_checkpoint(path, state)
+                self.written += 1
+            except BaseException as exc:  # reported to the simulation thread
+                self._error = exc
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        """Finish pending writes and stop the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,39 +1,137 @@
+import argparse
 import os
+import shutil
+import subprocess
+
 import numpy as np
-from PIL import Image
+from PIL import GifImagePlugin, Image
+
+from recorder import Recording
+from render import COLORINGS, MODES, render_recording
+
+
+class GifWriter:
+    """Write an animated GIF one frame at a time.
+
+    The palette is derived from the first frame and reused for every later
+    frame, so nothing but the current frame is kept in memory.
+    """
+
+    def __init__(self, path, delay=10, loop=0):
+        self.path = path
+        self.delay = delay
+        self.loop = loop
+        self._file = open(path, "wb")
+        self._palette = None
+
+    def write(self, frame):
+        im = Image.fromarray(frame)
+        if self._palette is None:
+            self._palette = im.quantize(256, method=Image.Quantize.MEDIANCUT)
+            header, _ = GifImagePlugin.getheader(self._palette.copy(), info={"loop": self.loop,
+                                                                             "duration": self.delay})
+            for block in header:
+                self._file.write(block)
+        frame_im = im.quantize(palette=self._palette, dither=Image.Dither.NONE)
+        for block in GifImagePlugin.getdata(frame_im, duration=self.delay):
+            self._file.write(block)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.write(b";")
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
-from recorder import SimulationRecorder
+class VideoWriter:
+    """Pipe raw RGB frames into ``ffmpeg`` to encode a video file."""
+
+    def __init__(self, path, size, fps=30):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise RuntimeError("video output requires ffmpeg on PATH")
+        self._proc = subprocess.Popen(
+            [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+             "-s", "%dx%d" % (size, size), "-r", str(fps), "-i", "-",
+             "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", path],
+            stdin=subprocess.PIPE,
+        )
+
+    def write(self, frame):
+        self._proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    def close(self):
+        if self._proc.stdin and not self._proc.stdin.closed:
+            self._proc.stdin.close()
+            if self._proc.wait():
+                raise RuntimeError("ffmpeg exited with status %d" % self._proc.returncode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def save_gif(frames, path, delay=10):
-    images = [Image.fromarray(f).convert("P", palette=Image.ADAPTIVE) for f in frames]
-    images[0].save(
-        path,
-        save_all=True,
-        append_images=images[1:],
-        loop=0,
-        duration=delay,
-        optimize=True,
-    )
-
-
-def main():
-    if not os.path.exists("simulation.bin"):
-        raise FileNotFoundError("simulation.bin not found")
-    rec = SimulationRecorder.load("simulation.bin")
-    size = 200
-    frames = []
-    for pts in rec.frames:
-        img = np.zeros((size, size, 3), dtype=np.uint8)
-        for x, y, z in pts:
-            ix = int((x + 2) / 4 * (size - 1))
-            iy = int((y + 2) / 4 * (size - 1))
-            if 0 <= ix < size and 0 <= iy < size:
-                c = int(max(0, min(255, 128 + 127 * z)))
-                img[iy, ix] = (0, c, 255 - c)
-        frames.append(img)
-    save_gif(frames, "simulation.gif")
-    Image.fromarray(frames[-1]).save("simulation.png")
+    """Stream ``frames`` (any iterable of RGB arrays) into a GIF file."""
+    with GifWriter(path, delay=delay) as writer:
+        for frame in frames:
+            writer.write(frame)
+
+
+def export(frames, path, size, delay=10, png=None):
+    """Write ``frames`` to a GIF or, for other extensions, a video file.
+
+    Frames are consumed one at a time; the last one is also saved to ``png``.
+    """
+    last = None
+    if path.lower().endswith(".gif"):
+        writer = GifWriter(path, delay=delay)
+    else:
+        writer = VideoWriter(path, size, fps=max(1, round(1000 / delay)))
+    with writer:
+        for frame in frames:
+            writer.write(frame)
+            last = frame
+    if png and last is not None:
+        Image.fromarray(last).save(png)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a simulation recording to a GIF or video")
+    parser.add_argument("input", nargs="?", default="simulation.bin", help="Recording file")
+    parser.add_argument("-o", "--output", default="simulation.gif",
+                        help="Output file (.gif, or a video format such as .mp4 via ffmpeg)")
+    parser.add_argument("--png", default="simulation.png", help="Also save the last frame here ('' to skip)")
+    parser.add_argument("--size", type=int, default=200, help="Image width and height in pixels")
+    parser.add_argument("--extent", type=float, default=2.0, help="Half width of the view in simulation units")
+    parser.add_argument("--mode", choices=MODES, default="points", help="Blending mode")
+    parser.add_argument("--color", choices=COLORINGS, default="depth",
+                        help="Color particles by height or by local density")
+    parser.add_argument("--start", type=int, default=0, help="First frame")
+    parser.add_argument("--stop", type=int, default=None, help="Frame to stop before")
+    parser.add_argument("--stride", type=int, default=1, help="Render every n-th frame")
+    parser.add_argument("--delay", type=int, default=10, help="Frame delay in milliseconds")
+    parser.add_argument("--workers", type=int, default=None, help="Rendering processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.input):
+        raise FileNotFoundError("%s not found" % args.input)
+    recording = Recording(args.input)
+    indices = range(len(recording))[args.start:args.stop:args.stride]
+    if not indices:
+        raise ValueError("no frames to render: %s has %d frames, selected [%s:%s:%s]"
+                         % (args.input, len(recording), args.start, "" if args.stop is None else args.stop,
+                            args.stride))
+    frames = render_recording(args.input, indices, size=args.size, extent=args.extent,
+                              mode=args.mode, workers=args.workers, color=args.color)
+    export(frames, args.output, args.size, delay=args.delay, png=args.png or None)
 
 
 if __name__ == "__main__":
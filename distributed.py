@@ -0,0 +1,429 @@
+"""Barnes-Hut across several processes with Morton-key domain decomposition.
+
+Every rank is a separate process that owns the particles of one contiguous
+range of Morton keys and never sees the whole system. Each pair of ranks is
+connected by a pipe for the bulk data (migrating particles and essential
+trees); the coordinating parent process only sends commands and collects
+small replies such as bounds, work counts, key samples and energy sums. No
+shared memory or external services are involved.
+
+Ranks draw their share of the initial conditions themselves (see
+:func:`initial_conditions.generate_range`); the coordinator only reduces the
+mass moments needed to recenter the system. A leapfrog step then runs in
+three rounds:
+
+1. ``drift``: each rank kicks and drifts its particles and reports their
+   bounds. The coordinator keeps one root cube for all ranks and enlarges it
+   (with a margin) when particles leave it.
+2. ``migrate``: particles whose key left the rank's range are sent straight
+   to their new owner. When the measured work of the ranks drifts apart, the
+   key ranges are first recomputed from weighted key samples so that each
+   rank gets the same share of work (``sample``).
+3. ``forces``: each rank builds its local tree in the shared root cube and,
+   for every other domain, walks it with the opening test against the
+   domain's bounding box. Accepted nodes are sent as point masses, opened
+   leaves as their particles: the local essential tree. With the trees
+   received from the other ranks it builds a tree over its own particles
+   plus the imported ones, computes the accelerations of its own particles
+   and finishes the step with the second kick.
+
+The opening test against the nearest point of a domain is at least as strict
+as against any particle in it, so forces are as accurate as those of a
+single tree with the same ``theta``. Work is measured as tree-walk
+operations per rank (see :data:`octree.WALK_COUNTERS`).
+"""
+
+import argparse
+import random
+import threading
+import time
+import traceback
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from initial_conditions import MODELS, generate_range, parse_params
+from nbody import ROOT_MARGIN, compute_kinetic_energy
+from octree import LinearOctree, _ranges, bounding_cube, morton_keys
+from particles import ParticleSet
+
+# Key samples each rank contributes when the domains are rebalanced
+SAMPLE_KEYS = 4096
+
+_KEY_END = np.iinfo(np.uint64).max
+
+
+def essential_tree(tree: LinearOctree, lo: np.ndarray, hi: np.ndarray, theta: float, eps: float):
+    """Point masses of ``tree`` that a domain with bounding box ``[lo, hi]`` needs.
+
+    Returns ``(pos, mass)``: the centers of mass of nodes that pass the
+    opening test for the point of the box nearest to them, and the particles
+    of leaves that do not.
+    """
+    theta2 = theta * theta
+    eps2 = eps * eps
+    nodes: List[np.ndarray] = []
+    parts: List[np.ndarray] = []
+    frontier = np.zeros(1, dtype=np.int64)
+    while len(frontier):
+        com = tree.com[frontier]
+        d = np.maximum(lo - com, 0.0) + np.maximum(com - hi, 0.0)
+        size = tree.size[frontier]
+        accept = size * size < theta2 * (np.einsum("ij,ij->i", d, d) + eps2)
+        nodes.append(frontier[accept])
+        rest = frontier[~accept]
+        leaf = tree.first_child[rest] < 0
+        parts.append(_ranges(tree.start[rest[leaf]], tree.end[rest[leaf]]))
+        inner = rest[~leaf]
+        frontier = _ranges(tree.first_child[inner], tree.first_child[inner] + tree.n_children[inner])
+    nodes_ = np.concatenate(nodes)
+    parts_ = np.concatenate(parts)
+    return (np.concatenate((tree.com[nodes_], tree.pos[parts_])),
+            np.concatenate((tree.mass[nodes_], tree.pmass[parts_])))
+
+
+class _Rank:
+    """State and message handlers of one rank, living in a worker process."""
+
+    def __init__(self, rank: int, params: Dict, peers: Dict):
+        self.rank = rank
+        self.params = params
+        self.peers = peers
+        self.pos = np.empty((0, 3))
+        self.vel = np.empty((0, 3))
+        self.mass = np.empty(0)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.acc = np.empty((0, 3))
+        self.tree: Optional[LinearOctree] = None
+        self.work = 0
+
+    def _send_all(self, outgoing: Dict):
+        for peer, conn in self.peers.items():
+            conn.send(outgoing.get(peer))
+
+    def _exchange(self, outgoing: Dict) -> List:
+        """Send ``outgoing[peer]`` to every peer and return what the peers sent here.
+
+        Sending runs in a thread so that ranks sending large messages to each
+        other at the same time cannot block each other on full pipes.
+        """
+        sender = threading.Thread(target=self._send_all, args=(outgoing,), daemon=True)
+        sender.start()
+        received = [conn.recv() for conn in self.peers.values()]
+        sender.join()
+        return [message for message in received if message is not None]
+
+    def generate(self, model: str, n: int, start: int, stop: int, seed: int, params: Dict):
+        """Draw particles ``start:stop`` of the system and return their mass moments."""
+        self.pos, self.vel, self.mass = generate_range(model, n, start, stop, seed, **params)
+        self.ids = np.arange(start, stop)
+        self.acc = np.zeros_like(self.pos)
+        return float(self.mass.sum()), self.mass @ self.pos, self.mass @ self.vel
+
+    def shift(self, dpos, dvel):
+        self.pos -= dpos
+        self.vel -= dvel
+        return self.bounds()
+
+    def bounds(self):
+        if not len(self.pos):
+            return None
+        return self.pos.min(axis=0), self.pos.max(axis=0)
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def drift(self, dt: float):
+        self.vel += self.acc * (0.5 * dt)
+        self.pos += self.vel * dt
+        return self.bounds()
+
+    def sample(self, center, half_size):
+        """Sorted key samples, each weighted with the work of the particles it stands for."""
+        n = len(self.pos)
+        if not n:
+            return np.empty(0, dtype=np.uint64), np.empty(0)
+        keys = np.sort(morton_keys(self.pos, center, half_size))
+        per_particle = self.work / n if self.work else 1.0
+        idx = np.linspace(0, n, min(n, SAMPLE_KEYS) + 1).astype(np.int64)
+        return keys[idx[:-1]], np.diff(idx) * per_particle
+
+    def migrate(self, center, half_size, splitters):
+        """Send the particles outside this rank's key range to their owners and take in the ones for it."""
+        outgoing = {}
+        try:
+            owner = np.searchsorted(splitters, morton_keys(self.pos, center, half_size), side="right")
+            for dest in np.unique(owner).tolist():
+                if dest != self.rank:
+                    sel = owner == dest
+                    outgoing[dest] = (self.pos[sel], self.vel[sel], self.mass[sel], self.ids[sel])
+            keep = owner == self.rank
+        finally:
+            # Always take part in the exchange so the peers do not wait forever
+            incoming = self._exchange(outgoing)
+        self.pos = np.concatenate([self.pos[keep]] + [p[0] for p in incoming])
+        self.vel = np.concatenate([self.vel[keep]] + [p[1] for p in incoming])
+        self.mass = np.concatenate([self.mass[keep]] + [p[2] for p in incoming])
+        self.ids = np.concatenate([self.ids[keep]] + [p[3] for p in incoming])
+        return self.bounds()
+
+    def forces(self, center, half_size, boxes, kick: float):
+        """Exchange essential trees, then compute the local accelerations and kick by ``kick``."""
+        p = self.params
+        n = len(self.pos)
+        exports = {}
+        try:
+            if n:
+                tree = LinearOctree(self.pos, self.mass, leaf_size=p["leaf_size"], center=center,
+                                    half_size=half_size)
+                exports = {
+                    dest: essential_tree(tree, box[0], box[1], p["theta"], p["eps"])
+                    for dest, box in enumerate(boxes)
+                    if dest != self.rank and box is not None
+                }
+        finally:
+            imports = self._exchange(exports)
+        counts: Dict[str, int] = {}
+        if n:
+            pos = np.concatenate([self.pos] + [imp[0] for imp in imports])
+            mass = np.concatenate([self.mass] + [imp[1] for imp in imports])
+            self.tree = LinearOctree(pos, mass, leaf_size=p["leaf_size"], center=center, half_size=half_size)
+            self.acc = self.tree.accelerations(p["theta"], p["G"], p["eps"], targets=np.arange(n),
+                                               mode=p["mode"], group_size=p["group_size"], counts=counts)
+        else:
+            self.tree = None
+            self.acc = np.empty((0, 3))
+        self.vel += self.acc * kick
+        self.work = sum(counts.values())
+        return self.work
+
+    def energy(self):
+        """Kinetic and tree-estimated potential energy of the local particles.
+
+        Uses the tree of the last force evaluation, so the potential is taken
+        at the positions the accelerations were computed for.
+        """
+        p = self.params
+        n = len(self.pos)
+        kinetic = compute_kinetic_energy(ParticleSet(self.pos, self.vel, self.mass))
+        if self.tree is None or not n:
+            return kinetic, 0.0
+        phi = self.tree.potentials(p["theta"], p["G"], p["eps"], p["group_size"], targets=np.arange(n))
+        return kinetic, 0.5 * float(np.dot(self.mass, phi))
+
+    def gather(self):
+        return self.pos, self.vel, self.mass, self.ids, self.acc
+
+
+def _serve(rank: int, params: Dict, conn, peers: Dict):
+    state = _Rank(rank, params, peers)
+    while True:
+        command, args = conn.recv()
+        if command == "stop":
+            conn.close()
+            for peer in peers.values():
+                peer.close()
+            return
+        try:
+            reply = ("ok", getattr(state, command)(*args))
+        except Exception:
+            reply = ("error", traceback.format_exc())
+        conn.send(reply)
+
+
+class DistributedSimulation:
+    """Leapfrog Barnes-Hut simulation split across ``ranks`` worker processes.
+
+    Takes the same physical parameters as :class:`nbody.BarnesHutSimulation`.
+    The key ranges are recomputed when the most loaded rank does more than
+    ``imbalance`` times the average work. :meth:`gather` and
+    :attr:`particles` copy every particle into this process, which is only
+    meant for inspecting small systems.
+    """
+
+    def __init__(self, num_particles: int = 100, ranks: int = 2, dt: float = 0.01, theta: float = 0.5,
+                 eps: float = 0.05, G: float = 1.0, mode: str = "bh", leaf_size: int = 8, group_size: int = 32,
+                 imbalance: float = 1.2, model: str = "spiral", seed: Optional[int] = None,
+                 model_params: Optional[Dict[str, float]] = None):
+        if ranks < 1:
+            raise ValueError("need at least one rank")
+        if model not in MODELS:
+            raise ValueError("unknown model %r (choose from %s)" % (model, ", ".join(MODELS)))
+        self.ranks = ranks
+        self.dt = dt
+        self.theta = theta
+        self.eps = eps
+        self.imbalance = imbalance
+        self.step_count = 0
+        self.time = 0.0
+        self.rebalances = 0
+        self.work = [0] * ranks
+        params = dict(theta=theta, eps=eps, G=G, leaf_size=leaf_size, group_size=group_size,
+                      mode="group" if mode == "group" else "particle")
+        ctx = get_context("spawn")
+        peers: List[Dict] = [{} for _ in range(ranks)]
+        for a in range(ranks):
+            for b in range(a + 1, ranks):
+                peers[a][b], peers[b][a] = ctx.Pipe()
+        self._conns = []
+        self._procs = []
+        for rank in range(ranks):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_serve, args=(rank, params, child, peers[rank]), daemon=True)
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        for rank_peers in peers:
+            for conn in rank_peers.values():
+                conn.close()
+        self.center = np.zeros(3)
+        self.half_size = 1.0
+        self.splitters = np.zeros(0, dtype=np.uint64)
+
+        # Every rank draws its own slice; only the mass moments come back here
+        model_params = dict(model_params or {})
+        recenter = bool(model_params.pop("recenter", True))
+        if seed is None:
+            seed = random.getrandbits(63)
+        edges = [num_particles * rank // ranks for rank in range(ranks + 1)]
+        moments = self._call("generate", [(model, num_particles, edges[rank], edges[rank + 1], seed, model_params)
+                                          for rank in range(ranks)])
+        if recenter and num_particles:
+            total = sum(m[0] for m in moments)
+            bounds = self._broadcast("shift", sum(m[1] for m in moments) / total,
+                                     sum(m[2] for m in moments) / total)
+        else:
+            bounds = self._broadcast("bounds")
+        self._set_cube(bounds)
+        self._decompose(rebalance=True)
+        self._forces(kick=0.0)
+
+    def _call(self, command: str, args: Optional[Sequence] = None) -> List:
+        """Run ``command`` on every rank (with per-rank ``args``) and collect the replies."""
+        for rank, conn in enumerate(self._conns):
+            conn.send((command, args[rank] if args is not None else ()))
+        replies = [conn.recv() for conn in self._conns]
+        for rank, (status, value) in enumerate(replies):
+            if status != "ok":
+                raise RuntimeError("rank %d failed in %s:\n%s" % (rank, command, value))
+        return [value for _, value in replies]
+
+    def _broadcast(self, command: str, *args) -> List:
+        return self._call(command, [args] * self.ranks)
+
+    def _set_cube(self, bounds):
+        lo = np.min([b[0] for b in bounds if b is not None], axis=0)
+        hi = np.max([b[1] for b in bounds if b is not None], axis=0)
+        center, half_size = bounding_cube(np.stack((lo, hi)))
+        self.center, self.half_size = center, half_size * (1.0 + ROOT_MARGIN)
+
+    def _contains(self, bounds) -> bool:
+        return all(b is None or (np.abs(np.stack(b) - self.center).max() < self.half_size) for b in bounds)
+
+    def _decompose(self, rebalance: bool):
+        work = np.asarray(self.work, dtype=np.float64)
+        if rebalance or (work.mean() > 0 and work.max() > self.imbalance * work.mean()):
+            samples = self._broadcast("sample", self.center, self.half_size)
+            keys = np.concatenate([s[0] for s in samples])
+            weights = np.concatenate([s[1] for s in samples])
+            order = np.argsort(keys, kind="stable")
+            cumulative = np.cumsum(weights[order])
+            if len(keys):
+                cuts = cumulative[-1] * np.arange(1, self.ranks) / self.ranks
+                self.splitters = keys[order][np.minimum(np.searchsorted(cumulative, cuts), len(keys) - 1)]
+            else:
+                self.splitters = np.full(self.ranks - 1, _KEY_END, dtype=np.uint64)
+            self.rebalances += 1
+        self.boxes = self._broadcast("migrate", self.center, self.half_size, self.splitters)
+
+    def _forces(self, kick: float):
+        self.work = self._broadcast("forces", self.center, self.half_size, self.boxes, kick)
+
+    def step(self):
+        bounds = self._broadcast("drift", self.dt)
+        rebalance = not self._contains(bounds)
+        if rebalance:
+            self._set_cube(bounds)
+        self._decompose(rebalance)
+        self._forces(kick=0.5 * self.dt)
+        self.step_count += 1
+        self.time += self.dt
+
+    def energy(self) -> float:
+        """Total energy, summed over the ranks with the Barnes-Hut potential estimate."""
+        return sum(kinetic + potential for kinetic, potential in self._broadcast("energy"))
+
+    def gather(self):
+        """``(pos, vel, mass, acc)`` of all particles in their original order."""
+        parts = self._broadcast("gather")
+        ids = np.concatenate([p[3] for p in parts])
+        order = np.argsort(ids)
+        pos, vel, mass, acc = (np.concatenate([p[i] for p in parts])[order] for i in (0, 1, 2, 4))
+        return pos, vel, mass, acc
+
+    @property
+    def particles(self) -> ParticleSet:
+        pos, vel, mass, _ = self.gather()
+        return ParticleSet(pos, vel, mass)
+
+    @property
+    def accelerations(self) -> np.ndarray:
+        return self.gather()[3]
+
+    def counts(self) -> List[int]:
+        """Number of particles owned by each rank."""
+        return self._broadcast("count")
+
+    def run(self, iterations: int):
+        e0 = self.energy()
+        t0 = time.time()
+        for _ in range(iterations):
+            self.step()
+        elapsed = time.time() - t0
+        print("Energy drift:", self.energy() - e0)
+        print("Particles per rank:", self.counts(), "rebalances:", self.rebalances)
+        print("Simulation time: %.2f s" % elapsed)
+
+    def close(self):
+        for conn, proc in zip(self._conns, self._procs):
+            try:
+                conn.send(("stop", ()))
+            except OSError:
+                pass
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
+            conn.close()
+        self._conns, self._procs = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Barnes-Hut N-body simulation across processes")
+    parser.add_argument("--particles", type=int, default=10000, help="Number of particles")
+    parser.add_argument("--ranks", type=int, default=4, help="Worker processes")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of steps")
+    parser.add_argument("--dt", type=float, default=0.01, help="Time step")
+    parser.add_argument("--mode", choices=["bh", "group"], default="group", help="Tree walk")
+    parser.add_argument("--theta", type=float, default=0.5, help="Barnes-Hut opening angle")
+    parser.add_argument("--eps", type=float, default=0.05, help="Softening parameter")
+    parser.add_argument("--model", choices=sorted(MODELS), default="spiral", help="Initial conditions")
+    parser.add_argument("--model-param", action="append", metavar="KEY=VALUE",
+                        help="Model parameter, e.g. --model-param separation=6 (repeatable)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the initial conditions")
+    args = parser.parse_args(argv)
+    with DistributedSimulation(args.particles, ranks=args.ranks, dt=args.dt, theta=args.theta, eps=args.eps,
+                               mode=args.mode, model=args.model, seed=args.seed,
+                               model_params=parse_params(args.model_param)) as sim:
+        sim.run(args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
 import tkinter as tk
 from tkinter import ttk
-import math
 
+import numpy as np
+
+from backends import available_backends, make_backend
+from initial_conditions import MODELS
 from nbody import BarnesHutSimulation
+from render import density_colors, ppm_bytes, speed_colors, splat
+from streaming import FrameStream, snapshot
+
+COLORINGS = ("velocity", "density", "white")
+DENSITY_NEIGHBORS = 32
 
 
 class GalaxyApp:
@@ -12,6 +20,9 @@ class GalaxyApp:
         self.canvas_size = 600
         self.canvas = tk.Canvas(self.root, width=self.canvas_size, height=self.canvas_size, bg="black")
         self.canvas.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+        # All particles are rasterized into this image, blitted as one item
+        self.photo = tk.PhotoImage(width=self.canvas_size, height=self.canvas_size)
+        self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW)
 
         controls = tk.Frame(self.root)
         controls.pack(side=tk.BOTTOM, fill=tk.X)
@@ -22,7 +33,8 @@ class GalaxyApp:
         self.eps_var = tk.DoubleVar(value=0.05)
 
         tk.Label(controls, text="Particles").pack(side=tk.LEFT)
-        tk.Scale(controls, from_=50, to=500, orient=tk.HORIZONTAL, variable=self.n_var).pack(side=tk.LEFT)
+        tk.Scale(controls, from_=50, to=50000, resolution=50, orient=tk.HORIZONTAL,
+                 variable=self.n_var).pack(side=tk.LEFT)
         tk.Label(controls, text="Time step").pack(side=tk.LEFT)
         tk.Scale(controls, from_=1, to=100, orient=tk.HORIZONTAL, variable=self.dt_var).pack(side=tk.LEFT)
         tk.Label(controls, text="Iterations").pack(side=tk.LEFT)
@@ -30,25 +42,71 @@ class GalaxyApp:
         tk.Label(controls, text="Softening").pack(side=tk.LEFT)
         tk.Scale(controls, from_=1, to=100, orient=tk.HORIZONTAL, variable=self.eps_var).pack(side=tk.LEFT)
 
-        # Enable velocity-based coloring by default for better visual feedback
-        self.color_var = tk.BooleanVar(value=True)
-        tk.Checkbutton(controls, text="Color by velocity", variable=self.color_var).pack(side=tk.LEFT)
+        self.model_var = tk.StringVar(value="spiral")
+        tk.Label(controls, text="Model").pack(side=tk.LEFT)
+        tk.OptionMenu(controls, self.model_var, *MODELS).pack(side=tk.LEFT)
+
+        self.backend_var = tk.StringVar(value="numpy")
+        tk.Label(controls, text="Backend").pack(side=tk.LEFT)
+        tk.OptionMenu(controls, self.backend_var, *available_backends()).pack(side=tk.LEFT)
+
+        # Velocity-based coloring by default for better visual feedback;
+        # density coloring adds a neighbor search per published step
+        self.color_var = tk.StringVar(value="velocity")
+        self.color_var.trace_add("write", self.set_coloring)
+        tk.Label(controls, text="Color").pack(side=tk.LEFT)
+        tk.OptionMenu(controls, self.color_var, *COLORINGS).pack(side=tk.LEFT)
 
         ttk.Button(controls, text="Start", command=self.start).pack(side=tk.LEFT)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
 
         self.sim = None
+        # The simulation steps on the stream's thread; the UI polls a
+        # one-slot subscription that keeps only the newest snapshot, so a
+        # slow display never holds up the simulation and a slow step never
+        # freezes the UI
+        self.stream = None
+        self.frames = None
         self.current_iter = 0
+        self.total_iter = 0
 
     def start(self):
+        self.stop()
         n = self.n_var.get()
         dt = self.dt_var.get() / 100.0
         iterations = self.iter_var.get()
         eps = self.eps_var.get() / 100.0
-        self.sim = BarnesHutSimulation(num_particles=n, dt=dt, eps=eps)
+        backend = make_backend(self.backend_var.get())
+        # The group walk is fastest, but the python backend only has "bh"
+        mode = "group" if "group" in backend.modes else "bh"
+        self.sim = BarnesHutSimulation(num_particles=n, dt=dt, eps=eps, mode=mode, model=self.model_var.get(),
+                                       backend=backend)
         self.current_iter = 0
         self.total_iter = iterations
+        self.draw(snapshot(self.sim, self.density_neighbors()))
+        self.stream = FrameStream(self.sim, iterations, close_sim=True,
+                                  density_neighbors=self.density_neighbors())
+        self.frames = self.stream.subscribe(maxsize=1, policy="drop")
+        self.stream.start()
         self.update_simulation()
 
+    def stop(self):
+        if self.stream is not None:
+            self.frames.close()
+            self.stream = self.frames = None
+
+    def close(self):
+        self.stop()
+        self.root.destroy()
+
+    def density_neighbors(self) -> int:
+        return DENSITY_NEIGHBORS if self.color_var.get() == "density" else 0
+
+    def set_coloring(self, *_):
+        # Densities are computed by the producer, from the tree of each step
+        if self.stream is not None:
+            self.stream.density_neighbors = self.density_neighbors()
+
     def project(self, x, y, z):
         distance = 3.0
         scale = self.canvas_size / 4
@@ -59,38 +117,33 @@ class GalaxyApp:
         py = cy - y * factor
         # Clamp coordinates so that the 2x2 particle remains fully visible
         # within the canvas boundaries
-        px = max(2, min(self.canvas_size - 2, px))
-        py = max(2, min(self.canvas_size - 2, py))
+        px = np.clip(px, 2, self.canvas_size - 2)
+        py = np.clip(py, 2, self.canvas_size - 2)
         return px, py
 
-    def draw(self):
-        self.canvas.delete("all")
-        if not self.sim:
-            return
-        colorize = self.color_var.get()
-        max_speed = 0.0
-        if colorize:
-            for p in self.sim.particles:
-                speed = math.sqrt(p.vx * p.vx + p.vy * p.vy + p.vz * p.vz)
-                if speed > max_speed:
-                    max_speed = speed
-
-        for p in self.sim.particles:
-            px, py = self.project(p.x, p.y, p.z)
-            color = "white"
-            if colorize and max_speed > 0:
-                speed = math.sqrt(p.vx * p.vx + p.vy * p.vy + p.vz * p.vz)
-                t = min(1.0, speed / max_speed)
-                r = int(t * 255)
-                b = int((1.0 - t) * 255)
-                color = f"#{r:02x}00{b:02x}"
-            self.canvas.create_oval(px-2, py-2, px+2, py+2, fill=color, outline="")
+    def draw(self, snap):
+        pos = snap.pos
+        px, py = self.project(pos[:, 0], pos[:, 1], pos[:, 2])
+        coloring = self.color_var.get()
+        if coloring == "velocity":
+            colors = speed_colors(snap.vel)
+        elif coloring == "density" and snap.density is not None:
+            colors = density_colors(snap.density)
+        else:
+            colors = np.full((len(pos), 3), 255, dtype=np.uint8)
+        img = splat(px, py, colors, self.canvas_size, self.canvas_size)
+        self.photo.configure(data=ppm_bytes(img), format="PPM")
 
     def update_simulation(self):
-        if self.sim and self.current_iter < self.total_iter:
-            self.sim.step()
-            self.current_iter += 1
-            self.draw()
+        if self.stream is None:
+            return
+        # Check liveness first so a frame posted just before exit is not lost
+        alive = self.stream.running
+        snap = self.frames.latest()
+        if snap is not None:
+            self.current_iter = snap.step
+            self.draw(snap)
+        if self.current_iter < self.total_iter and alive:
             self.root.after(10, self.update_simulation)
 
     def run(self):
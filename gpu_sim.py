@@ -1,109 +1,331 @@
 import argparse
+import math
+import os
+
 import torch
 
+import initial_conditions
+from checkpoint import particle_state, read_checkpoint, write_checkpoint
+
+
+def generate_initial_conditions(model, num, device="cuda", seed=None, dtype=torch.float32, **params):
+    """Particles from :mod:`initial_conditions` as tensors on ``device``.
+
+    The same model and seed give the same particles as the NumPy backend.
+    """
+    arrays = initial_conditions.generate(model, num, seed=seed, **params)
+    return tuple(torch.from_numpy(a).to(device=device, dtype=dtype) for a in arrays)
+
+
+def generate_spiral_galaxy(num, radius=1.0, device="cuda", seed=None):
+    return generate_initial_conditions("spiral", num, device=device, seed=seed, recenter=False, radius=radius)
+
+
+MAX_TILE_BYTES = 256 << 20  # upper bound for one pairwise tile on a GPU
+CPU_TILE_BYTES = 4 << 20  # CPU tiles are kept cache sized
+_VALUES_PER_PAIR = 5  # dx, dy, dz, r2 and the force factor
+
+
+def available_memory(device):
+    """Free memory in bytes on ``device`` (an estimate for the CPU)."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 1 << 30
+
+
+def tile_shape(n_targets, n_sources, itemsize, memory_budget=None, device="cpu"):
+    """Rows and columns of a pairwise tile that fits in ``memory_budget`` bytes.
+
+    Without a budget a quarter of the free memory is used, capped at
+    :data:`MAX_TILE_BYTES` on a GPU and :data:`CPU_TILE_BYTES` on the CPU.
+    Tiles that cannot hold all pairs are made roughly square so each block
+    of sources is reused by as many targets as possible.
+    """
+    if memory_budget is None:
+        cap = CPU_TILE_BYTES if torch.device(device).type == "cpu" else MAX_TILE_BYTES
+        memory_budget = min(available_memory(device) // 4, cap)
+    pairs = max(1, int(memory_budget) // (_VALUES_PER_PAIR * itemsize))
+    cols = max(1, min(n_sources, max(math.isqrt(pairs), pairs // max(1, n_targets))))
+    rows = max(1, min(n_targets, pairs // cols))
+    return rows, cols
+
+
+def _pair_tiles(pos, compute_dtype, memory_budget, targets=None):
+    """Yield ``(target slice, source slice, d, r2)`` over all pairwise tiles.
+
+    ``d`` holds ``source - target`` separations of shape ``(3, rows, cols)``
+    and ``r2`` their squared lengths, both in ``compute_dtype``. With
+    ``targets`` only those particles are targets, and target slices index
+    into ``targets``.
+    """
+    n = pos.size(0)
+    x = pos.to(compute_dtype)
+    xt_all = x.t().contiguous()
+    xt_tgt = xt_all if targets is None else xt_all[:, targets]
+    m = xt_tgt.size(1)
+    rows, cols = tile_shape(m, n, x.element_size(), memory_budget, pos.device)
+    for r0 in range(0, m, rows):
+        tgt = slice(r0, min(m, r0 + rows))
+        for c0 in range(0, n, cols):
+            src = slice(c0, min(n, c0 + cols))
+            d = xt_all[:, src].unsqueeze(1) - xt_tgt[:, tgt].unsqueeze(2)
+            yield tgt, src, d, (d * d).sum(0)
+
+
+def direct_accelerations(pos, mass, G=1.0, eps=0.05, compute_dtype=None, memory_budget=None, targets=None):
+    """Softened pairwise accelerations, summed tile by tile.
+
+    Each tile is evaluated in ``compute_dtype`` (default: the dtype of
+    ``pos``) and added into a float64 accumulator, so a float32 kernel keeps
+    most of the accuracy of a float64 sum. Memory use is bounded by
+    ``memory_budget`` bytes per tile rather than growing with N².
+    ``targets`` optionally restricts the evaluation to a subset of indices.
+    """
+    compute_dtype = compute_dtype or pos.dtype
+    m = mass.to(compute_dtype)
+    rows = pos.size(0) if targets is None else len(targets)
+    acc = torch.zeros(rows, 3, dtype=torch.float64, device=pos.device)
+    for tgt, src, d, r2 in _pair_tiles(pos, compute_dtype, memory_budget, targets):
+        r2 += eps * eps
+        inv = r2.rsqrt_()
+        # Coincident pairs (including self pairs without softening) add nothing
+        inv = torch.where(torch.isinf(inv), torch.zeros_like(inv), inv)
+        w = inv * inv * inv * m[src]
+        acc[tgt] += torch.einsum("kij,ij->ik", d, w).double()
+    return (acc * G).to(pos.dtype)
+
+
+def potential_energy(pos, mass, G=1.0, eps=0.05, compute_dtype=None, memory_budget=None):
+    """Softened potential energy of all pairs with O(N) extra memory."""
+    compute_dtype = compute_dtype or pos.dtype
+    m = mass.to(compute_dtype)
+    total = torch.zeros((), dtype=torch.float64, device=pos.device)
+    for tgt, src, _, r2 in _pair_tiles(pos, compute_dtype, memory_budget):
+        r2 += eps * eps
+        inv = r2.rsqrt_()
+        if tgt.start < src.stop and src.start < tgt.stop:
+            ti = torch.arange(tgt.start, tgt.stop, device=pos.device).unsqueeze(1)
+            si = torch.arange(src.start, src.stop, device=pos.device).unsqueeze(0)
+            inv = inv.masked_fill(ti == si, 0.0)
+        inv = torch.where(torch.isinf(inv), torch.zeros_like(inv), inv)
+        total += (m[tgt].unsqueeze(1) * inv * m[src]).sum(dtype=torch.float64)
+    # Every pair was visited twice
+    return float(-0.5 * G * total)
+
+
+def kinetic_energy(vel, mass):
+    return float(0.5 * (mass.double() * (vel.double() ** 2).sum(1)).sum())
+
 
-def generate_spiral_galaxy(num, radius=1.0, device="cuda"):
-    central_mass = num
-    G = 1.0
-    r = torch.sqrt(torch.rand(num, device=device)) * radius
-    angle = r * 4.0 + (torch.rand(num, device=device) * 0.4 - 0.2)
-    x = r * torch.cos(angle)
-    y = r * torch.sin(angle)
-    z = torch.randn(num, device=device) * 0.05
-    v_mag = torch.sqrt(G * central_mass / (r + 0.01))
-    vx = -v_mag * torch.sin(angle)
-    vy = v_mag * torch.cos(angle)
-    vz = torch.randn(num, device=device) * 0.01
-    pos = torch.stack((x, y, z), dim=1)
-    vel = torch.stack((vx, vy, vz), dim=1)
-    mass = torch.ones(num, device=device)
-    return pos, vel, mass
-
-
-def step_direct(pos, vel, mass, dt, G=1.0, eps=0.05):
-    diff = pos.unsqueeze(1) - pos.unsqueeze(0)
-    dist_sqr = (diff ** 2).sum(-1) + eps ** 2
-    inv_dist3 = dist_sqr.pow(-1.5)
-    accel = (diff * inv_dist3.unsqueeze(-1) * mass.view(1, -1, 1)).sum(1) * G
+def total_energy(pos, vel, mass, G=1.0, eps=0.05, compute_dtype=None, memory_budget=None):
+    return kinetic_energy(vel, mass) + potential_energy(pos, mass, G, eps, compute_dtype, memory_budget)
+
+
+def step_direct(pos, vel, mass, dt, G=1.0, eps=0.05, compute_dtype=None, memory_budget=None):
+    accel = direct_accelerations(pos, mass, G, eps, compute_dtype, memory_budget)
     vel += accel * dt
     pos += vel * dt
 
 
-class BHNode:
-    def __init__(self, indices, center, half_size):
-        self.indices = indices
-        self.center = center
-        self.half_size = half_size
-        self.children = []
-        self.mass = 0.0
-        self.com = torch.zeros(3, device=center.device)
-
-
-def _build_tree(pos, mass, indices, center, half_size, min_size=1e-5):
-    node = BHNode(indices, center, half_size)
-    if indices.numel() == 0:
-        return node
-    if indices.numel() == 1 or half_size < min_size:
-        node.mass = mass[indices].sum()
-        node.com = (pos[indices] * mass[indices].unsqueeze(1)).sum(0) / node.mass
-        return node
-    half = half_size / 2.0
-    xmask = pos[indices, 0] > center[0]
-    ymask = pos[indices, 1] > center[1]
-    zmask = pos[indices, 2] > center[2]
-    for i in range(8):
-        mask = (
-            (xmask == bool(i & 1))
-            & (ymask == bool(i & 2))
-            & (zmask == bool(i & 4))
-        )
-        sub_idx = indices[mask]
-        offset = torch.tensor(
-            [half if i & 1 else -half, half if i & 2 else -half, half if i & 4 else -half],
-            device=pos.device,
-        )
-        child_center = center + offset
-        child = _build_tree(pos, mass, sub_idx, child_center, half, min_size)
-        if child.indices.numel() > 0:
-            node.children.append(child)
-    if node.children:
-        node.mass = sum(c.mass for c in node.children)
-        node.com = sum(c.mass * c.com for c in node.children) / node.mass
-    return node
-
-
-def _bh_force(node, i, pos, theta, G=1.0, eps=0.05):
-    if node.mass == 0:
-        return torch.zeros(3, device=pos.device)
-    dx = node.com - pos[i]
-    dist = torch.sqrt((dx * dx).sum() + eps * eps)
-    if node.indices.numel() == 1 and node.indices[0] == i:
-        return torch.zeros(3, device=pos.device)
-    if not node.children or node.half_size / dist < theta:
-        return dx * (G * node.mass / (dist ** 3))
-    acc = torch.zeros(3, device=pos.device)
-    for child in node.children:
-        acc = acc + _bh_force(child, i, pos, theta, G, eps)
-    return acc
-
-
-def step_bh(pos, vel, mass, dt, theta=0.5, G=1.0, eps=0.05):
-    center = torch.tensor([0.0, 0.0, 0.0], device=pos.device)
-    indices = torch.arange(pos.size(0), device=pos.device)
-    root = _build_tree(pos, mass, indices, center, 2.0)
-    forces = torch.stack([_bh_force(root, i, pos, theta, G, eps) for i in range(pos.size(0))])
+MAX_LEVEL = 21  # 3 * 21 = 63 Morton key bits, fits in int64
+
+
+def _spread_bits(v):
+    v = v & 0x1FFFFF
+    v = (v | (v << 32)) & 0x1F00000000FFFF
+    v = (v | (v << 16)) & 0x1F0000FF0000FF
+    v = (v | (v << 8)) & 0x100F00F00F00F00F
+    v = (v | (v << 4)) & 0x10C30C30C30C30C3
+    v = (v | (v << 2)) & 0x1249249249249249
+    return v
+
+
+def morton_keys(pos, center, half_size):
+    scale = (1 << MAX_LEVEL) / (2.0 * half_size)
+    q = torch.floor((pos - (center - half_size)) * scale)
+    q = q.clamp(0, (1 << MAX_LEVEL) - 1).to(torch.int64)
+    return _spread_bits(q[:, 0]) | (_spread_bits(q[:, 1]) << 1) | (_spread_bits(q[:, 2]) << 2)
+
+
+def _ranges(starts, ends):
+    """Concatenation of ``arange(s, e)`` for every pair of bounds."""
+    counts = ends - starts
+    offsets = torch.cumsum(counts, 0) - counts
+    total = int(counts.sum())
+    return torch.repeat_interleave(starts - offsets, counts) + torch.arange(total, device=starts.device)
+
+
+class TensorOctree:
+    """Barnes-Hut octree built and walked entirely with tensor operations.
+
+    Particles are sorted by Morton key and the tree is built one level at a
+    time: every node covers a contiguous range of the sorted particles and is
+    split where the next 3-bit key digit changes. Node data lives in flat
+    tensors (range, first child, child count, mass, center of mass, size).
+    """
+
+    def __init__(self, pos, mass, leaf_size=8):
+        device = pos.device
+        lo = pos.min(0).values
+        hi = pos.max(0).values
+        center = 0.5 * (lo + hi)
+        half = float((hi - lo).max()) * 0.5 * (1.0 + 1e-6) or 1.0
+        keys = morton_keys(pos, center, half)
+        keys, self.order = torch.sort(keys, stable=True)
+        self.rank = torch.empty_like(self.order)
+        self.rank[self.order] = torch.arange(len(self.order), device=device)
+        self.pos = pos[self.order]
+        self.pmass = mass[self.order]
+
+        n = pos.size(0)
+        starts = [torch.zeros(1, dtype=torch.int64, device=device)]
+        ends = [torch.full((1,), n, dtype=torch.int64, device=device)]
+        first_child = [torch.full((1,), -1, dtype=torch.int64, device=device)]
+        n_children = [torch.zeros(1, dtype=torch.int64, device=device)]
+        levels = [0]
+        base = 1
+        f_start, f_end = starts[0], ends[0]
+        for level in range(MAX_LEVEL):
+            counts = f_end - f_start
+            split = torch.nonzero(counts > leaf_size).flatten()
+            if split.numel() == 0:
+                break
+            idx = _ranges(f_start[split], f_end[split])
+            prefix = keys[idx] >> (3 * (MAX_LEVEL - level - 1))
+            new = torch.ones(idx.numel(), dtype=torch.bool, device=device)
+            new[1:] = prefix[1:] != prefix[:-1]
+            b = torch.nonzero(new).flatten()
+            c_start = idx[b]
+            c_end = torch.empty_like(c_start)
+            c_end[:-1] = idx[b[1:] - 1] + 1
+            c_end[-1] = idx[-1] + 1
+            cnt = counts[split]
+            first = torch.searchsorted(b, torch.cumsum(cnt, 0) - cnt)
+            first_child[-1][split] = base + first
+            n_children[-1][split] = torch.diff(first, append=first.new_tensor([b.numel()]))
+            starts.append(c_start)
+            ends.append(c_end)
+            first_child.append(torch.full_like(c_start, -1))
+            n_children.append(torch.zeros_like(c_start))
+            levels.append(level + 1)
+            base += b.numel()
+            f_start, f_end = c_start, c_end
+
+        self.start = torch.cat(starts)
+        self.end = torch.cat(ends)
+        self.first_child = torch.cat(first_child)
+        self.n_children = torch.cat(n_children)
+        level = torch.cat([torch.full((s.numel(),), lv, device=device) for s, lv in zip(starts, levels)])
+        self.size = (half / torch.pow(2.0, level.to(pos.dtype))).to(pos.dtype)
+
+        # Node moments from prefix sums over the sorted particles, in float64
+        zero = torch.zeros(1, 4, dtype=torch.float64, device=device)
+        weighted = torch.cat((self.pmass.unsqueeze(1), self.pos * self.pmass.unsqueeze(1)), 1).double()
+        prefix_sums = torch.cat((zero, torch.cumsum(weighted, 0)))
+        sums = prefix_sums[self.end] - prefix_sums[self.start]
+        node_mass = sums[:, 0]
+        self.mass = node_mass.to(pos.dtype)
+        self.com = (sums[:, 1:] / node_mass.clamp_min(1e-300).unsqueeze(1)).to(pos.dtype)
+
+    def __len__(self):
+        return self.start.numel()
+
+    def accelerations(self, theta=0.5, G=1.0, eps=0.05, batch=8192, targets=None):
+        """Accelerations of all particles (or of the indices ``targets``), in the original order.
+
+        Targets are processed ``batch`` at a time. For each batch the walk is
+        a frontier of (target, node) pairs expanded one tree level per
+        iteration: accepted nodes are applied as point masses, leaves are
+        summed directly and the remaining pairs are replaced by the node's
+        children.
+        """
+        device = self.pos.device
+        # Sorted index of the particle in each output row
+        rows = torch.arange(self.pos.size(0), device=device) if targets is None else self.rank[targets]
+        n = rows.numel()
+        out = self.pos.new_zeros((n, 3))
+        theta2 = theta * theta
+        eps2 = eps * eps
+        for b0 in range(0, n, batch):
+            ti = torch.arange(b0, min(n, b0 + batch), device=device)
+            tn = torch.zeros_like(ti)
+            while ti.numel():
+                fc = self.first_child[tn]
+                leaf = fc < 0
+                d = self.com[tn] - self.pos[rows[ti]]
+                r2 = (d * d).sum(1) + eps2
+                accept = ~leaf & (self.size[tn] ** 2 < theta2 * r2)
+                if bool(accept.any()):
+                    f = G * self.mass[tn[accept]] * r2[accept].pow(-1.5)
+                    out.index_add_(0, ti[accept], d[accept] * f.unsqueeze(1))
+
+                li = ti[leaf]
+                ln = tn[leaf]
+                if li.numel():
+                    si = torch.repeat_interleave(li, self.end[ln] - self.start[ln])
+                    pj = _ranges(self.start[ln], self.end[ln])
+                    keep = rows[si] != pj
+                    si = si[keep]
+                    pj = pj[keep]
+                    dd = self.pos[pj] - self.pos[rows[si]]
+                    rr = (dd * dd).sum(1) + eps2
+                    f = G * self.pmass[pj] * torch.where(rr > 0, rr, torch.ones_like(rr)).pow(-1.5)
+                    out.index_add_(0, si, dd * (f * (rr > 0)).unsqueeze(1))
+
+                opened = ~leaf & ~accept
+                on = tn[opened]
+                k = self.n_children[on]
+                ti = torch.repeat_interleave(ti[opened], k)
+                tn = _ranges(fc[opened], fc[opened] + k)
+        return out[self.rank] if targets is None else out
+
+
+def step_bh(pos, vel, mass, dt, theta=0.5, G=1.0, eps=0.05, leaf_size=8, batch=8192):
+    tree = TensorOctree(pos, mass, leaf_size=leaf_size)
+    forces = tree.accelerations(theta, G, eps, batch=batch)
     vel += forces * dt
     pos += vel * dt
 
 
-def run(n_particles, iterations, dt, device=None, mode="direct", theta=0.5, eps=0.05):
+def run(n_particles, iterations, dt, device=None, mode="direct", theta=0.5, eps=0.05, leaf_size=8,
+        dtype=torch.float32, compute_dtype=None, memory_budget=None, resume=None, checkpoint=None,
+        model="spiral", seed=None, model_params=None):
+    """Integrate an N-body system and return the final ``(pos, vel)``.
+
+    ``dtype`` is the precision of the particle state, ``compute_dtype`` that
+    of the direct-summation kernel (e.g. float32 for a float64 state).
+    ``resume`` starts from a checkpoint file (also one written by
+    ``nbody.BarnesHutSimulation``) instead of a new galaxy; ``checkpoint``
+    writes the final state in the same format. New runs start from
+    ``model`` (see :mod:`initial_conditions`) with ``model_params``.
+    """
     device = device or ("cuda" if torch.cuda.is_available() else "cpu")
-    pos, vel, mass = generate_spiral_galaxy(n_particles, device=device)
+    step = 0
+    sim_time = 0.0
+    if resume:
+        state = read_checkpoint(resume)
+        pos, vel, mass = (torch.as_tensor(state[k], device=device).to(dtype) for k in ("pos", "vel", "mass"))
+        step = int(state["step"])
+        sim_time = float(state["time"])
+    else:
+        pos, vel, mass = generate_initial_conditions(model, n_particles, device=device, seed=seed, dtype=dtype,
+                                                     **(model_params or {}))
     for _ in range(iterations):
         if mode == "bh":
-            step_bh(pos, vel, mass, dt, theta=theta, eps=eps)
+            step_bh(pos, vel, mass, dt, theta=theta, eps=eps, leaf_size=leaf_size)
         else:
-            step_direct(pos, vel, mass, dt, eps=eps)
+            step_direct(pos, vel, mass, dt, eps=eps, compute_dtype=compute_dtype, memory_budget=memory_budget)
+        step += 1
+        sim_time += dt
+    if checkpoint:
+        params = {"dt": dt, "theta": theta, "eps": eps, "leaf_size": leaf_size,
+                  "mode": "bh" if mode == "bh" else "direct"}
+        arrays = (t.cpu().numpy() for t in (pos, vel, mass))
+        write_checkpoint(checkpoint, particle_state(*arrays, step, sim_time, params))
     return pos, vel
 
 
@@ -115,8 +337,27 @@ def main():
     parser.add_argument("--mode", choices=["direct", "bh"], default="direct", help="Force computation mode")
     parser.add_argument("--theta", type=float, default=0.5, help="Barnes-Hut opening angle")
     parser.add_argument("--eps", type=float, default=0.05, help="Softening parameter")
+    parser.add_argument("--leaf-size", type=int, default=8, help="Particles per Barnes-Hut leaf")
+    parser.add_argument("--dtype", choices=["float32", "float64"], default="float32",
+                        help="Precision of positions and velocities")
+    parser.add_argument("--compute-dtype", choices=["float32", "float64"], default=None,
+                        help="Precision of the direct-summation kernel (default: --dtype)")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="Memory per direct-summation tile in MB (default: from free memory)")
+    parser.add_argument("--model", choices=sorted(initial_conditions.MODELS), default="spiral",
+                        help="Initial conditions")
+    parser.add_argument("--model-param", action="append", metavar="KEY=VALUE",
+                        help="Model parameter, e.g. --model-param scale=0.3 (repeatable)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the initial conditions")
+    parser.add_argument("--resume", default=None, help="Start from this checkpoint file")
+    parser.add_argument("--checkpoint", default=None, help="Write the final state to this checkpoint file")
     args = parser.parse_args()
-    run(args.particles, args.iterations, args.dt, mode=args.mode, theta=args.theta, eps=args.eps)
+    budget = None if args.memory_budget is None else int(args.memory_budget * (1 << 20))
+    compute_dtype = getattr(torch, args.compute_dtype) if args.compute_dtype else None
+    run(args.particles, args.iterations, args.dt, mode=args.mode, theta=args.theta, eps=args.eps,
+        leaf_size=args.leaf_size, dtype=getattr(torch, args.dtype), compute_dtype=compute_dtype,
+        memory_budget=budget, resume=args.resume, checkpoint=args.checkpoint, model=args.model, seed=args.seed,
+        model_params=initial_conditions.parse_params(args.model_param))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+"""Vectorized, seedable initial conditions shared by all backends.
+
+Every model is a function ``model(rng, start, stop, n, **params)`` that
+returns ``(pos, vel, mass)`` arrays for particles ``start:stop`` of an
+``n``-body system. Particles are drawn independently of each other, so
+:func:`generate` fills the output arrays chunk by chunk and only ever holds
+temporaries for one chunk. Each chunk gets its own generator spawned from
+the seed, which makes the result depend only on the seed (and the chunk
+size), not on the global random state, and lets :func:`generate_range`
+draw any slice of the system on its own.
+
+Units follow the rest of the code: ``G = 1`` and, unless a model is given a
+``total_mass``, every particle has unit mass.
+"""
+
+import math
+import random
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+CHUNK_SIZE = 1 << 16
+
+Arrays = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def _unit_vectors(rng: np.random.Generator, n: int) -> np.ndarray:
+    cos_t = rng.uniform(-1.0, 1.0, n)
+    phi = rng.uniform(0.0, 2.0 * math.pi, n)
+    sin_t = np.sqrt(1.0 - cos_t * cos_t)
+    return np.stack((sin_t * np.cos(phi), sin_t * np.sin(phi), cos_t), axis=1)
+
+
+def _particle_mass(n: int, count: int, total_mass: Optional[float]) -> np.ndarray:
+    return np.full(count, 1.0 if total_mass is None else total_mass / n)
+
+
+def spiral(rng: np.random.Generator, start: int, stop: int, n: int, radius: float = 1.0,
+           central_mass: Optional[float] = None) -> Arrays:
+    """Thin rotating disk with a two-armed spiral pattern.
+
+    The vectorized form of the original generator: orbital speeds assume a
+    central mass of ``n`` unless ``central_mass`` is given.
+    """
+    count = stop - start
+    central_mass = n if central_mass is None else central_mass
+    r = np.sqrt(rng.random(count)) * radius
+    angle = r * 4.0 + rng.uniform(-0.2, 0.2, count)
+    z = rng.normal(0.0, 0.05, count)
+    v_mag = np.sqrt(central_mass / (r + 0.01))
+    pos = np.stack((r * np.cos(angle), r * np.sin(angle), z), axis=1)
+    vel = np.stack((-v_mag * np.sin(angle), v_mag * np.cos(angle), rng.normal(0.0, 0.01, count)), axis=1)
+    return pos, vel, np.ones(count)
+
+
+def plummer(rng: np.random.Generator, start: int, stop: int, n: int, scale: float = 0.2,
+            total_mass: Optional[float] = None, max_radius: float = 10.0) -> Arrays:
+    """Plummer sphere in equilibrium (Aarseth, Henon & Wielen 1974).
+
+    Radii beyond ``max_radius`` scale lengths are redrawn.
+    """
+    count = stop - start
+    M = n if total_mass is None else total_mass
+    # Inverse of the cumulative mass profile, truncated at max_radius
+    x_max = max_radius / math.sqrt(1.0 + max_radius * max_radius)
+    m = rng.uniform(1e-10, x_max ** 3, count)
+    r = scale / np.sqrt(m ** (-2.0 / 3.0) - 1.0)
+    pos = r[:, np.newaxis] * _unit_vectors(rng, count)
+
+    # Speeds as a fraction q of the escape speed, by rejection from q^2 (1 - q^2)^3.5
+    q = np.empty(count)
+    todo = np.arange(count)
+    while len(todo):
+        trial = rng.random(len(todo))
+        accept = 0.1 * rng.random(len(todo)) < trial * trial * (1.0 - trial * trial) ** 3.5
+        q[todo[accept]] = trial[accept]
+        todo = todo[~accept]
+    v_esc = np.sqrt(2.0 * M / scale) * (1.0 + (r / scale) ** 2) ** -0.25
+    vel = (q * v_esc)[:, np.newaxis] * _unit_vectors(rng, count)
+    return pos, vel, _particle_mass(n, count, total_mass)
+
+
+def _disk_bulge_enclosed(r: np.ndarray, M: float, bulge_fraction: float, disk_scale: float,
+                         bulge_scale: float) -> np.ndarray:
+    """Mass inside radius ``r`` (disk treated as spherical for the rotation curve)."""
+    x = r / disk_scale
+    disk = (1.0 - bulge_fraction) * M * (1.0 - (1.0 + x) * np.exp(-x))
+    bulge = bulge_fraction * M * r * r / (r + bulge_scale) ** 2
+    return disk + bulge
+
+
+def disk(rng: np.random.Generator, start: int, stop: int, n: int, disk_scale: float = 0.3,
+         disk_height: float = 0.03, bulge_fraction: float = 0.2, bulge_scale: float = 0.05,
+         total_mass: Optional[float] = None, dispersion: float = 0.1, softening: float = 0.05) -> Arrays:
+    """Exponential disk with a Hernquist bulge.
+
+    Each particle belongs to the bulge with probability ``bulge_fraction``.
+    Disk particles have an exponential surface density with scale length
+    ``disk_scale``, a sech² vertical profile of height ``disk_height`` and
+    move on circular orbits of the combined rotation curve plus a random
+    velocity of ``dispersion`` times the circular speed. Bulge particles have
+    isotropic velocities from the Jeans estimate ``sigma² = G M(<r) / 3 r``.
+    """
+    count = stop - start
+    M = n if total_mass is None else total_mass
+    in_bulge = rng.random(count) < bulge_fraction
+    pos = np.empty((count, 3))
+    vel = np.empty((count, 3))
+
+    d = np.flatnonzero(~in_bulge)
+    R = rng.gamma(2.0, disk_scale, len(d))
+    phi = rng.uniform(0.0, 2.0 * math.pi, len(d))
+    z = disk_height * np.arctanh(rng.uniform(-0.999, 0.999, len(d)))
+    v_c = np.sqrt(_disk_bulge_enclosed(R, M, bulge_fraction, disk_scale, bulge_scale)
+                  * R / (R * R + softening * softening))
+    pos[d] = np.stack((R * np.cos(phi), R * np.sin(phi), z), axis=1)
+    vel[d] = np.stack((-v_c * np.sin(phi), v_c * np.cos(phi), np.zeros(len(d))), axis=1)
+    vel[d] += rng.normal(0.0, 1.0, (len(d), 3)) * (dispersion * v_c)[:, np.newaxis]
+
+    b = np.flatnonzero(in_bulge)
+    u = np.sqrt(rng.uniform(0.0, 0.99, len(b)))
+    r = bulge_scale * u / (1.0 - u)
+    pos[b] = r[:, np.newaxis] * _unit_vectors(rng, len(b))
+    sigma = np.sqrt(_disk_bulge_enclosed(r, M, bulge_fraction, disk_scale, bulge_scale)
+                    * r / (3.0 * (r * r + softening * softening)))
+    vel[b] = rng.normal(0.0, 1.0, (len(b), 3)) * sigma[:, np.newaxis]
+    return pos, vel, _particle_mass(n, count, total_mass)
+
+
+def _rotation(inclination: float) -> np.ndarray:
+    c, s = math.cos(inclination), math.sin(inclination)
+    return np.array([[1.0, 0.0, 0.0], [0.0, c, -s], [0.0, s, c]])
+
+
+def collision(rng: np.random.Generator, start: int, stop: int, n: int, separation: float = 4.0,
+              impact: float = 1.0, mass_ratio: float = 1.0, inclination: float = 0.6,
+              approach: float = 1.0, total_mass: Optional[float] = None, **galaxy) -> Arrays:
+    """Two disk galaxies on an approaching orbit.
+
+    The first ``n / (1 + mass_ratio)`` particles form the primary at the
+    origin; the rest form a companion tilted by ``inclination`` radians,
+    placed ``separation`` away with impact parameter ``impact`` and moving
+    towards the primary at ``approach`` times the parabolic speed. Other
+    keyword arguments are passed to :func:`disk` for both galaxies.
+    """
+    M = n if total_mass is None else total_mass
+    n1 = int(round(n / (1.0 + mass_ratio)))
+    pos = np.empty((stop - start, 3))
+    vel = np.empty((stop - start, 3))
+    mass = np.empty(stop - start)
+
+    lo, hi = start, min(stop, n1)
+    if hi > lo:
+        p, v, m = disk(rng, lo, hi, n1, total_mass=M * n1 / n, **galaxy)
+        pos[:hi - lo], vel[:hi - lo], mass[:hi - lo] = p, v, m
+    lo, hi = max(start, n1), stop
+    if hi > lo:
+        n2 = n - n1
+        p, v, m = disk(rng, lo - n1, hi - n1, n2, total_mass=M * n2 / n, **galaxy)
+        rot = _rotation(inclination)
+        speed = approach * math.sqrt(2.0 * M / math.hypot(separation, impact))
+        pos[lo - start:] = p @ rot.T + (separation, impact, 0.0)
+        vel[lo - start:] = v @ rot.T + (-speed, 0.0, 0.0)
+        mass[lo - start:] = m
+    return pos, vel, mass
+
+
+MODELS: Dict[str, Callable[..., Arrays]] = {
+    "spiral": spiral,
+    "plummer": plummer,
+    "disk": disk,
+    "collision": collision,
+}
+
+
+def generate_range(model: str, n: int, start: int, stop: int, seed: int, chunk_size: int = CHUNK_SIZE,
+                   dtype=np.float64, **params) -> Arrays:
+    """Particles ``start:stop`` of the ``n``-body system :func:`generate` draws with ``seed``.
+
+    Only the chunks overlapping the range are drawn, so each process of a
+    distributed run can create just its own share. Nothing is recentered.
+    """
+    if model not in MODELS:
+        raise ValueError("unknown model %r (choose from %s)" % (model, ", ".join(MODELS)))
+    fn = MODELS[model]
+    pos = np.empty((stop - start, 3), dtype=dtype)
+    vel = np.empty((stop - start, 3), dtype=dtype)
+    mass = np.empty(stop - start, dtype=dtype)
+    children = np.random.SeedSequence(seed).spawn(len(range(0, n, chunk_size)))
+    for chunk in range(start // chunk_size, -(-stop // chunk_size)):
+        lo, hi = chunk * chunk_size, min(n, (chunk + 1) * chunk_size)
+        p, v, m = fn(np.random.default_rng(children[chunk]), lo, hi, n, **params)
+        # Chunks at the ends of the range are drawn whole and then cut
+        a, b = max(lo, start), min(hi, stop)
+        pos[a - start:b - start], vel[a - start:b - start], mass[a - start:b - start] = (
+            p[a - lo:b - lo], v[a - lo:b - lo], m[a - lo:b - lo])
+    return pos, vel, mass
+
+
+def generate(model: str, n: int, seed: Optional[int] = None, chunk_size: int = CHUNK_SIZE,
+             dtype=np.float64, recenter: bool = True, **params) -> Arrays:
+    """Positions, velocities and masses of ``n`` particles drawn from ``model``.
+
+    Without a ``seed`` one is taken from the global ``random`` module, so
+    ``random.seed`` still makes runs reproducible. With ``recenter`` the
+    center of mass is moved to rest at the origin.
+    """
+    if seed is None:
+        seed = random.getrandbits(63)
+    pos, vel, mass = generate_range(model, n, 0, n, seed, chunk_size, dtype, **params)
+    if recenter and n:
+        total = mass.sum(dtype=np.float64)
+        pos -= (mass @ pos) / total
+        vel -= (mass @ vel) / total
+    return pos, vel, mass
+
+
+def parse_params(items) -> Dict[str, float]:
+    """Turn ``["key=value", ...]`` command line items into model keyword arguments."""
+    params = {}
+    for item in items or ():
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError("model parameters must look like key=value, got %r" % item)
+        params[key.strip().replace("-", "_")] = float(value)
+    return params
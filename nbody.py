@@ -1,254 +1,516 @@
-import math
-import random
-from dataclasses import dataclass
-from typing import Iterable, List, Optional, Tuple
+import argparse
+import inspect
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 import time
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+
+import numpy as np
+
+from backends import BACKENDS, OctreeNode, make_backend  # noqa: F401
+from checkpoint import params_of, particle_state, read_checkpoint, rng_state, set_rng_state, write_checkpoint
+from initial_conditions import MODELS, generate, parse_params
+from octree import LinearOctree, bounding_cube, interaction_kernel
+from parallel import ProcessForcePool
+from particles import Particle, ParticleSet, ParticleView, as_particle_set  # noqa: F401
+from profiling import Profiler
+from spatial import SpatialIndex
+from streaming import FrameStream, Subscription
+
+# Upper bound on the number of pairwise terms evaluated at once by the
+# blocked direct-summation kernels.
+PAIR_BLOCK = 1 << 20
+
+# Constructor arguments stored in checkpoints
+CHECKPOINT_PARAMS = ("dt", "theta", "eps", "mode", "integrator", "leaf_size", "group_size",
+                     "diagnostics_every", "timestep_levels", "eta", "refit_tolerance", "quadrupole")
+
+
+def generate_spiral_galaxy(num: int, radius: float = 1.0, seed: Optional[int] = None) -> List[Particle]:
+    """Spiral galaxy as a list of particles (see :func:`initial_conditions.spiral`)."""
+    pos, vel, mass = generate("spiral", num, seed=seed, recenter=False, radius=radius)
+    return ParticleSet(pos, vel, mass).to_particles()
+
+
+def _row_blocks(n: int, columns: Optional[int] = None):
+    block = max(1, PAIR_BLOCK // max(n if columns is None else columns, 1))
+    for start in range(0, n, block):
+        yield start, min(n, start + block)
+
+
+def direct_accelerations(pos: np.ndarray, mass: np.ndarray, G: float = 1.0, eps: float = 0.05,
+                         targets: Optional[np.ndarray] = None) -> np.ndarray:
+    """Exact pairwise accelerations, evaluated in row blocks of bounded size.
+
+    ``targets`` optionally restricts the evaluation to a subset of indices.
+    """
+    target_pos = pos if targets is None else pos[targets]
+    acc = np.empty_like(target_pos)
+    for start, stop in _row_blocks(len(target_pos), len(pos)):
+        acc[start:stop] = interaction_kernel(target_pos[start:stop], pos, mass, G, eps)
+    return acc
+
+
+def _takes_step(add_frame) -> bool:
+    """Whether a recorder's ``add_frame`` accepts ``step`` and ``time``; older ones take the particles only."""
+    try:
+        params = inspect.signature(add_frame).parameters
+    except (TypeError, ValueError):
+        return False
+    if any(param.kind == param.VAR_KEYWORD for param in params.values()):
+        return True
+    return "step" in params and "time" in params
+
+
+# Above this many particles run() estimates potential energy with the tree
+# instead of exact pairwise summation.
+EXACT_ENERGY_LIMIT = 5000
+
+# Relative padding of the root cube when the tree is rebuilt, so particles
+# drifting outwards stay inside it for a while and the tree can be refit.
+ROOT_MARGIN = 0.1
 
 
 @dataclass
-class Particle:
-    x: float
-    y: float
-    z: float
-    vx: float
-    vy: float
-    vz: float
-    mass: float = 1.0
-
-
-class OctreeNode:
-    MIN_SIZE = 1e-5
-
-    def __init__(self, center: Tuple[float, float, float], half_size: float):
-        self.center = list(center)
-        self.half_size = half_size
-        self.particle: Optional[Particle] = None
-        self.children: List[Optional["OctreeNode"]] = [None] * 8
-        self.mass = 0.0
-        self.com = [0.0, 0.0, 0.0]
-
-    def _is_leaf(self) -> bool:
-        return all(child is None for child in self.children)
-
-    def _subdivide(self):
-        quarter = self.half_size / 2.0
-        for i in range(8):
-            offset = (
-                quarter if i & 1 else -quarter,
-                quarter if i & 2 else -quarter,
-                quarter if i & 4 else -quarter,
-            )
-            new_center = (
-                self.center[0] + offset[0],
-                self.center[1] + offset[1],
-                self.center[2] + offset[2],
-            )
-            self.children[i] = OctreeNode(new_center, quarter)
-
-    def _child_index(self, p: Particle) -> int:
-        idx = 0
-        if p.x > self.center[0]:
-            idx |= 1
-        if p.y > self.center[1]:
-            idx |= 2
-        if p.z > self.center[2]:
-            idx |= 4
-        return idx
-
-    def insert(self, p: Particle):
-        if self._is_leaf():
-            if self.particle is None:
-                self.particle = p
-                self.mass = p.mass
-                self.com = [p.x, p.y, p.z]
-                return
-            elif self.half_size < self.MIN_SIZE:
-                # Avoid infinite subdivision when particles overlap closely
-                self.mass += p.mass
-                self.com[0] += p.mass * p.x
-                self.com[1] += p.mass * p.y
-                self.com[2] += p.mass * p.z
-                return
-            else:
-                self._subdivide()
-                existing = self.particle
-                self.particle = None
-                self.children[self._child_index(existing)].insert(existing)
-        self.children[self._child_index(p)].insert(p)
-        # Update center of mass and mass
-        self.mass += p.mass
-        self.com[0] += p.mass * p.x
-        self.com[1] += p.mass * p.y
-        self.com[2] += p.mass * p.z
-
-    def finalize(self):
-        if self.mass > 0:
-            self.com[0] /= self.mass
-            self.com[1] /= self.mass
-            self.com[2] /= self.mass
-        if not self._is_leaf():
-            for child in self.children:
-                if child:
-                    child.finalize()
-
-    def compute_force_on(
-        self, p: Particle, theta: float = 0.5, G: float = 1.0, eps: float = 0.05
-    ) -> Tuple[float, float, float]:
-        if self.mass == 0 or (self.particle is p and self._is_leaf()):
-            return 0.0, 0.0, 0.0
-        dx = self.com[0] - p.x
-        dy = self.com[1] - p.y
-        dz = self.com[2] - p.z
-        dist = math.sqrt(dx * dx + dy * dy + dz * dz + eps * eps)
-        if self._is_leaf() or self.half_size / dist < theta:
-            factor = G * self.mass / (dist ** 3)
-            return dx * factor, dy * factor, dz * factor
-        fx = fy = fz = 0.0
-        for child in self.children:
-            if child:
-                cfx, cfy, cfz = child.compute_force_on(p, theta, G, eps)
-                fx += cfx
-                fy += cfy
-                fz += cfz
-        return fx, fy, fz
-
-
-def generate_spiral_galaxy(num: int, radius: float = 1.0) -> List[Particle]:
-    particles: List[Particle] = []
-    central_mass = num
-    G = 1.0
-    for _ in range(num):
-        r = math.sqrt(random.random()) * radius
-        angle = r * 4.0 + random.uniform(-0.2, 0.2)
-        x = r * math.cos(angle)
-        y = r * math.sin(angle)
-        z = random.gauss(0, 0.05)
-        v_mag = math.sqrt(G * central_mass / (r + 0.01))
-        vx = -v_mag * math.sin(angle)
-        vy = v_mag * math.cos(angle)
-        vz = random.gauss(0, 0.01)
-        particles.append(Particle(x, y, z, vx, vy, vz))
-    return particles
-
-
-def compute_total_momentum(particles: Iterable[Particle]):
-    px = sum(p.mass * p.vx for p in particles)
-    py = sum(p.mass * p.vy for p in particles)
-    pz = sum(p.mass * p.vz for p in particles)
+class DiagnosticsRecord:
+    step: int
+    time: float
+    kinetic: float
+    potential: float
+    momentum: Tuple[float, float, float]
+    angular_momentum: Tuple[float, float, float]
+
+    @property
+    def energy(self) -> float:
+        return self.kinetic + self.potential
+
+
+def compute_total_momentum(particles: Union[ParticleSet, Iterable[Particle]]):
+    ps = as_particle_set(particles)
+    px, py, pz = (ps.mass[:, np.newaxis] * ps.vel).sum(axis=0).tolist()
     return px, py, pz
 
 
-def compute_total_energy(particles: Iterable[Particle], G: float = 1.0, eps: float = 0.05):
-    KE = sum(0.5 * p.mass * (p.vx ** 2 + p.vy ** 2 + p.vz ** 2) for p in particles)
+def compute_total_angular_momentum(particles: Union[ParticleSet, Iterable[Particle]]):
+    ps = as_particle_set(particles)
+    lx, ly, lz = (ps.mass[:, np.newaxis] * np.cross(ps.pos, ps.vel)).sum(axis=0).tolist()
+    return lx, ly, lz
+
+
+def compute_kinetic_energy(particles: Union[ParticleSet, Iterable[Particle]]) -> float:
+    ps = as_particle_set(particles)
+    return 0.5 * float(np.dot(ps.mass, np.einsum("ij,ij->i", ps.vel, ps.vel)))
+
+
+def compute_potential_energy(particles: Union[ParticleSet, Iterable[Particle]], G: float = 1.0,
+                             eps: float = 0.05, method: str = "exact", theta: float = 0.5,
+                             tree: Optional[LinearOctree] = None) -> float:
+    """Total potential energy.
+
+    ``method="exact"`` sums all pairs in vectorized row blocks.
+    ``method="tree"`` estimates each particle's potential with a Barnes-Hut
+    walk of ``tree`` (built on demand if not given) in O(N log N).
+    """
+    ps = as_particle_set(particles)
+    pos, mass = ps.pos, ps.mass
+    if method == "tree":
+        if tree is None:
+            tree = LinearOctree(pos, mass)
+        return 0.5 * float(np.dot(mass, tree.potentials(theta, G, eps)))
+    if method != "exact":
+        raise ValueError("unknown energy method %r" % method)
     PE = 0.0
-    plist = list(particles)
-    for i in range(len(plist)):
-        for j in range(i + 1, len(plist)):
-            dx = plist[i].x - plist[j].x
-            dy = plist[i].y - plist[j].y
-            dz = plist[i].z - plist[j].z
-            r = math.sqrt(dx * dx + dy * dy + dz * dz + eps * eps)
-            PE -= G * plist[i].mass * plist[j].mass / r
-    return KE + PE
+    for start, stop in _row_blocks(len(pos)):
+        diff = pos[start:stop, np.newaxis, :] - pos[np.newaxis, start:, :]
+        r = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff) + eps * eps)
+        # Only count each pair once: column j > row i
+        upper = np.arange(start, len(pos))[np.newaxis, :] > np.arange(start, stop)[:, np.newaxis]
+        with np.errstate(divide="ignore"):
+            inv_r = np.where(upper, 1.0 / r, 0.0)
+        PE -= G * float(mass[start:stop] @ inv_r @ mass[start:])
+    return PE
+
+
+def compute_total_energy(particles: Union[ParticleSet, Iterable[Particle]], G: float = 1.0, eps: float = 0.05,
+                         method: str = "exact", theta: float = 0.5, tree: Optional[LinearOctree] = None):
+    ps = as_particle_set(particles)
+    return compute_kinetic_energy(ps) + compute_potential_energy(ps, G, eps, method, theta, tree)
 
 
 class BarnesHutSimulation:
     def __init__(self, num_particles: int = 100, dt: float = 0.01, theta: float = 0.5,
-                 eps: float = 0.05, mode: str = "bh", integrator: str = "euler", recorder=None):
+                 eps: float = 0.05, mode: str = "bh", integrator: str = "euler", recorder=None,
+                 leaf_size: int = 8, group_size: int = 32, workers: int = 1,
+                 diagnostics_every: int = 0, timestep_levels: int = 0, eta: float = 0.2,
+                 refit_tolerance: float = 0.05, profiler: Optional[Profiler] = None,
+                 checkpointer=None, model: str = "spiral", seed: Optional[int] = None,
+                 model_params: Optional[Dict[str, float]] = None, quadrupole: bool = False,
+                 tuner=None, backend="numpy"):
         self.dt = dt
         self.theta = theta
         self.eps = eps
+        self.leaf_size = leaf_size
+        self.group_size = group_size
+        # Quadrupole moments in the tree nodes (see octree.LinearOctree)
+        self.quadrupole = quadrupole
         self.mode = mode
         self.integrator = integrator
-        self.particles = generate_spiral_galaxy(num_particles)
+        if timestep_levels and integrator != "leapfrog":
+            raise ValueError("block time steps require the leapfrog integrator")
+        # Hierarchical time steps: particle i advances with dt / 2**levels[i]
+        # where levels are chosen from eta * sqrt(eps / |a|)
+        self.timestep_levels = timestep_levels
+        self.eta = eta
+        self.levels: Optional[np.ndarray] = None
+        # Accelerations at the current positions, carried between leapfrog steps
+        self.accelerations: Optional[np.ndarray] = None
+        # Particle storage and force engine, see backends.BACKENDS; other
+        # backends keep accelerations in their own array type
+        self.backend = make_backend(backend)
+        if self.backend.name != "numpy" and (quadrupole or workers > 1):
+            raise ValueError("quadrupole moments and force workers require the numpy backend")
+        if mode not in self.backend.modes:
+            raise ValueError("the %s backend does not support mode %r" % (self.backend.name, mode))
+        # Initial conditions from initial_conditions.MODELS; without a seed
+        # the global ``random`` state decides, as before
+        self.particles = ParticleSet(*generate(model, num_particles, seed=seed, **(model_params or {})))
         self.recorder = recorder
+        self.step_count = 0
+        self.time = 0.0
+        # Conservation time series, recorded every ``diagnostics_every`` steps
+        self.diagnostics_every = diagnostics_every
+        self.diagnostics: List[DiagnosticsRecord] = []
+        # The tree persists between steps and is refit until particles leave
+        # the root cube or node sizes grow by more than ``refit_tolerance``
+        self.refit_tolerance = refit_tolerance
+        self.tree: Optional[LinearOctree] = None
+        self._tree_current = False
+        # Opt-in process pool; kept alive for the whole simulation
+        self.force_pool = ProcessForcePool(workers) if workers > 1 else None
+        # Opt-in per-step timers and counters, see profiling.Profiler
+        self.profiler = profiler
+        # Optional checkpoint.Checkpointer, consulted after every step
+        self.checkpointer = checkpointer
+        # Optional tuning.AutoTuner, adjusting theta and leaf_size before steps
+        self.tuner = tuner
+
+    def close(self):
+        close_recorder = getattr(self.recorder, "close", None)
+        if close_recorder is not None:
+            close_recorder()
+        if self.force_pool is not None:
+            self.force_pool.close()
+            self.force_pool = None
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+            self.checkpointer = None
 
-    def _build_tree(self) -> OctreeNode:
-        root = OctreeNode((0.0, 0.0, 0.0), 2.0)
-        for p in self.particles:
-            root.insert(p)
-        root.finalize()
-        return root
+    def __enter__(self):
+        return self
 
-    def _direct_forces(self) -> List[Tuple[float, float, float]]:
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def particles(self) -> ParticleSet:
+        return self.backend.particles
+
+    @particles.setter
+    def particles(self, particles: Union[ParticleSet, Iterable[Particle]]):
+        self.backend.load(as_particle_set(particles))
+        self.accelerations = None
+        self.levels = None
+        self.tree = None
+        self._tree_current = False
+
+    def _phase(self, name: str):
+        return nullcontext() if self.profiler is None else self.profiler.phase(name)
+
+    def _build_tree(self) -> LinearOctree:
+        ps = self.particles
+        tree = self.tree
+        if (tree is not None and self.refit_tolerance > 0 and tree.num_particles == len(ps)
+                and tree.contains(ps.pos)):
+            tree.refit(ps.pos, ps.mass)
+            rebuild = tree.inflation > self.refit_tolerance
+        else:
+            rebuild = True
+        if rebuild:
+            center, half_size = bounding_cube(ps.pos)
+            self.tree = LinearOctree(ps.pos, ps.mass, leaf_size=self.leaf_size,
+                                     center=center, half_size=half_size * (1.0 + ROOT_MARGIN),
+                                     quadrupole=self.quadrupole)
+            if self.profiler is not None:
+                self.profiler.tree_built(self.tree)
+        self._tree_current = True
+        return self.tree
+
+    def _direct_forces(self, targets: Optional[np.ndarray] = None) -> np.ndarray:
         n = len(self.particles)
-        forces = [(0.0, 0.0, 0.0)] * n
-        G = 1.0
-        for i in range(n):
-            fx, fy, fz = 0.0, 0.0, 0.0
-            for j in range(i + 1, n):
-                pi = self.particles[i]
-                pj = self.particles[j]
-                dx = pj.x - pi.x
-                dy = pj.y - pi.y
-                dz = pj.z - pi.z
-                r = math.sqrt(dx * dx + dy * dy + dz * dz + self.eps * self.eps)
-                f = G / (r ** 3)
-                fx_ij = dx * f
-                fy_ij = dy * f
-                fz_ij = dz * f
-                fx += fx_ij * pj.mass
-                fy += fy_ij * pj.mass
-                fz += fz_ij * pj.mass
-                forces[j] = (
-                    forces[j][0] - fx_ij * pi.mass,
-                    forces[j][1] - fy_ij * pi.mass,
-                    forces[j][2] - fz_ij * pi.mass,
-                )
-            forces[i] = (fx, fy, fz)
-        return forces
+        if self.profiler is not None:
+            rows = n if targets is None else len(targets)
+            counts = self.profiler.counts
+            counts["particle_particle"] = counts.get("particle_particle", 0) + rows * (n - 1)
+        return direct_accelerations(self.particles.pos, self.particles.mass, eps=self.eps, targets=targets)
+
+    def _compute_forces(self, targets: Optional[np.ndarray] = None):
+        return self.backend.accelerations(self, targets)
+
+    def _timestep_level(self, acc: np.ndarray) -> np.ndarray:
+        amag = np.sqrt(np.einsum("ij,ij->i", acc, acc))
+        with np.errstate(divide="ignore"):
+            wanted = self.eta * np.sqrt(self.eps / amag)
+            level = np.ceil(np.log2(self.dt / wanted))
+        return np.clip(np.nan_to_num(level, nan=0.0), 0, self.timestep_levels).astype(np.int64)
+
+    def _block_step(self):
+        """Kick-drift-kick over one ``dt`` with power-of-two substeps.
+
+        All particles drift every substep; a particle on level ``k`` is
+        kicked (and needs new forces) only every ``2**(L-k)`` substeps. At the
+        end of its step a particle may move to a finer level at once and to a
+        coarser one only where that level's steps are synchronized.
+        Substeps ending with no particle to kick are merged into the next
+        one, so they cost neither a drift nor a force evaluation.
+        """
+        backend = self.backend
+        acc = self.accelerations
+        if self.levels is None:
+            self.levels = self._timestep_level(backend.to_host(acc))
+        nsub = 1 << self.timestep_levels
+        dt_sub = self.dt / nsub
+        pending = 0.0
+        for s in range(nsub):
+            period = nsub >> self.levels
+            starting = np.flatnonzero(s % period == 0)
+            if len(starting):
+                backend.kick(acc, 0.5 * self.dt / (1 << self.levels[starting]), starting)
+            pending += dt_sub
+            active = np.flatnonzero((s + 1) % period == 0)
+            if not len(active):
+                # Nobody starts a step at the next substep either, so no kick
+                # comes between this drift and the next one. The last
+                # substep always has every particle active.
+                continue
+            backend.drift(pending)
+            pending = 0.0
+            self._tree_current = False
+            forces = self._compute_forces(active)
+            backend.set_rows(acc, active, forces)
+            backend.kick(acc, 0.5 * self.dt / (1 << self.levels[active]), active)
+            # Coarsest level whose steps end together with this substep
+            synced = self.timestep_levels - int((s + 1) & -(s + 1)).bit_length() + 1
+            self.levels[active] = np.maximum(self._timestep_level(backend.to_host(forces)), max(synced, 0))
 
     def step(self):
-        if self.mode == "direct":
-            forces = self._direct_forces()
-        else:
-            tree = self._build_tree()
-            with ThreadPoolExecutor() as ex:
-                forces = list(ex.map(lambda p: tree.compute_force_on(p, self.theta, eps=self.eps), self.particles))
+        backend = self.backend
+        if self.profiler is not None:
+            self.profiler.start_step()
+        if self.tuner is not None:
+            with self._phase("tune"):
+                self.tuner.maybe_tune(self)
 
         if self.integrator == "leapfrog":
-            for (p, (ax, ay, az)) in zip(self.particles, forces):
-                p.vx += ax * self.dt * 0.5
-                p.vy += ay * self.dt * 0.5
-                p.vz += az * self.dt * 0.5
-                p.x += p.vx * self.dt
-                p.y += p.vy * self.dt
-                p.z += p.vz * self.dt
-            if self.mode == "direct":
-                forces = self._direct_forces()
+            if self.accelerations is None:
+                self.accelerations = self._compute_forces()
+            if self.timestep_levels:
+                self._block_step()
             else:
-                tree = self._build_tree()
-                with ThreadPoolExecutor() as ex:
-                    forces = list(ex.map(lambda p: tree.compute_force_on(p, self.theta, eps=self.eps), self.particles))
-            for (p, (ax, ay, az)) in zip(self.particles, forces):
-                p.vx += ax * self.dt * 0.5
-                p.vy += ay * self.dt * 0.5
-                p.vz += az * self.dt * 0.5
+                backend.kick(self.accelerations, self.dt * 0.5)
+                backend.drift(self.dt)
+                self._tree_current = False
+                self.accelerations = self._compute_forces()
+                backend.kick(self.accelerations, self.dt * 0.5)
         else:  # euler
-            for (p, (ax, ay, az)) in zip(self.particles, forces):
-                p.vx += ax * self.dt
-                p.vy += ay * self.dt
-                p.vz += az * self.dt
-                p.x += p.vx * self.dt
-                p.y += p.vy * self.dt
-                p.z += p.vz * self.dt
+            forces = self._compute_forces()
+            backend.kick(forces, self.dt)
+            backend.drift(self.dt)
+            self._tree_current = False
+        self.step_count += 1
+        self.time += self.dt
 
+        # Reading self.particles copies device backends to the host, so only
+        # do it when a recorder needs the frame
         if self.recorder is not None:
-            self.recorder.add_frame(self.particles)
+            with self._phase("record"):
+                if _takes_step(self.recorder.add_frame):
+                    self.recorder.add_frame(self.particles, step=self.step_count, time=self.time)
+                else:
+                    self.recorder.add_frame(self.particles)
+        if self.diagnostics_every and self.step_count % self.diagnostics_every == 0:
+            with self._phase("diagnostics"):
+                self.record_diagnostics()
+        if self.checkpointer is not None:
+            with self._phase("checkpoint"):
+                self.checkpointer.maybe_save(self)
+        if self.profiler is not None:
+            tree = self.tree if self.mode != "direct" and backend.name == "numpy" else None
+            self.profiler.end_step(self.step_count, self.time, len(backend), tree)
+
+    def checkpoint_state(self) -> Dict[str, np.ndarray]:
+        """Copy of everything needed to continue this run exactly.
+
+        Besides the particles this includes the carried accelerations and
+        time-step levels, the persistent tree (whose refit history affects
+        later forces), the diagnostics series and the random generator state.
+        """
+        ps = self.particles
+        params = {key: getattr(self, key) for key in CHECKPOINT_PARAMS}
+        state = particle_state(ps.pos, ps.vel, ps.mass, self.step_count, self.time, params)
+        state.update(rng_state())
+        if self.accelerations is not None:
+            state["accelerations"] = np.array(self.backend.to_host(self.accelerations))
+        if self.levels is not None:
+            state["levels"] = self.levels.copy()
+        if self.tree is not None:
+            for key, value in vars(self.tree).items():
+                if value is not None:
+                    state["tree/" + key] = np.array(value)
+            state["tree_current"] = np.asarray(self._tree_current)
+        if self.tuner is not None and self.tuner.last_step is not None:
+            state["tuner_step"] = np.asarray(self.tuner.last_step)
+        if self.diagnostics:
+            state["diagnostics"] = np.array([(d.step, d.time, d.kinetic, d.potential) + tuple(d.momentum)
+                                             + tuple(d.angular_momentum) for d in self.diagnostics])
+        return state
+
+    def save_checkpoint(self, path: str):
+        """Write a checkpoint synchronously (see :mod:`checkpoint`)."""
+        write_checkpoint(path, self.checkpoint_state())
+
+    @classmethod
+    def from_checkpoint(cls, path: str, **kwargs) -> "BarnesHutSimulation":
+        """Resume a simulation from a checkpoint file.
+
+        Stored parameters are used unless overridden in ``kwargs``, which also
+        takes the runtime-only arguments (``recorder``, ``workers``,
+        ``profiler``, ``checkpointer``, ``tuner``, ``backend``). Files without integrator state, e.g.
+        written by ``gpu_sim``, start with freshly computed forces.
+        """
+        state = read_checkpoint(path)
+        params = {k: v for k, v in params_of(state).items() if k in CHECKPOINT_PARAMS}
+        params.update(kwargs)
+        sim = cls(num_particles=0, **params)
+        sim.particles = ParticleSet(state["pos"], state["vel"], state["mass"])
+        sim.step_count = int(state["step"])
+        sim.time = float(state["time"])
+        if "accelerations" in state:
+            sim.accelerations = sim.backend.from_host(state["accelerations"])
+        if "levels" in state:
+            sim.levels = state["levels"]
+        tree_state = {k[5:]: v for k, v in state.items() if k.startswith("tree/")}
+        if tree_state:
+            sim.tree = LinearOctree.from_arrays({k: v.item() if v.ndim == 0 else v for k, v in tree_state.items()})
+            sim._tree_current = bool(state["tree_current"])
+        if sim.tuner is not None and "tuner_step" in state:
+            sim.tuner.last_step = int(state["tuner_step"])
+        for row in state.get("diagnostics", ()):
+            values = row.tolist()
+            sim.diagnostics.append(DiagnosticsRecord(int(values[0]), values[1], values[2], values[3],
+                                                     tuple(values[4:7]), tuple(values[7:10])))
+        set_rng_state(state)
+        return sim
+
+    def potential_energy(self, method: Optional[str] = None) -> float:
+        """Potential energy of the current state.
+
+        By default small systems are summed exactly and larger ones use the
+        tree estimate, reusing the tree from the last force evaluation when it
+        still matches the particle positions.
+        """
+        if method is None:
+            method = "exact" if len(self.particles) <= EXACT_ENERGY_LIMIT else "tree"
+        tree = None
+        if method == "tree":
+            tree = self.tree if self._tree_current else self._build_tree()
+        return compute_potential_energy(self.particles, eps=self.eps, method=method, theta=self.theta, tree=tree)
+
+    def spatial_index(self) -> SpatialIndex:
+        """Neighbor queries over the current particles (see :mod:`spatial`).
+
+        Wraps the tree of the last force evaluation when it still matches the
+        particle positions, so querying after a step costs no rebuild.
+        """
+        return SpatialIndex(self.tree if self._tree_current else self._build_tree())
+
+    def densities(self, k: int = 32) -> np.ndarray:
+        """Local mass density of every particle from its ``k`` nearest neighbors."""
+        return self.spatial_index().density(k)
+
+    def record_diagnostics(self, method: Optional[str] = None) -> DiagnosticsRecord:
+        record = DiagnosticsRecord(
+            step=self.step_count,
+            time=self.time,
+            kinetic=compute_kinetic_energy(self.particles),
+            potential=self.potential_energy(method),
+            momentum=compute_total_momentum(self.particles),
+            angular_momentum=compute_total_angular_momentum(self.particles),
+        )
+        self.diagnostics.append(record)
+        return record
+
+    def stream(self, iterations: Optional[int] = None, stride: int = 1, maxsize: int = 8,
+               policy: str = "block") -> Subscription:
+        """Step on a background thread and iterate over snapshots of the particles.
+
+        Returns a single :class:`streaming.Subscription`, usable with ``for``
+        and ``async for``; closing it stops the run. Use
+        :class:`streaming.FrameStream` directly for several consumers.
+        """
+        producer = FrameStream(self, iterations)
+        sub = producer.subscribe(stride, maxsize, policy)
+        producer.start()
+        return sub
 
     def run(self, iterations: int):
         start_mom = compute_total_momentum(self.particles)
-        start_energy = compute_total_energy(self.particles, eps=self.eps)
+        start_energy = compute_kinetic_energy(self.particles) + self.potential_energy()
         t0 = time.time()
         for _ in range(iterations):
             self.step()
         elapsed = time.time() - t0
         end_mom = compute_total_momentum(self.particles)
-        end_energy = compute_total_energy(self.particles, eps=self.eps)
+        end_energy = compute_kinetic_energy(self.particles) + self.potential_energy()
         print("Momentum:", start_mom, "->", end_mom)
         if sum(abs(m) for m in start_mom) > 0:
             delta = [abs(e - s) / abs(s) for s, e in zip(start_mom, end_mom)]
             print("Relative change:", delta)
         print("Energy drift:", end_energy - start_energy)
         print("Simulation time: %.2f s" % elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Barnes-Hut N-body simulation")
+    parser.add_argument("--particles", type=int, default=1000, help="Number of particles")
+    parser.add_argument("--iterations", type=int, default=100, help="Number of steps")
+    parser.add_argument("--dt", type=float, default=0.01, help="Time step")
+    parser.add_argument("--mode", choices=["bh", "group", "direct"], default="bh", help="Force computation mode")
+    parser.add_argument("--integrator", choices=["euler", "leapfrog"], default="leapfrog", help="Integrator")
+    parser.add_argument("--theta", type=float, default=0.5, help="Barnes-Hut opening angle")
+    parser.add_argument("--eps", type=float, default=0.05, help="Softening parameter")
+    parser.add_argument("--quadrupole", action="store_true", help="Use quadrupole moments in the tree")
+    parser.add_argument("--workers", type=int, default=1, help="Force worker processes")
+    parser.add_argument("--backend", choices=BACKENDS, default="numpy", help="Particle storage and force engine")
+    parser.add_argument("--target-error", type=float, default=None,
+                        help="Tune theta so the 90th percentile force error stays below this")
+    parser.add_argument("--tune-every", type=int, default=100, help="Steps between tuning checks")
+    parser.add_argument("--model", choices=sorted(MODELS), default="spiral", help="Initial conditions")
+    parser.add_argument("--model-param", action="append", metavar="KEY=VALUE",
+                        help="Model parameter, e.g. --model-param separation=6 (repeatable)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the initial conditions")
+    args = parser.parse_args(argv)
+    tuner = None
+    if args.target_error is not None:
+        from tuning import AutoTuner
+
+        tuner = AutoTuner(target=args.target_error, every=args.tune_every)
+    with BarnesHutSimulation(num_particles=args.particles, dt=args.dt, theta=args.theta, eps=args.eps,
+                             mode=args.mode, integrator=args.integrator, workers=args.workers,
+                             model=args.model, seed=args.seed, quadrupole=args.quadrupole,
+                             tuner=tuner, backend=args.backend,
+                             model_params=parse_params(args.model_param)) as sim:
+        sim.run(args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+"""Flat, Morton-ordered octree for Barnes-Hut force evaluation.
+
+Particles are sorted by their 63-bit Morton key so that every node of the
+tree covers a contiguous range of the sorted particle arrays. The tree is
+built level by level with vectorized NumPy operations and stored as flat
+per-node arrays instead of an object graph:
+
+- ``start``/``end``: range of sorted particles covered by the node,
+- ``first_child``/``n_children``: children are stored contiguously, ``-1``
+  marks a leaf,
+- ``mass``, ``com`` and ``size`` (half width used by the opening test),
+- optionally ``quad``, the second mass moments of every node about its
+  center of mass, which add a quadrupole term to accepted nodes.
+
+A tree can persist across steps: :meth:`LinearOctree.refit` recomputes the
+node moments and bounds for moved particles without touching the structure,
+and :attr:`LinearOctree.inflation` measures how far the nodes have grown
+beyond their cells so the caller can decide when to rebuild.
+
+Leaves hold buckets of up to ``leaf_size`` particles which are summed
+directly during the walk.
+"""
+
+import math
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+MAX_LEVEL = 21  # 3 * 21 = 63 key bits
+
+_U = np.uint64
+
+# Keys of the optional interaction counters filled in by the tree walks
+WALK_COUNTERS = ("nodes_opened", "particle_node", "particle_particle")
+
+
+def _tally(counts: Optional[Dict[str, int]], opened: int, node_terms: int, pair_terms: int):
+    if counts is not None:
+        counts["nodes_opened"] = counts.get("nodes_opened", 0) + opened
+        counts["particle_node"] = counts.get("particle_node", 0) + node_terms
+        counts["particle_particle"] = counts.get("particle_particle", 0) + pair_terms
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    """Insert two zero bits between each of the low 21 bits of ``v``."""
+    v = v & _U(0x1FFFFF)
+    v = (v | (v << _U(32))) & _U(0x1F00000000FFFF)
+    v = (v | (v << _U(16))) & _U(0x1F0000FF0000FF)
+    v = (v | (v << _U(8))) & _U(0x100F00F00F00F00F)
+    v = (v | (v << _U(4))) & _U(0x10C30C30C30C30C3)
+    v = (v | (v << _U(2))) & _U(0x1249249249249249)
+    return v
+
+
+def _ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Concatenation of ``arange(s, e)`` for every pair of bounds."""
+    counts = ends - starts
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(int(counts.sum()))
+
+
+def bounding_cube(pos: np.ndarray):
+    """Smallest cube (center, half width) enclosing ``pos``."""
+    if len(pos) == 0:
+        return np.zeros(3), 1.0
+    lo = pos.min(axis=0)
+    hi = pos.max(axis=0)
+    center = 0.5 * (lo + hi)
+    half = 0.5 * float((hi - lo).max())
+    if half <= 0.0:
+        half = 1.0
+    # Pad slightly so particles on the upper faces quantize inside the cube
+    return center, half * (1.0 + 1e-9)
+
+
+def morton_keys(pos: np.ndarray, center: Sequence[float], half_size: float) -> np.ndarray:
+    """Morton keys of ``pos`` inside the cube ``center +/- half_size``.
+
+    Bit 0 of each 3-bit digit is x, bit 1 is y and bit 2 is z, matching the
+    child numbering of :class:`backends.OctreeNode`. Points outside the cube are
+    clamped to its faces.
+    """
+    scale = (1 << MAX_LEVEL) / (2.0 * half_size)
+    q = np.floor((pos - (np.asarray(center) - half_size)) * scale)
+    q = np.clip(q, 0, (1 << MAX_LEVEL) - 1).astype(np.uint64)
+    return _spread_bits(q[:, 0]) | (_spread_bits(q[:, 1]) << _U(1)) | (_spread_bits(q[:, 2]) << _U(2))
+
+
+def interaction_kernel(targets: np.ndarray, sources: np.ndarray, source_mass: np.ndarray,
+                       G: float = 1.0, eps: float = 0.05) -> np.ndarray:
+    """Softened accelerations of ``targets`` due to point-mass ``sources``.
+
+    Coincident pairs (including a particle and itself) contribute nothing.
+    """
+    diff = sources[np.newaxis, :, :] - targets[:, np.newaxis, :]
+    r2 = np.einsum("ijk,ijk->ij", diff, diff) + eps * eps
+    with np.errstate(divide="ignore"):
+        inv_r3 = np.where(r2 > 0.0, r2 ** -1.5, 0.0)
+    inv_r3 *= source_mass
+    return G * np.einsum("ijk,ij->ik", diff, inv_r3)
+
+
+def potential_kernel(targets: np.ndarray, sources: np.ndarray, source_mass: np.ndarray,
+                     G: float = 1.0, eps: float = 0.05) -> np.ndarray:
+    """Softened gravitational potential at ``targets`` due to ``sources``.
+
+    Sources at exactly the target position are skipped so a particle does not
+    see its own softened self-potential.
+    """
+    diff = sources[np.newaxis, :, :] - targets[:, np.newaxis, :]
+    d2 = np.einsum("ijk,ijk->ij", diff, diff)
+    with np.errstate(divide="ignore"):
+        inv_r = np.where(d2 > 0.0, (d2 + eps * eps) ** -0.5, 0.0)
+    return -G * (inv_r @ source_mass)
+
+
+def _quad_dot(quad: np.ndarray, d: np.ndarray) -> np.ndarray:
+    """``S @ d`` for packed symmetric tensors ``(xx, yy, zz, xy, xz, yz)`` broadcast against ``d``."""
+    qxx, qyy, qzz, qxy, qxz, qyz = np.moveaxis(quad, -1, 0)
+    x, y, z = np.moveaxis(d, -1, 0)
+    return np.stack((qxx * x + qxy * y + qxz * z,
+                     qxy * x + qyy * y + qyz * z,
+                     qxz * x + qyz * y + qzz * z), axis=-1)
+
+
+def quadrupole_kernel(targets: np.ndarray, centers: np.ndarray, quad: np.ndarray,
+                      G: float = 1.0, eps: float = 0.05) -> np.ndarray:
+    """Quadrupole correction to the accelerations of ``targets``.
+
+    ``quad`` holds the packed second moments ``S`` of each node about its
+    center of mass. With ``d = center - target``, ``s^2 = |d|^2 + eps^2`` and
+    ``T = tr S`` the term is ``G (d (7.5 d.S.d / s^2 - 1.5 T) - 3 S.d) / s^5``,
+    the second-order expansion of the softened kernel.
+    """
+    d = centers[np.newaxis, :, :] - targets[:, np.newaxis, :]
+    s2 = np.einsum("ijk,ijk->ij", d, d) + eps * eps
+    sd = _quad_dot(quad[np.newaxis], d)
+    dsd = np.einsum("ijk,ijk->ij", d, sd)
+    trace = quad[:, :3].sum(axis=1)
+    inv_s5 = s2 ** -2.5
+    radial = (7.5 * dsd / s2 - 1.5 * trace) * inv_s5
+    return G * (np.einsum("ijk,ij->ik", d, radial) - 3.0 * np.einsum("ijk,ij->ik", sd, inv_s5))
+
+
+def quadrupole_potential_kernel(targets: np.ndarray, centers: np.ndarray, quad: np.ndarray,
+                                G: float = 1.0, eps: float = 0.05) -> np.ndarray:
+    """Quadrupole correction ``-G (3 d.S.d - s^2 tr S) / (2 s^5)`` to the potential at ``targets``."""
+    d = centers[np.newaxis, :, :] - targets[:, np.newaxis, :]
+    s2 = np.einsum("ijk,ijk->ij", d, d) + eps * eps
+    dsd = np.einsum("ijk,ijk->ij", d, _quad_dot(quad[np.newaxis], d))
+    trace = quad[:, :3].sum(axis=1)
+    return -0.5 * G * ((3.0 * dsd - s2 * trace) * s2 ** -2.5).sum(axis=1)
+
+
+# Quadrupole term matching each monopole kernel of the group walk
+QUADRUPOLE_KERNELS = {
+    interaction_kernel: quadrupole_kernel,
+    potential_kernel: quadrupole_potential_kernel,
+}
+
+
+class LinearOctree:
+    """Barnes-Hut octree stored as flat arrays over Morton-sorted particles.
+
+    With ``quadrupole=True`` the nodes also carry quadrupole moments and
+    accepted nodes contribute a quadrupole term, which reaches the same force
+    error at a larger opening angle.
+    """
+
+    # Trees published to worker processes may not carry moments
+    quad: Optional[np.ndarray] = None
+
+    def __init__(self, pos: np.ndarray, mass: np.ndarray, leaf_size: int = 8,
+                 center: Optional[Sequence[float]] = None, half_size: Optional[float] = None,
+                 quadrupole: bool = False):
+        if leaf_size < 1:
+            raise ValueError("leaf_size must be at least 1")
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 3)
+        mass = np.asarray(mass, dtype=np.float64).reshape(-1)
+        if center is None or half_size is None:
+            center, half_size = bounding_cube(pos)
+        self.leaf_size = leaf_size
+        self.quadrupole = quadrupole
+        self.center = np.asarray(center, dtype=np.float64)
+        self.half_size = float(half_size)
+
+        keys = morton_keys(pos, self.center, self.half_size)
+        self.order = np.argsort(keys, kind="stable")
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(len(self.order))
+        self.keys = keys[self.order]
+        self.pos = pos[self.order]
+        self.pmass = mass[self.order]
+        self._build()
+        self._accumulate()
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "LinearOctree":
+        """Wrap existing node and particle arrays without rebuilding.
+
+        Used by worker processes that receive a published tree; only the
+        attributes present in ``arrays`` are set.
+        """
+        tree = cls.__new__(cls)
+        for key, value in arrays.items():
+            setattr(tree, key, value)
+        return tree
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    @property
+    def num_particles(self) -> int:
+        return len(self.pos)
+
+    @property
+    def depth(self) -> int:
+        return len(self.level_offsets) - 2
+
+    def _build(self):
+        n = len(self.keys)
+        starts = [np.zeros(1, dtype=np.int64)]
+        ends = [np.full(1, n, dtype=np.int64)]
+        first_child = [np.full(1, -1, dtype=np.int64)]
+        n_children = [np.zeros(1, dtype=np.int64)]
+        parents = [np.full(1, -1, dtype=np.int64)]
+        level_offsets = [0, 1]
+        f_start, f_end = starts[0], ends[0]
+        level = 0
+        while level < MAX_LEVEL:
+            counts = f_end - f_start
+            split = np.flatnonzero(counts > self.leaf_size)
+            if len(split) == 0:
+                break
+            s = f_start[split]
+            cnt = counts[split]
+            offsets = np.cumsum(cnt) - cnt
+            # Concatenated indices of every particle inside a node to split
+            idx = _ranges(s, f_end[split])
+            prefix = self.keys[idx] >> _U(3 * (MAX_LEVEL - level - 1))
+            new = np.empty(len(idx), dtype=bool)
+            new[0] = True
+            np.not_equal(prefix[1:], prefix[:-1], out=new[1:])
+            b = np.flatnonzero(new)
+            c_start = idx[b]
+            c_end = np.empty_like(c_start)
+            c_end[:-1] = idx[b[1:] - 1] + 1
+            c_end[-1] = idx[-1] + 1
+
+            first = np.searchsorted(b, offsets)
+            base = level_offsets[-1]
+            fc = first_child[-1]
+            nc = n_children[-1]
+            fc[split] = base + first
+            nc[split] = np.diff(np.append(first, len(b)))
+            parents.append(np.repeat(level_offsets[-2] + split, nc[split]))
+
+            starts.append(c_start)
+            ends.append(c_end)
+            first_child.append(np.full(len(b), -1, dtype=np.int64))
+            n_children.append(np.zeros(len(b), dtype=np.int64))
+            level_offsets.append(base + len(b))
+            f_start, f_end = c_start, c_end
+            level += 1
+
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        self.first_child = np.concatenate(first_child)
+        self.n_children = np.concatenate(n_children)
+        self.parent = np.concatenate(parents)
+        self.level_offsets = np.asarray(level_offsets, dtype=np.int64)
+        self.level = np.repeat(np.arange(len(level_offsets) - 1), np.diff(self.level_offsets))
+        self.cell_size = self.half_size / (2.0 ** self.level)
+        self.leaves = np.flatnonzero(self.first_child < 0)
+
+    def _reduce(self, values: np.ndarray, ufunc: np.ufunc = np.add) -> np.ndarray:
+        """Reduce per-particle ``values`` (sorted order) into every node.
+
+        Leaves are reduced directly over their particle range, internal nodes
+        bottom-up from their children one level at a time.
+        """
+        out = np.zeros((len(self.start),) + values.shape[1:], dtype=values.dtype)
+        if len(values) == 0:
+            return out
+        leaves = self.leaves[np.argsort(self.start[self.leaves], kind="stable")]
+        out[leaves] = ufunc.reduceat(values, self.start[leaves], axis=0)
+        lo = self.level_offsets
+        for level in range(len(lo) - 3, -1, -1):
+            nodes = np.arange(lo[level], lo[level + 1])
+            internal = nodes[self.first_child[nodes] >= 0]
+            if len(internal) == 0:
+                continue
+            children = out[lo[level + 1]:lo[level + 2]]
+            out[internal] = ufunc.reduceat(children, self.first_child[internal] - lo[level + 1], axis=0)
+        return out
+
+    def _accumulate(self):
+        self.mass = self._reduce(self.pmass)
+        weighted = self._reduce(self.pos * self.pmass[:, np.newaxis])
+        centers = self._reduce(self.pos) / np.maximum(self.end - self.start, 1)[:, np.newaxis]
+        positive = self.mass > 0
+        self.com = np.where(
+            positive[:, np.newaxis],
+            weighted / np.where(positive, self.mass, 1.0)[:, np.newaxis],
+            centers,
+        )
+        self.bbox_lo = self._reduce(self.pos, np.minimum)
+        self.bbox_hi = self._reduce(self.pos, np.maximum)
+        # Particles may have drifted out of their cells since the tree was
+        # built, so never use less than the bounding box half width
+        self.size = np.maximum(self.cell_size, 0.5 * (self.bbox_hi - self.bbox_lo).max(axis=1))
+        if self.quadrupole:
+            self.quad = self._quadrupoles()
+
+    def _quadrupoles(self) -> np.ndarray:
+        """Second moments ``sum m x x^T`` about each center of mass, packed as
+        ``(xx, yy, zz, xy, xz, yz)``.
+
+        Moments are reduced bottom-up about the root center and moved to each
+        node's center of mass with the parallel-axis theorem. Unlike the
+        traceless quadrupole tensor they keep the trace, which the softened
+        expansion needs.
+        """
+        x = self.pos - self.center
+        m = self.pmass
+        pairs = ((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2))
+        second = self._reduce(np.stack([m * x[:, i] * x[:, j] for i, j in pairs], axis=1))
+        c = self.com - self.center
+        second -= self.mass[:, np.newaxis] * np.stack([c[:, i] * c[:, j] for i, j in pairs], axis=1)
+        return second
+
+    def refit(self, pos: np.ndarray, mass: Optional[np.ndarray] = None):
+        """Recompute node masses, centers of mass and bounds for moved particles.
+
+        The tree structure and particle order are kept, so this costs a few
+        linear passes instead of a sort and rebuild.
+        """
+        self.pos = np.asarray(pos, dtype=np.float64).reshape(-1, 3)[self.order]
+        if mass is not None:
+            self.pmass = np.asarray(mass, dtype=np.float64).reshape(-1)[self.order]
+        self._accumulate()
+
+    def contains(self, pos: np.ndarray) -> bool:
+        """Whether every point of ``pos`` lies inside the root cube."""
+        return len(pos) == 0 or bool(np.abs(pos - self.center).max() < self.half_size)
+
+    @property
+    def inflation(self) -> float:
+        """Mean relative growth of the node sizes over their cells.
+
+        Zero for a freshly built tree. Particles leaving their leaf cells grow
+        the bounding boxes of that leaf and its ancestors, which makes the
+        opening test stricter and the walk slower.
+        """
+        return float(np.mean(self.size / self.cell_size)) - 1.0
+
+    def groups(self, group_size: int = 32, active: Optional[np.ndarray] = None) -> np.ndarray:
+        """Nodes used as interaction groups by :meth:`group_walk`.
+
+        A group is the largest node holding at most ``group_size`` particles,
+        or a leaf bucket if that is bigger. Groups partition the particles and
+        are returned in Morton order. With an ``active`` mask only groups
+        containing at least one active particle are kept.
+        """
+        fits = (self.end - self.start <= group_size) | (self.first_child < 0)
+        parent_fits = np.zeros_like(fits)
+        parent_fits[1:] = fits[self.parent[1:]]
+        groups = np.flatnonzero(fits & ~parent_fits)
+        groups = groups[np.argsort(self.start[groups], kind="stable")]
+        if active is not None:
+            groups = groups[np.add.reduceat(active.astype(np.int64), self.start[groups]) > 0]
+        return groups
+
+    def accelerations(self, theta: float = 0.5, G: float = 1.0, eps: float = 0.05,
+                      targets: Optional[np.ndarray] = None, mode: str = "particle",
+                      group_size: int = 32, counts: Optional[Dict[str, int]] = None) -> np.ndarray:
+        """Barnes-Hut accelerations in the original particle order.
+
+        ``mode`` selects the per-particle walk (``"particle"``) or the
+        group-wise walk (``"group"``, see :meth:`group_walk`). ``targets``
+        optionally restricts the evaluation to a subset of original particle
+        indices; the result then has one row per target. Interaction counts
+        (see :data:`WALK_COUNTERS`) are added to ``counts`` if given.
+        """
+        out = np.zeros((self.num_particles, 3))
+        active = self.active_mask(targets)
+        if mode == "group":
+            groups = self.groups(group_size, active)
+            self.group_walk(groups.tolist(), theta, G, eps, out, active, counts=counts)
+        elif mode == "particle":
+            sorted_targets = np.flatnonzero(active) if active is not None else np.arange(self.num_particles)
+            forces = self.walk(sorted_targets.tolist(), theta, G, eps, counts)
+            out[sorted_targets] = np.asarray(forces).reshape(-1, 3)
+        else:
+            raise ValueError("unknown walk mode %r" % mode)
+        if targets is None:
+            return out[self.rank]
+        return out[self.rank[np.asarray(targets, dtype=np.int64)]]
+
+    def potentials(self, theta: float = 0.5, G: float = 1.0, eps: float = 0.05,
+                   group_size: int = 32, targets: Optional[np.ndarray] = None) -> np.ndarray:
+        """Barnes-Hut estimate of the potential at every particle (original order).
+
+        ``targets`` restricts the evaluation as in :meth:`accelerations`.
+        """
+        out = np.zeros(self.num_particles)
+        active = self.active_mask(targets)
+        self.group_walk(self.groups(group_size, active).tolist(), theta, G, eps, out, active,
+                        kernel=potential_kernel)
+        if targets is None:
+            return out[self.rank]
+        return out[self.rank[np.asarray(targets, dtype=np.int64)]]
+
+    def active_mask(self, targets: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Boolean mask in sorted order of the original indices ``targets``."""
+        if targets is None:
+            return None
+        active = np.zeros(self.num_particles, dtype=bool)
+        active[self.rank[np.asarray(targets, dtype=np.int64)]] = True
+        return active
+
+    def group_walk(self, groups: Sequence[int], theta: float, G: float, eps: float,
+                   out: np.ndarray, active: Optional[np.ndarray] = None,
+                   kernel: Callable = interaction_kernel, counts: Optional[Dict[str, int]] = None):
+        """Walk the tree once per group and evaluate all its particles together.
+
+        For each group an interaction list is built from a single traversal:
+        nodes accepted by the opening test are kept as point masses, leaves
+        that must be opened contribute their particles directly. The test is
+        applied to the distance from the node's center of mass to the group's
+        bounding box, which is never larger than the distance to any particle
+        inside it, so every accepted node would also be accepted by the
+        per-particle walk. ``kernel`` results for the group's particles (only
+        the ``active`` ones, if given) are written into ``out`` in sorted
+        order; the default kernel yields accelerations. Trees with quadrupole
+        moments add the matching term from :data:`QUADRUPOLE_KERNELS` for the
+        accepted nodes. ``counts`` receives
+        the number of opened nodes and of evaluated particle-node and
+        particle-particle terms.
+        """
+        fc = self.first_child.tolist()
+        nc = self.n_children.tolist()
+        st = self.start.tolist()
+        en = self.end.tolist()
+        cx, cy, cz = self.com.T.tolist()
+        sz2 = (self.size * self.size).tolist()
+        lx, ly, lz = self.bbox_lo.T.tolist()
+        hx, hy, hz = self.bbox_hi.T.tolist()
+        theta2 = theta * theta
+        eps2 = eps * eps
+        opened = node_terms = pair_terms = 0
+        quad = self.quad
+        quad_kernel = QUADRUPOLE_KERNELS.get(kernel) if quad is not None else None
+        open_eps2 = eps2 if quad is None else 0.0
+
+        for g in groups:
+            gx0, gy0, gz0, gx1, gy1, gz1 = lx[g], ly[g], lz[g], hx[g], hy[g], hz[g]
+            accepted = []
+            leaves = []
+            stack = [0]
+            while stack:
+                n = stack.pop()
+                first = fc[n]
+                if first < 0:
+                    opened += 1
+                    leaves.append(n)
+                    continue
+                x, y, z = cx[n], cy[n], cz[n]
+                dx = gx0 - x if x < gx0 else (x - gx1 if x > gx1 else 0.0)
+                dy = gy0 - y if y < gy0 else (y - gy1 if y > gy1 else 0.0)
+                dz = gz0 - z if z < gz0 else (z - gz1 if z > gz1 else 0.0)
+                if sz2[n] < theta2 * (dx * dx + dy * dy + dz * dz + open_eps2):
+                    accepted.append(n)
+                else:
+                    opened += 1
+                    stack.extend(range(first, first + nc[n]))
+
+            rows = np.arange(st[g], en[g])
+            if active is not None:
+                rows = rows[active[st[g]:en[g]]]
+            direct = _ranges(self.start[leaves], self.end[leaves])
+            src = np.concatenate((self.com[accepted], self.pos[direct]))
+            src_mass = np.concatenate((self.mass[accepted], self.pmass[direct]))
+            out[rows] = kernel(self.pos[rows], src, src_mass, G, eps)
+            if quad_kernel is not None and accepted:
+                out[rows] += quad_kernel(self.pos[rows], self.com[accepted], quad[accepted], G, eps)
+            node_terms += len(rows) * len(accepted)
+            pair_terms += len(rows) * len(direct)
+        _tally(counts, opened, node_terms, pair_terms)
+
+    def walk(self, sorted_targets: Sequence[int], theta: float, G: float, eps: float,
+             counts: Optional[Dict[str, int]] = None):
+        """Iterative per-particle tree walk over sorted particle indices.
+
+        The interaction counters are kept in plain locals, which costs next
+        to nothing, and are only reported when ``counts`` is given.
+        """
+        fc = self.first_child.tolist()
+        nc = self.n_children.tolist()
+        st = self.start.tolist()
+        en = self.end.tolist()
+        nm = self.mass.tolist()
+        cx, cy, cz = self.com.T.tolist()
+        sz2 = (self.size * self.size).tolist()
+        px, py, pz = self.pos.T.tolist()
+        pm = self.pmass.tolist()
+        theta2 = theta * theta
+        eps2 = eps * eps
+        sqrt = math.sqrt
+        quad = self.quad.tolist() if self.quad is not None else None
+        open_eps2 = eps2 if quad is None else 0.0
+
+        out = []
+        opened = node_terms = pair_terms = 0
+        for i in sorted_targets:
+            xi, yi, zi = px[i], py[i], pz[i]
+            ax = ay = az = 0.0
+            stack = [0]
+            while stack:
+                n = stack.pop()
+                first = fc[n]
+                if first < 0:
+                    opened += 1
+                    pair_terms += en[n] - st[n]
+                    for j in range(st[n], en[n]):
+                        if j == i:
+                            pair_terms -= 1
+                            continue
+                        dx = px[j] - xi
+                        dy = py[j] - yi
+                        dz = pz[j] - zi
+                        r2 = dx * dx + dy * dy + dz * dz + eps2
+                        if r2 > 0.0:
+                            f = G * pm[j] / (r2 * sqrt(r2))
+                            ax += dx * f
+                            ay += dy * f
+                            az += dz * f
+                    continue
+                dx = cx[n] - xi
+                dy = cy[n] - yi
+                dz = cz[n] - zi
+                d2 = dx * dx + dy * dy + dz * dz
+                r2 = d2 + eps2
+                if sz2[n] < theta2 * (d2 + open_eps2):
+                    node_terms += 1
+                    inv_r = 1.0 / sqrt(r2)
+                    f = G * nm[n] * inv_r / r2
+                    ax += dx * f
+                    ay += dy * f
+                    az += dz * f
+                    if quad is not None:
+                        sxx, syy, szz, sxy, sxz, syz = quad[n]
+                        sx = sxx * dx + sxy * dy + sxz * dz
+                        sy = sxy * dx + syy * dy + syz * dz
+                        sz = sxz * dx + syz * dy + szz * dz
+                        inv_r5 = G * inv_r / (r2 * r2)
+                        g = (7.5 * (dx * sx + dy * sy + dz * sz) / r2 - 1.5 * (sxx + syy + szz)) * inv_r5
+                        ax += g * dx - 3.0 * sx * inv_r5
+                        ay += g * dy - 3.0 * sy * inv_r5
+                        az += g * dz - 3.0 * sz * inv_r5
+                else:
+                    opened += 1
+                    stack.extend(range(first, first + nc[n]))
+            out.append((ax, ay, az))
+        _tally(counts, opened, node_terms, pair_terms)
+        return out
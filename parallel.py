@@ -0,0 +1,155 @@
+"""Persistent process pool for Barnes-Hut force evaluation.
+
+The tree built by the parent process is published once per force
+evaluation into a single shared-memory block. Each worker attaches to the
+block (the attachment is cached across calls), rebuilds zero-copy array
+views of the tree and walks it for one contiguous slice of the Morton-sorted
+targets, writing accelerations straight into a shared output array.
+"""
+
+import multiprocessing
+import os
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from octree import LinearOctree
+
+# Tree attributes a worker needs to walk the tree.
+TREE_FIELDS = (
+    "first_child", "n_children", "start", "end", "mass", "com", "size",
+    "bbox_lo", "bbox_hi", "pos", "pmass",
+)
+
+_ALIGN = 64
+
+Layout = Dict[str, Tuple[int, Tuple[int, ...], str]]
+
+_attached: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = _attached.get(name)
+    if shm is None:
+        for old in _attached.values():
+            old.close()
+        _attached.clear()
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+    return shm
+
+
+def _views(buf, layout: Layout) -> Dict[str, np.ndarray]:
+    return {
+        key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=buf, offset=offset)
+        for key, (offset, shape, dtype) in layout.items()
+    }
+
+
+def _worker_forces(name: str, layout: Layout, lo: int, hi: int, mode: str,
+                   theta: float, G: float, eps: float, count: bool = False):
+    arrays = _views(_attach(name).buf, layout)
+    tree = LinearOctree.from_arrays(arrays)
+    work = arrays["work"][lo:hi].tolist()
+    out = arrays["out"]
+    counts: Optional[Dict[str, int]] = {} if count else None
+    if mode == "group":
+        tree.group_walk(work, theta, G, eps, out, arrays.get("active"), counts=counts)
+    else:
+        out[work] = tree.walk(work, theta, G, eps, counts)
+    # Drop the views so the cached block can be closed later
+    del arrays, tree, out
+    return counts
+
+
+class ProcessForcePool:
+    """Evaluate tree forces on a persistent pool of worker processes.
+
+    The pool and its shared-memory block live as long as this object; the
+    block only grows when a larger tree has to be published. Call
+    :meth:`close` (or rely on garbage collection) to release both.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or os.cpu_count() or 1
+        # Start the tracker first so forked workers share it with the parent
+        resource_tracker.ensure_running()
+        self._pool = multiprocessing.get_context().Pool(self.workers)
+        # One-element box so the finalizer sees the current block without
+        # holding a reference to self
+        self._box: list = [None]
+        self._finalizer = weakref.finalize(self, ProcessForcePool._release, self._pool, self._box)
+
+    @staticmethod
+    def _release(pool, box):
+        pool.terminate()
+        pool.join()
+        if box[0] is not None:
+            box[0].close()
+            box[0].unlink()
+            box[0] = None
+
+    @property
+    def _shm(self) -> Optional[shared_memory.SharedMemory]:
+        return self._box[0]
+
+    def _publish(self, arrays: Dict[str, np.ndarray]) -> Layout:
+        layout: Layout = {}
+        offset = 0
+        for key, arr in arrays.items():
+            layout[key] = (offset, arr.shape, arr.dtype.str)
+            offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+        if self._shm is None or self._shm.size < offset:
+            if self._shm is not None:
+                self._shm.close()
+                self._shm.unlink()
+            # Leave headroom so slowly growing trees do not reallocate every step
+            self._box[0] = shared_memory.SharedMemory(create=True, size=max(offset + offset // 4, _ALIGN))
+        views = _views(self._shm.buf, layout)
+        for key, arr in arrays.items():
+            views[key][...] = arr
+        return layout
+
+    def accelerations(self, tree: LinearOctree, theta: float = 0.5, G: float = 1.0, eps: float = 0.05,
+                      targets: Optional[np.ndarray] = None, mode: str = "particle",
+                      group_size: int = 32, counts: Optional[Dict[str, int]] = None) -> np.ndarray:
+        """Parallel equivalent of :meth:`octree.LinearOctree.accelerations`.
+
+        Work items (sorted particle indices, or groups in ``"group"`` mode)
+        are split into one contiguous slice per worker. The workers'
+        interaction counts are summed into ``counts`` if given.
+        """
+        active = tree.active_mask(targets)
+        if mode == "group":
+            work = tree.groups(group_size, active)
+        elif mode == "particle":
+            work = np.flatnonzero(active) if active is not None else np.arange(tree.num_particles)
+        else:
+            raise ValueError("unknown walk mode %r" % mode)
+        arrays = {key: getattr(tree, key) for key in TREE_FIELDS}
+        if tree.quad is not None:
+            arrays["quad"] = tree.quad
+        arrays["work"] = work
+        arrays["out"] = np.zeros((tree.num_particles, 3))
+        if active is not None:
+            arrays["active"] = active
+        layout = self._publish(arrays)
+
+        bounds = np.linspace(0, len(work), self.workers + 1).astype(int)
+        tasks = [
+            (self._shm.name, layout, int(lo), int(hi), mode, theta, G, eps, counts is not None)
+            for lo, hi in zip(bounds[:-1], bounds[1:])
+            if hi > lo
+        ]
+        for part in self._pool.starmap(_worker_forces, tasks):
+            if part:
+                for key, value in part.items():
+                    counts[key] = counts.get(key, 0) + value
+        out = _views(self._shm.buf, {"out": layout["out"]})["out"]
+        if targets is None:
+            return out[tree.rank]
+        return out[tree.rank[np.asarray(targets, dtype=np.int64)]]
+
+    def close(self):
+        self._finalizer()
@@ -0,0 +1,117 @@
+"""Particle containers shared by the simulation, recorder and GUI."""
+
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+
+@dataclass
+class Particle:
+    x: float
+    y: float
+    z: float
+    vx: float
+    vy: float
+    vz: float
+    mass: float = 1.0
+
+
+def _component(array: str, axis: Optional[int] = None) -> property:
+    if axis is None:
+        def fget(self):
+            return float(getattr(self._store, array)[self.index])
+
+        def fset(self, value):
+            getattr(self._store, array)[self.index] = value
+    else:
+        def fget(self):
+            return float(getattr(self._store, array)[self.index, axis])
+
+        def fset(self, value):
+            getattr(self._store, array)[self.index, axis] = value
+    return property(fget, fset)
+
+
+class ParticleView:
+    """``Particle``-like proxy for one row of a :class:`ParticleSet`.
+
+    Reads and writes go straight to the underlying arrays, so code written
+    against ``Particle`` objects keeps working on the array store.
+    """
+
+    __slots__ = ("_store", "index")
+
+    x = _component("pos", 0)
+    y = _component("pos", 1)
+    z = _component("pos", 2)
+    vx = _component("vel", 0)
+    vy = _component("vel", 1)
+    vz = _component("vel", 2)
+    mass = _component("mass")
+
+    def __init__(self, store: "ParticleSet", index: int):
+        self._store = store
+        self.index = index
+
+    def __repr__(self):
+        return "ParticleView(index=%d, x=%g, y=%g, z=%g, vx=%g, vy=%g, vz=%g, mass=%g)" % (
+            self.index, self.x, self.y, self.z, self.vx, self.vy, self.vz, self.mass,
+        )
+
+
+class ParticleSet:
+    """Structure-of-arrays particle storage.
+
+    ``pos`` and ``vel`` are contiguous ``(N, 3)`` float64 arrays and ``mass``
+    is an ``(N,)`` array. Indexing or iterating yields cached
+    :class:`ParticleView` objects for callers that expect ``Particle``s.
+    """
+
+    def __init__(self, pos, vel, mass=None):
+        self.pos = np.ascontiguousarray(pos, dtype=np.float64).reshape(-1, 3)
+        self.vel = np.ascontiguousarray(vel, dtype=np.float64).reshape(-1, 3)
+        if mass is None:
+            mass = np.ones(len(self.pos))
+        self.mass = np.ascontiguousarray(mass, dtype=np.float64).reshape(-1)
+        if not (len(self.pos) == len(self.vel) == len(self.mass)):
+            raise ValueError("pos, vel and mass must have the same length")
+        self._views: Optional[List[ParticleView]] = None
+
+    @classmethod
+    def from_particles(cls, particles: Iterable[Particle]) -> "ParticleSet":
+        plist = list(particles)
+        pos = np.array([(p.x, p.y, p.z) for p in plist], dtype=np.float64).reshape(-1, 3)
+        vel = np.array([(p.vx, p.vy, p.vz) for p in plist], dtype=np.float64).reshape(-1, 3)
+        mass = np.array([p.mass for p in plist], dtype=np.float64)
+        return cls(pos, vel, mass)
+
+    def to_particles(self) -> List[Particle]:
+        return [
+            Particle(x, y, z, vx, vy, vz, m)
+            for (x, y, z), (vx, vy, vz), m in zip(self.pos.tolist(), self.vel.tolist(), self.mass.tolist())
+        ]
+
+    def copy(self) -> "ParticleSet":
+        return ParticleSet(self.pos.copy(), self.vel.copy(), self.mass.copy())
+
+    def _view_list(self) -> List[ParticleView]:
+        if self._views is None or len(self._views) != len(self.mass):
+            self._views = [ParticleView(self, i) for i in range(len(self.mass))]
+        return self._views
+
+    def __len__(self) -> int:
+        return len(self.mass)
+
+    def __getitem__(self, index: int) -> ParticleView:
+        return self._view_list()[index]
+
+    def __iter__(self) -> Iterator[ParticleView]:
+        return iter(self._view_list())
+
+
+def as_particle_set(particles) -> ParticleSet:
+    """Return ``particles`` as a :class:`ParticleSet`, converting if needed."""
+    if isinstance(particles, ParticleSet):
+        return particles
+    return ParticleSet.from_particles(particles)
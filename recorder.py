@@ -1,38 +1,301 @@
-"""Simple recording of simulation frames for playback."""
+"""Recording of simulation frames for playback and analysis.
 
+Recordings are stored in a chunked binary format that can be appended to
+while a simulation runs and read back through a memory map:
+
+- a 64 byte header (magic, version, flags, particle count, frame stride,
+  number of complete frames, offset of the first frame),
+- optionally the particle masses as float32,
+- fixed-size frame records ``(step: int64, time: float64, pos: float32[N, 3]
+  [, vel: float32[N, 3]])``.
+
+Because every record has the same size the step/time columns act as a frame
+index with O(1) random access, and :class:`Recording` exposes positions and
+velocities as zero-copy ``(frames, N, 3)`` array views. Frames are buffered
+in chunks of bounded size and written at least every ``flush_interval``
+seconds. The frame count in the header is only advanced after a chunk has
+been written, so a reader never sees a partial frame. Files written by the original recorder (a
+``"III"`` header followed by raw float32 positions) are read as well.
+"""
+
+import os
 import struct
-from typing import Iterable, List, Tuple
+from time import monotonic
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+MAGIC = b"CWREC\x00\x00\x00"
+VERSION = 2
+HEADER = struct.Struct("<8sIIQQQQ16x")  # magic, version, flags, count, every, frames, data offset
+FLAG_VELOCITIES = 1
+FLAG_MASSES = 2
+_ALIGN = 64
+
+# Default size of the frame buffer of a RecordingWriter
+CHUNK_BYTES = 8 << 20
+
+
+def frame_dtype(particle_count: int, velocities: bool = False) -> np.dtype:
+    """NumPy dtype of one on-disk frame record."""
+    fields = [("step", "<i8"), ("time", "<f8"), ("pos", "<f4", (particle_count, 3))]
+    if velocities:
+        fields.append(("vel", "<f4", (particle_count, 3)))
+    return np.dtype(fields)
+
+
+def _particle_arrays(particles):
+    pos = getattr(particles, "pos", None)
+    if pos is not None:
+        return pos, particles.vel, particles.mass
+    plist = list(particles)
+    pos = np.array([(p.x, p.y, p.z) for p in plist], dtype=np.float64).reshape(-1, 3)
+    vel = np.array([(p.vx, p.vy, p.vz) for p in plist], dtype=np.float64).reshape(-1, 3)
+    mass = np.array([p.mass for p in plist], dtype=np.float64)
+    return pos, vel, mass
+
+
+class RecordingWriter:
+    """Append frames to a recording file in chunks.
+
+    Only every ``every``-th call to :meth:`add_frame` is stored. Frames are
+    buffered in a chunk of at most ``chunk_bytes`` (and at most
+    ``chunk_frames`` frames, if given; always at least one frame). A chunk is
+    written when it is full or when ``flush_interval`` seconds have passed
+    since the last write. The first frame is written at once, so live
+    readers see the run start. :meth:`flush` writes a partial chunk. With
+    ``append=True`` an existing recording is continued.
+    """
+
+    def __init__(self, path: str, particle_count: int, velocities: bool = False,
+                 masses: Optional[np.ndarray] = None, every: int = 1, chunk_frames: Optional[int] = None,
+                 append: bool = False, chunk_bytes: int = CHUNK_BYTES, flush_interval: float = 1.0):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        self.path = path
+        self.particle_count = particle_count
+        self.every = every
+        self.flush_interval = flush_interval
+        self.calls = 0
+        if append and os.path.exists(path):
+            self._open_existing(velocities)
+        else:
+            self._create(velocities, masses)
+        self.dtype = frame_dtype(particle_count, self.velocities)
+        self.chunk_frames = max(1, chunk_bytes // self.dtype.itemsize)
+        if chunk_frames is not None:
+            self.chunk_frames = max(1, min(self.chunk_frames, chunk_frames))
+        self._buffer = np.zeros(self.chunk_frames, dtype=self.dtype)
+        self._buffered = 0
+        self._last_flush = -float("inf")
+
+    def _create(self, velocities: bool, masses: Optional[np.ndarray]):
+        self.velocities = velocities
+        flags = FLAG_VELOCITIES if velocities else 0
+        mass_bytes = b""
+        if masses is not None:
+            flags |= FLAG_MASSES
+            mass_bytes = np.asarray(masses, dtype="<f4").reshape(self.particle_count).tobytes()
+        self.data_offset = -(-(HEADER.size + len(mass_bytes)) // _ALIGN) * _ALIGN
+        self.flags = flags
+        self.frames = 0
+        self._file = open(self.path, "w+b")
+        self._write_header()
+        self._file.write(mass_bytes)
+        self._file.write(b"\0" * (self.data_offset - HEADER.size - len(mass_bytes)))
+        self._file.flush()
+
+    def _open_existing(self, velocities: bool):
+        self._file = open(self.path, "r+b")
+        magic, version, flags, count, every, frames, offset = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            self._file.close()
+            raise ValueError("%s is not a version %d recording" % (self.path, VERSION))
+        if count != self.particle_count or bool(flags & FLAG_VELOCITIES) != velocities:
+            self._file.close()
+            raise ValueError("recording layout does not match the requested one")
+        self.flags = flags
+        self.velocities = velocities
+        self.data_offset = offset
+        self.frames = frames
+        # Drop anything past the last complete frame
+        self._file.truncate(offset + frames * frame_dtype(count, velocities).itemsize)
+
+    def _write_header(self):
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, self.flags, self.particle_count,
+                                     self.every, self.frames, self.data_offset))
+
+    def add_frame(self, particles, step: Optional[int] = None, time: float = 0.0):
+        """Buffer a frame taken from a ``ParticleSet`` or iterable of particles."""
+        call = self.calls
+        self.calls += 1
+        if call % self.every:
+            return
+        pos, vel, _ = _particle_arrays(particles)
+        self.append(pos, vel, call if step is None else step, time)
+
+    def append(self, pos: np.ndarray, vel: Optional[np.ndarray] = None, step: int = 0, time: float = 0.0):
+        """Buffer one frame from arrays, bypassing the ``every`` stride."""
+        record = self._buffer[self._buffered]
+        record["step"] = step
+        record["time"] = time
+        record["pos"] = pos
+        if self.velocities:
+            record["vel"] = vel
+        self._buffered += 1
+        if (self._buffered == self.chunk_frames
+                or monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self._last_flush = monotonic()
+        if self._buffered:
+            self._file.seek(self.data_offset + self.frames * self.dtype.itemsize)
+            self._file.write(self._buffer[:self._buffered].tobytes())
+            self._file.flush()
+            self.frames += self._buffered
+            self._buffered = 0
+            # Publish the new frames only once their data is on disk
+            self._write_header()
+            self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __del__(self):
+        # Keep buffered frames of a writer that was never closed
+        if hasattr(self, "_buffered"):
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Recording:
+    """Memory-mapped, read-only view of a recording file.
+
+    ``positions`` (and ``velocities`` when recorded) are ``(frames, N, 3)``
+    float32 arrays backed by the file; indexing returns one frame without
+    reading the others. Call :meth:`refresh` to pick up frames appended
+    since the file was opened.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        with open(self.path, "rb") as f:
+            head = f.read(HEADER.size)
+        if head[:8] == MAGIC:
+            magic, version, flags, count, every, frames, offset = HEADER.unpack(head)
+            if version != VERSION:
+                raise ValueError("unsupported recording version %d" % version)
+            self.particle_count = count
+            self.every = every
+            dtype = frame_dtype(count, bool(flags & FLAG_VELOCITIES))
+            self.masses = None
+            if flags & FLAG_MASSES:
+                self.masses = np.memmap(self.path, dtype="<f4", mode="r", offset=HEADER.size, shape=(count,))
+            if frames:
+                self._records = np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=(frames,))
+            else:
+                self._records = np.zeros(0, dtype=dtype)
+            self.positions = self._records["pos"]
+            self.velocities = self._records["vel"] if flags & FLAG_VELOCITIES else None
+            self.steps = self._records["step"]
+            self.times = self._records["time"]
+        else:
+            # Original format: "III" header then float32 positions
+            frames, count, comps = struct.unpack("III", head[:12])
+            self.particle_count = count
+            self.every = 1
+            self.masses = None
+            self.velocities = None
+            if frames:
+                self.positions = np.memmap(self.path, dtype="<f4", mode="r", offset=12, shape=(frames, count, comps))
+            else:
+                self.positions = np.zeros((0, count, comps), dtype="<f4")
+            self.steps = np.arange(frames)
+            self.times = np.zeros(frames)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __getitem__(self, index) -> np.ndarray:
+        return self.positions[index]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return iter(self.positions)
 
 
 class SimulationRecorder:
-    """Record particle positions for each simulation step."""
+    """Record particle positions for each simulation step.
+
+    Frames are kept in memory unless ``path`` is given, in which case they are
+    streamed to a recording file as the simulation runs. ``every`` keeps only
+    every k-th frame; ``velocities`` and ``masses`` add those to the file.
+    """
 
-    def __init__(self, particle_count: int):
+    def __init__(self, particle_count: int, path: Optional[str] = None, every: int = 1,
+                 velocities: bool = False, masses: bool = False):
         self.particle_count = particle_count
-        self.frames: List[List[Tuple[float, float, float]]] = []
+        self.every = every
+        self.velocities = velocities
+        self.masses = masses
+        self.frames: List[np.ndarray] = []
+        self.steps: List[int] = []
+        self.times: List[float] = []
+        self._calls = 0
+        self.path = path
+        self._writer: Optional[RecordingWriter] = None
+
+    def add_frame(self, particles: Iterable, step: Optional[int] = None, time: float = 0.0):
+        """Store a snapshot of ``particles``.
+
+        ``particles`` may be a :class:`particles.ParticleSet`, whose arrays
+        are copied in one go, or any iterable of objects with ``x``, ``y`` and
+        ``z`` attributes.
+        """
+        if self.path is not None:
+            if self._writer is None:
+                _, _, mass = _particle_arrays(particles)
+                self._writer = RecordingWriter(self.path, self.particle_count, velocities=self.velocities,
+                                               masses=mass if self.masses else None, every=self.every)
+            self._writer.add_frame(particles, step, time)
+            return
+        call = self._calls
+        self._calls += 1
+        if call % self.every:
+            return
+        pos, _, _ = _particle_arrays(particles)
+        self.frames.append(np.array(pos, dtype=np.float32).reshape(-1, 3))
+        self.steps.append(call if step is None else step)
+        self.times.append(time)
 
-    def add_frame(self, particles: Iterable[Tuple[float, float, float]]):
-        self.frames.append([(p.x, p.y, p.z) for p in particles])
+    def close(self):
+        """Flush and close a streaming recording."""
+        if self._writer is not None:
+            self._writer.close()
 
     def save(self, path: str):
-        """Write recorded frames to a binary file."""
-        with open(path, "wb") as f:
-            header = struct.pack("III", len(self.frames), self.particle_count, 3)
-            f.write(header)
-            for frame in self.frames:
-                for x, y, z in frame:
-                    f.write(struct.pack("fff", x, y, z))
+        """Write in-memory frames to a recording file."""
+        with RecordingWriter(path, self.particle_count, every=self.every, chunk_frames=256) as writer:
+            for frame, step, time in zip(self.frames, self.steps, self.times):
+                writer.append(frame, step=step, time=time)
 
     @classmethod
     def load(cls, path: str):
-        with open(path, "rb") as f:
-            header = f.read(12)
-            frames, count, comps = struct.unpack("III", header)
-            recorder = cls(count)
-            for _ in range(frames):
-                data = []
-                for _ in range(count):
-                    xyz = struct.unpack("fff", f.read(12))
-                    data.append(xyz)
-                recorder.frames.append(data)
+        """Load a recording; frames are memory-mapped views into the file."""
+        recording = Recording(path)
+        recorder = cls(recording.particle_count, every=recording.every)
+        recorder.frames = list(recording.positions)
+        recorder.steps = recording.steps.tolist()
+        recorder.times = recording.times.tolist()
         return recorder
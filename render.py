@@ -0,0 +1,198 @@
+"""Vectorized rasterization of particle positions into RGB images.
+
+Whole frames are drawn with array operations: particles are projected onto
+the pixel grid at once and blended with ``np.bincount`` accumulation.
+:func:`render_recording` renders frames of a recording file in batches on a
+process pool while keeping only a bounded number of batches in flight.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+
+from recorder import Recording
+from spatial import SpatialIndex
+
+MODES = ("points", "additive", "density")
+COLORINGS = ("depth", "density")
+
+
+def depth_colors(pos: np.ndarray) -> np.ndarray:
+    """Blue-to-green colors by height ``z``, the classic GIF look."""
+    c = np.clip(128 + 127 * pos[:, 2], 0, 255).astype(np.uint8)
+    colors = np.zeros((len(pos), 3), dtype=np.uint8)
+    colors[:, 1] = c
+    colors[:, 2] = 255 - c
+    return colors
+
+
+def speed_colors(vel: np.ndarray) -> np.ndarray:
+    """Blue (slow) to red (fast) colors relative to the fastest particle."""
+    speed = np.sqrt(np.einsum("ij,ij->i", vel, vel))
+    peak = speed.max() if len(speed) else 0.0
+    t = speed / peak if peak > 0 else np.zeros_like(speed)
+    colors = np.zeros((len(vel), 3), dtype=np.uint8)
+    colors[:, 0] = (t * 255).astype(np.uint8)
+    colors[:, 2] = ((1.0 - t) * 255).astype(np.uint8)
+    return colors
+
+
+def splat(px: np.ndarray, py: np.ndarray, colors: np.ndarray, width: int, height: int,
+          radius: int = 2) -> np.ndarray:
+    """Draw every particle as a filled square of side ``2 * radius`` pixels.
+
+    ``px``/``py`` are pixel coordinates (y growing downwards); the result is a
+    ``(height, width, 3)`` uint8 image on a black background.
+    """
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    ix = np.rint(px).astype(np.int64)
+    iy = np.rint(py).astype(np.int64)
+    for dy in range(-radius, radius):
+        y = iy + dy
+        for dx in range(-radius, radius):
+            x = ix + dx
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            img[y[inside], x[inside]] = colors[inside]
+    return img
+
+
+def ppm_bytes(img: np.ndarray) -> bytes:
+    """Encode an RGB uint8 image as binary PPM, e.g. for ``tk.PhotoImage``."""
+    height, width = img.shape[:2]
+    return b"P6 %d %d 255\n" % (width, height) + np.ascontiguousarray(img).tobytes()
+
+
+def pixel_indices(pos: np.ndarray, size: int, extent: float = 2.0):
+    """Flat pixel index of each particle and a mask of those inside the image.
+
+    The view spans ``[-extent, extent]`` in x and y; row 0 is the lowest y.
+    """
+    scale = (size - 1) / (2.0 * extent)
+    ix = ((pos[:, 0] + extent) * scale).astype(np.int64)
+    iy = ((pos[:, 1] + extent) * scale).astype(np.int64)
+    inside = (ix >= 0) & (ix < size) & (iy >= 0) & (iy < size)
+    return iy * size + ix, inside
+
+
+def _density_palette() -> np.ndarray:
+    t = np.linspace(0.0, 1.0, 256)
+    r = np.clip(3.0 * t - 2.0, 0, 1)
+    g = np.clip(3.0 * t - 1.0, 0, 1)
+    b = np.clip(3.0 * t, 0, 1)
+    return (np.stack((r, g, b), axis=1) * 255).astype(np.uint8)
+
+
+DENSITY_PALETTE = _density_palette()
+
+
+def rasterize(pos: np.ndarray, size: int = 200, extent: float = 2.0, mode: str = "points",
+              colors: Optional[np.ndarray] = None, gain: float = 1.0) -> np.ndarray:
+    """Draw ``pos`` into a ``(size, size, 3)`` uint8 image.
+
+    ``mode`` selects the blending:
+
+    - ``"points"``: each covered pixel takes the color of one particle,
+    - ``"additive"``: particle colors are summed per pixel (scaled by
+      ``gain``) and clipped, so dense regions saturate towards white,
+    - ``"density"``: the particle count per pixel is log-scaled and mapped
+      through :data:`DENSITY_PALETTE`; ``colors`` is ignored.
+
+    ``colors`` defaults to :func:`depth_colors`.
+    """
+    pos = np.asarray(pos)
+    flat, inside = pixel_indices(pos, size, extent)
+    flat = flat[inside]
+    npix = size * size
+    if mode == "density":
+        counts = np.bincount(flat, minlength=npix)
+        peak = counts.max() if len(flat) else 0
+        level = np.log1p(counts) / np.log1p(peak) if peak else np.zeros(npix)
+        img = DENSITY_PALETTE[(level * 255).astype(np.uint8)]
+        return img.reshape(size, size, 3)
+    if colors is None:
+        colors = depth_colors(pos)
+    colors = np.asarray(colors)[inside]
+    if mode == "additive":
+        img = np.empty((npix, 3))
+        for channel in range(3):
+            img[:, channel] = np.bincount(flat, weights=colors[:, channel], minlength=npix)
+        return np.clip(img * gain, 0, 255).astype(np.uint8).reshape(size, size, 3)
+    if mode != "points":
+        raise ValueError("unknown render mode %r" % mode)
+    img = np.zeros((npix, 3), dtype=np.uint8)
+    img[flat] = colors
+    return img.reshape(size, size, 3)
+
+
+def density_colors(density: np.ndarray) -> np.ndarray:
+    """Colors of the local particle densities, log-scaled through :data:`DENSITY_PALETTE`."""
+    density = np.asarray(density, dtype=np.float64)
+    finite = np.isfinite(density) & (density > 0)
+    if not finite.any():
+        return np.repeat(DENSITY_PALETTE[:1], len(density), axis=0)
+    logs = np.log(np.where(finite, density, 1.0))
+    lo, hi = logs[finite].min(), logs[finite].max()
+    level = (logs - lo) / (hi - lo) if hi > lo else np.ones(len(density))
+    # Coincident particles have infinite density
+    level = np.where(finite, level, np.where(density > 0, 1.0, 0.0))
+    return DENSITY_PALETTE[(np.clip(level, 0.0, 1.0) * 255).astype(np.uint8)]
+
+
+def frame_colors(pos: np.ndarray, color: str = "depth", mass: Optional[np.ndarray] = None,
+                 neighbors: int = 32) -> np.ndarray:
+    """Particle colors for one frame: ``"depth"`` or ``"density"`` (see :mod:`spatial`)."""
+    if color == "depth":
+        return depth_colors(pos)
+    if color != "density":
+        raise ValueError("unknown coloring %r (choose from %s)" % (color, ", ".join(COLORINGS)))
+    if len(pos) <= neighbors:
+        neighbors = len(pos) - 1
+    if neighbors < 1:
+        return density_colors(np.ones(len(pos)))
+    return density_colors(SpatialIndex.from_points(pos, mass).density(neighbors))
+
+
+def _render_batch(path: str, indices: Sequence[int], size: int, extent: float, mode: str, color: str):
+    recording = Recording(path)
+    frames = []
+    for i in indices:
+        pos = recording[i]
+        colors = None if mode == "density" else frame_colors(pos, color, recording.masses)
+        frames.append(rasterize(pos, size, extent, mode, colors))
+    return frames
+
+
+def render_recording(path: str, indices: Sequence[int], size: int = 200, extent: float = 2.0,
+                     mode: str = "points", workers: Optional[int] = None,
+                     batch: int = 16, color: str = "depth") -> Iterator[np.ndarray]:
+    """Yield rendered frames of the recording at ``path`` in order.
+
+    Frames are rendered ``batch`` at a time on ``workers`` processes, each
+    memory-mapping the file itself. At most two batches per worker are in
+    flight, so memory stays bounded however long the recording is.
+    ``color="density"`` colors particles by their local density, weighted by
+    the recorded masses if the file has them.
+    """
+    indices = list(indices)
+    batches = [indices[i:i + batch] for i in range(0, len(indices), batch)]
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        for chunk in batches:
+            yield from _render_batch(path, chunk, size, extent, mode, color)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending: deque = deque()
+        todo = iter(batches)
+        for chunk in todo:
+            pending.append(pool.submit(_render_batch, path, chunk, size, extent, mode, color))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            frames = pending.popleft().result()
+            chunk = next(todo, None)
+            if chunk is not None:
+                pending.append(pool.submit(_render_batch, path, chunk, size, extent, mode, color))
+            yield from frames
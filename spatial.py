@@ -0,0 +1,253 @@
+"""Neighbor search and local densities on top of :class:`octree.LinearOctree`.
+
+:class:`SpatialIndex` wraps a tree (typically the one the simulation built
+for its force pass, see :meth:`nbody.BarnesHutSimulation.spatial_index`) and
+answers batched queries with array operations:
+
+- query points are sorted in Morton order and split into small groups
+  sharing a tree cell. The tree is walked once per group, for all groups at once,
+  keeping a frontier of ``(group, node)`` pairs and pruning nodes whose
+  bounding box lies farther than the radius from the group's box. The
+  particles of the leaves that remain are the candidates of every query in
+  the group.
+- k-nearest-neighbor queries first bound each query's k-th neighbor
+  distance with the particles next to it in Morton order, then search that
+  radius and keep the k closest candidates.
+
+Both cost O(log N) tree levels per query, so :meth:`SpatialIndex.density`
+estimates the density of every particle in O(N log N). Indices refer to the
+original particle order.
+"""
+
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from octree import LinearOctree, _ranges, morton_keys
+
+# Queries are searched in groups of at most GROUP_SIZE points falling into
+# the same small tree cell; PAIR_BUDGET bounds the query-candidate pairs
+# evaluated per batch
+GROUP_SIZE = 16
+PAIR_BUDGET = 1 << 20
+
+# Relative error allowance of the fast squared distances used for pruning
+SLACK = 1e-9
+
+
+def _sq_dist(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    d = a - b
+    return np.einsum("ij,ij->i", d, d)
+
+
+class SpatialIndex:
+    """Batched radius and k-nearest-neighbor queries over the particles of ``tree``."""
+
+    def __init__(self, tree: LinearOctree):
+        self.tree = tree
+
+    @classmethod
+    def from_points(cls, pos: np.ndarray, mass: Optional[np.ndarray] = None, leaf_size: int = 16) -> "SpatialIndex":
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 3)
+        mass = np.ones(len(pos)) if mass is None else mass
+        return cls(LinearOctree(pos, mass, leaf_size=leaf_size))
+
+    def __len__(self) -> int:
+        return self.tree.num_particles
+
+    def _candidates(self, lo: np.ndarray, hi: np.ndarray, r2: np.ndarray):
+        """Sorted particle indices of the leaves within ``sqrt(r2)`` of each box ``[lo, hi]``.
+
+        Returned as ``(offsets, indices)``: box ``b`` owns
+        ``indices[offsets[b]:offsets[b + 1]]``.
+        """
+        tree = self.tree
+        out_g, out_n = [], []
+        g = np.arange(len(lo))
+        nodes = np.zeros(len(lo), dtype=np.int64)
+        while len(g):
+            gap = np.maximum(tree.bbox_lo[nodes] - hi[g], 0.0) + np.maximum(lo[g] - tree.bbox_hi[nodes], 0.0)
+            keep = np.einsum("ij,ij->i", gap, gap) <= r2[g]
+            g, nodes = g[keep], nodes[keep]
+            leaf = tree.first_child[nodes] < 0
+            out_g.append(g[leaf])
+            out_n.append(nodes[leaf])
+            inner = nodes[~leaf]
+            nc = tree.n_children[inner]
+            g = np.repeat(g[~leaf], nc)
+            nodes = _ranges(tree.first_child[inner], tree.first_child[inner] + nc)
+        g = np.concatenate(out_g)
+        leaves = np.concatenate(out_n)
+        order = np.argsort(g, kind="stable")
+        g, leaves = g[order], leaves[order]
+        sizes = tree.end[leaves] - tree.start[leaves]
+        offsets = np.zeros(len(lo) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(g, weights=sizes, minlength=len(lo)).astype(np.int64), out=offsets[1:])
+        return offsets, _ranges(tree.start[leaves], tree.end[leaves])
+
+    def _groups(self, p: np.ndarray) -> np.ndarray:
+        """Tree group (see :meth:`octree.LinearOctree.groups`) of the sorted particles ``p``."""
+        groups = self.tree.groups(GROUP_SIZE)
+        return np.searchsorted(self.tree.start[groups], np.minimum(p, len(self) - 1), side="right") - 1
+
+    def _batches(self, pts: np.ndarray, r2: np.ndarray, group: np.ndarray):
+        """Approximate squared distances from Morton-ordered ``pts`` to their candidates.
+
+        Consecutive queries with the same ``group`` label (a compact tree
+        cell) are searched together, at most ``GROUP_SIZE`` at a time. Yields
+        ``(queries, candidates, d2)`` with shapes ``(g, G)``, ``(g, C)`` and
+        ``(g, G, C)`` for batches of ``g`` groups; ``queries`` holds indices
+        into ``pts`` (-1 for padding) and padded candidates are ``-1`` at a
+        huge distance. ``d2`` comes from ``|x|^2 + |y|^2 - 2 x.y`` for speed,
+        so callers recompute the distances they keep.
+        """
+        tree = self.tree
+        m = len(pts)
+        i = np.arange(m)
+        new = np.ones(m, dtype=bool)
+        new[1:] = group[1:] != group[:-1]
+        run_start = np.maximum.accumulate(np.where(new, i, 0))
+        new |= (i - run_start) % GROUP_SIZE == 0
+        starts = np.flatnonzero(new)
+        member = np.cumsum(new) - 1
+        slots = np.full((len(starts), GROUP_SIZE), -1, dtype=np.int64)
+        slots[member, i - starts[member]] = i
+        members = np.diff(np.append(starts, m))
+        offsets, idx = self._candidates(np.minimum.reduceat(pts, starts), np.maximum.reduceat(pts, starts),
+                                        np.maximum.reduceat(r2, starts))
+        counts = np.diff(offsets)
+
+        # The padding candidate (index -1) is a point far away from everything
+        far = np.vstack((tree.pos, np.full((1, 3), 1e100)))
+        far_sq = np.einsum("ij,ij->i", far, far)
+        pts_sq = np.einsum("ij,ij->i", pts, pts)
+        # Groups with similar candidate counts are batched together to keep
+        # the padding small
+        by_count = np.argsort(counts, kind="stable")
+        sorted_counts = np.maximum(counts[by_count], 1)
+        start = 0
+        while start < len(by_count):
+            width = np.arange(1, len(by_count) - start + 1) * sorted_counts[start:] * GROUP_SIZE
+            stop = start + max(1, int(np.searchsorted(width, PAIR_BUDGET, side="right")))
+            batch = by_count[start:stop]
+            sizes = counts[batch]
+            rows = np.repeat(np.arange(len(batch)), sizes)
+            cols = np.arange(len(rows)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            cand = np.full((len(batch), sizes.max()), -1, dtype=np.int64)
+            cand[rows, cols] = idx[_ranges(offsets[batch], offsets[batch + 1])]
+            queries = slots[batch, :members[batch].max()]
+            q = np.maximum(queries, 0)
+            d2 = np.matmul(pts[q], far[cand].transpose(0, 2, 1))
+            d2 *= -2.0
+            d2 += pts_sq[q][:, :, np.newaxis]
+            d2 += far_sq[cand][:, np.newaxis, :]
+            yield queries, cand, d2
+            start = stop
+
+    def _morton_order(self, points: np.ndarray) -> np.ndarray:
+        return np.argsort(morton_keys(points, self.tree.center, self.tree.half_size), kind="stable")
+
+    def radius_pairs(self, points: np.ndarray, r) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """All ``(query, particle, distance)`` triples with distance at most ``r``.
+
+        ``r`` is a scalar or one radius per query. Triples are grouped by
+        query and sorted by distance within each group.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        r2 = np.broadcast_to(np.square(np.asarray(r, dtype=np.float64)), (len(points),))
+        if not len(points) or not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        tree = self.tree
+        perm = self._morton_order(points)
+        pts, r2 = points[perm], r2[perm]
+        group = self._groups(np.searchsorted(tree.keys, morton_keys(pts, tree.center, tree.half_size)))
+        # Loose test on the fast distances, exact test below
+        slack = SLACK * (np.einsum("ij,ij->i", pts, pts) + r2 + 1.0)
+        qs, js = [], []
+        for queries, cand, d2 in self._batches(pts, r2, group):
+            g, a, c = np.nonzero(d2 <= (r2 + slack)[queries][:, :, np.newaxis])
+            q = queries[g, a]
+            keep = q >= 0
+            qs.append(q[keep])
+            js.append(cand[g, c][keep])
+        q, j = np.concatenate(qs), np.concatenate(js)
+        d2 = _sq_dist(pts[q], tree.pos[j])
+        within = d2 <= r2[q]
+        q, j, d2 = perm[q[within]], j[within], d2[within]
+        order = np.lexsort((d2, q))
+        return q[order], tree.order[j[order]], np.sqrt(d2[order])
+
+    def radius(self, points: np.ndarray, r) -> List[np.ndarray]:
+        """Indices of the particles within ``r`` of each query point, nearest first."""
+        q, idx, _ = self.radius_pairs(points, r)
+        bounds = np.searchsorted(q, np.arange(len(np.asarray(points).reshape(-1, 3)) + 1))
+        return np.split(idx, bounds[1:-1])
+
+    def knn(self, k: int, points: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Distances and indices ``(m, k)`` of the ``k`` nearest particles, nearest first.
+
+        Without ``points`` every indexed particle is queried and excluded from
+        its own neighbors.
+        """
+        tree = self.tree
+        n = len(self)
+        own = points is None
+        if k < 1 or k > n - own:
+            raise ValueError("k must be between 1 and %d" % (n - own))
+        if own:
+            # The particles are stored in Morton order already
+            pts = tree.pos
+            p = np.arange(n)
+        else:
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+            perm = self._morton_order(points)
+            pts = points[perm]
+            p = np.searchsorted(tree.keys, morton_keys(pts, tree.center, tree.half_size))
+        # Any k particles bound the distance of the k-th neighbor; the Morton
+        # neighbors of a point are usually close to it
+        w = min(n, 2 * k + 1)
+        window = np.clip(p - k, 0, n - w)[:, np.newaxis] + np.arange(w)
+        d = tree.pos[window] - pts[:, np.newaxis]
+        d2 = np.einsum("ijk,ijk->ij", d, d)
+        if own:
+            d2[window == p[:, np.newaxis]] = np.inf
+        bound = np.partition(d2, k - 1, axis=1)[:, k - 1]
+        bound += SLACK * (np.einsum("ij,ij->i", pts, pts) + bound + 1.0)
+
+        # With its own particle among the candidates a query needs one more
+        take = min(k + own, n)
+        dist = np.empty((len(pts), k))
+        idx = np.empty((len(pts), k), dtype=np.int64)
+        for queries, cand, d2 in self._batches(pts, bound, self._groups(p)):
+            valid = queries >= 0
+            q = queries[valid]
+            nearest = np.take_along_axis(np.broadcast_to(cand[:, np.newaxis], d2.shape),
+                                         np.argpartition(d2, take - 1, axis=2)[:, :, :take], axis=2)[valid]
+            near_d2 = np.einsum("qkj,qkj->qk", tree.pos[nearest] - pts[q][:, np.newaxis],
+                                tree.pos[nearest] - pts[q][:, np.newaxis])
+            if own:
+                near_d2[nearest == q[:, np.newaxis]] = np.inf
+            order = np.argsort(near_d2, axis=1, kind="stable")[:, :k]
+            dist[q] = np.sqrt(np.take_along_axis(near_d2, order, axis=1))
+            idx[q] = np.take_along_axis(nearest, order, axis=1)
+        idx = tree.order[idx]
+        if own:
+            # Rows are in sorted order; return them in the original order
+            return dist[tree.rank], idx[tree.rank]
+        inverse = np.empty_like(perm)
+        inverse[perm] = np.arange(len(perm))
+        return dist[inverse], idx[inverse]
+
+    def density(self, k: int = 32) -> np.ndarray:
+        """Mass density at every particle from its ``k`` nearest neighbors.
+
+        The mass of the particle and its neighbors divided by the volume of
+        the sphere reaching the k-th neighbor, in the original order.
+        """
+        dist, idx = self.knn(k)
+        mass = np.zeros(len(self))
+        mass[self.tree.order] = self.tree.pmass
+        enclosed = mass + mass[idx].sum(axis=1)
+        with np.errstate(divide="ignore"):
+            return enclosed / (4.0 / 3.0 * math.pi * dist[:, -1] ** 3)
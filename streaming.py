@@ -0,0 +1,291 @@
+"""Stream snapshots of a running simulation to any number of consumers.
+
+A :class:`FrameStream` steps a :class:`nbody.BarnesHutSimulation` on a
+background thread and hands read-only :class:`Snapshot` copies to its
+subscribers. Every :class:`Subscription` has its own bounded queue, its own
+``stride`` and a policy for a full queue:
+
+- ``"block"`` makes the producer wait for the consumer, so no snapshot is
+  lost (recorders, analysis),
+- ``"drop"`` discards the oldest queued snapshot, so a slow consumer only
+  ever lags by ``maxsize`` snapshots and never holds up the run (displays).
+
+Subscriptions are iterators and async iterators; iteration ends when the
+producer has finished and the queue is drained. An exception raised by the
+simulation is re-raised in every consumer at that point. Consumers must not
+touch the simulation itself while it is being streamed.
+"""
+
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass
+from queue import Empty
+from typing import Callable, List, Optional
+
+import numpy as np
+
+POLICIES = ("block", "drop")
+
+# Longest an async consumer's executor thread waits for a snapshot at once
+ASYNC_POLL = 0.1
+
+_END = object()
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """Copy of the particle state after ``step`` steps.
+
+    Has the ``pos``/``vel``/``mass`` attributes of a particle set, so it can
+    be passed to :meth:`recorder.SimulationRecorder.add_frame` directly.
+    ``density`` holds the k-nearest-neighbor densities if the stream was
+    asked for them (see :class:`FrameStream`).
+    """
+
+    step: int
+    time: float
+    pos: np.ndarray
+    vel: np.ndarray
+    mass: np.ndarray
+    density: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.pos)
+
+
+def snapshot(sim, density_neighbors: int = 0) -> Snapshot:
+    ps = sim.particles
+    arrays = [ps.pos.copy(), ps.vel.copy(), ps.mass.copy()]
+    if density_neighbors and len(ps) > 1:
+        # Reuses the tree of the last step, see BarnesHutSimulation.spatial_index
+        arrays.append(sim.densities(min(density_neighbors, len(ps) - 1)))
+    for array in arrays:
+        array.flags.writeable = False  # shared by all subscribers
+    return Snapshot(sim.step_count, sim.time, *arrays)
+
+
+class Subscription:
+    """Bounded queue of snapshots for one consumer (see :meth:`FrameStream.subscribe`)."""
+
+    def __init__(self, stream: "FrameStream", stride: int = 1, maxsize: int = 8, policy: str = "block"):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %r (choose from %s)" % (policy, ", ".join(POLICIES)))
+        if stride < 1 or maxsize < 1:
+            raise ValueError("stride and maxsize must be at least 1")
+        self.stream = stream
+        self.stride = stride
+        self.maxsize = maxsize
+        self.policy = policy
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+
+    def _put(self, item, stop: threading.Event):
+        with self._cond:
+            while self.policy == "block" and len(self._queue) >= self.maxsize and not (self.closed or stop.is_set()):
+                self._cond.wait(0.1)
+            if self.closed:
+                return
+            if len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(item)
+            self._cond.notify_all()
+
+    def _finish(self):
+        with self._cond:
+            self._queue.append(_END)
+            self._cond.notify_all()
+
+    def _get(self, timeout: Optional[float] = None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queue, timeout):
+                raise Empty
+            item = self._queue[0]
+            if item is not _END:
+                self._queue.popleft()
+                self.delivered += 1
+                self._cond.notify_all()
+            return item
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Snapshot]:
+        """Next snapshot, or ``None`` once the stream has ended.
+
+        Raises :class:`queue.Empty` if nothing arrives within ``timeout``.
+        """
+        item = self._get(timeout)
+        if item is _END:
+            self.stream._raise()
+            return None
+        return item
+
+    def latest(self) -> Optional[Snapshot]:
+        """Newest queued snapshot without waiting, discarding older ones; ``None`` if none."""
+        with self._cond:
+            frames = [item for item in self._queue if item is not _END]
+            if not frames:
+                return None
+            self.dropped += len(frames) - 1
+            self.delivered += 1
+            self._queue = deque(item for item in self._queue if item is _END)
+            self._cond.notify_all()
+            return frames[-1]
+
+    def close(self):
+        """Stop receiving snapshots; the producer stops when its last subscriber closes."""
+        with self._cond:
+            self.closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        self.stream._unsubscribe(self)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            self.close()
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # Wait in short slices on an executor thread (run_in_executor
+                # rather than asyncio.to_thread, which needs Python 3.9), so a
+                # cancelled consumer releases the thread soon
+                try:
+                    item = await loop.run_in_executor(None, self._get, ASYNC_POLL)
+                except Empty:
+                    continue
+                if item is _END:
+                    self.stream._raise()
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameStream:
+    """Step ``sim`` on a background thread and publish snapshots to subscribers.
+
+    Runs ``iterations`` steps (forever if ``None``) or until :meth:`stop` is
+    called or every subscription is closed. A snapshot of the initial state
+    (step ``sim.step_count``) is published first. Snapshots are only copied
+    for steps that at least one subscriber wants. With ``close_sim`` the
+    simulation is closed when the producer finishes. While
+    ``density_neighbors`` is nonzero (it may be changed during the run),
+    snapshots carry densities from that many neighbors, computed on the
+    producer thread.
+    """
+
+    def __init__(self, sim, iterations: Optional[int] = None, close_sim: bool = False,
+                 density_neighbors: int = 0):
+        self.sim = sim
+        self.iterations = iterations
+        self.close_sim = close_sim
+        self.density_neighbors = density_neighbors
+        self._subscriptions: List[Subscription] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._started = False
+
+    def subscribe(self, stride: int = 1, maxsize: int = 8, policy: str = "block") -> Subscription:
+        """New consumer receiving every ``stride``-th step.
+
+        Subscribe before :meth:`start` to receive the initial snapshot.
+        """
+        sub = Subscription(self, stride, maxsize, policy)
+        with self._lock:
+            self._subscriptions.append(sub)
+        return sub
+
+    def attach(self, consumer: Callable[[Snapshot], None], stride: int = 1, maxsize: int = 8,
+               policy: str = "block") -> threading.Thread:
+        """Call ``consumer`` with every snapshot on a thread of its own.
+
+        For example ``stream.attach(lambda s: recorder.add_frame(s, s.step, s.time))``
+        records without putting the writes on the step loop.
+        """
+        sub = self.subscribe(stride, maxsize, policy)
+
+        def run():
+            for snap in sub:
+                consumer(snap)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _unsubscribe(self, sub: Subscription):
+        with self._lock:
+            if sub in self._subscriptions:
+                self._subscriptions.remove(sub)
+            if not self._subscriptions and self._started:
+                self._stop.set()
+
+    def _publish(self):
+        with self._lock:
+            subs = [s for s in self._subscriptions if self.sim.step_count % s.stride == 0]
+        if subs:
+            snap = snapshot(self.sim, self.density_neighbors)
+            for sub in subs:
+                sub._put(snap, self._stop)
+
+    def _run(self):
+        try:
+            self._publish()
+            done = 0
+            while not self._stop.is_set() and (self.iterations is None or done < self.iterations):
+                self.sim.step()
+                done += 1
+                self._publish()
+        except BaseException as exc:  # re-raised in the consumers
+            self._error = exc
+        finally:
+            if self.close_sim:
+                self.sim.close()
+            with self._lock:
+                subs = list(self._subscriptions)
+            for sub in subs:
+                sub._finish()
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+    def start(self) -> "FrameStream":
+        self._started = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Ask the producer to stop after the current step."""
+        self._stop.set()
+
+    def join(self, timeout: Optional[float] = None):
+        self._thread.join(timeout)
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        self.join()
@@ -0,0 +1,246 @@
+"""Run a grid of :class:`nbody.BarnesHutSimulation` configurations in parallel.
+
+The grid file (TOML or JSON) has a ``base`` table of settings shared by all
+runs, a ``grid`` table whose lists are combined as a cartesian product and an
+optional ``limits`` table::
+
+    [base]
+    num_particles = 2000
+    iterations = 200
+    integrator = "leapfrog"
+
+    [grid]
+    theta = [0.3, 0.5, 0.8]
+    eps = [0.02, 0.05]
+    seed = [0, 1, 2]
+
+    [limits]
+    memory_mb = 2048
+    cpu_seconds = 600
+
+``iterations`` and ``diagnostics_every`` control the run; every other key is
+passed to ``BarnesHutSimulation``. Each run executes in a fresh worker
+process under its own resource limits, and its result (parameters, status,
+timings and diagnostics series) is appended to a JSON Lines table as soon as
+it finishes. Runs whose id is already recorded as ``ok`` in that table are
+skipped, so an interrupted sweep resumes where it stopped.
+"""
+
+import argparse
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import resource
+import signal
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from multiprocessing import get_context
+from typing import Dict, Iterable, List, Optional, Tuple
+
+RUN_KEYS = ("iterations", "diagnostics_every")
+
+# Pool workers can only be replaced after every task from Python 3.11 on
+RECYCLE_WORKERS = sys.version_info >= (3, 11)
+
+
+def load_grid(path: str) -> Tuple[Dict, Dict, Dict]:
+    """Read ``(base, grid, limits)`` from a TOML or JSON file."""
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+
+        with open(path, "rb") as f:
+            spec = tomllib.load(f)
+    else:
+        with open(path) as f:
+            spec = json.load(f)
+    return spec.get("base", {}), spec.get("grid", {}), spec.get("limits", {})
+
+
+def run_id(params: Dict) -> str:
+    """Stable id of a configuration, independent of key order."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def expand(base: Dict, grid: Dict) -> List[Dict]:
+    """All configurations of the grid, each merged over ``base``."""
+    from nbody import BarnesHutSimulation
+
+    allowed = set(inspect.signature(BarnesHutSimulation).parameters) | set(RUN_KEYS)
+    keys = sorted(grid)
+    unknown = (set(base) | set(keys)) - allowed
+    if unknown:
+        raise ValueError("unknown sweep parameters: %s" % ", ".join(sorted(unknown)))
+    runs = []
+    for values in itertools.product(*(grid[k] for k in keys)):
+        params = dict(base, **dict(zip(keys, values)))
+        runs.append(params)
+    return runs
+
+
+class RunLimitExceeded(Exception):
+    pass
+
+
+def _limit_handler(signum, frame):
+    raise RunLimitExceeded(signal.Signals(signum).name)
+
+
+def _apply_limits(limits: Dict):
+    memory = limits.get("memory_mb")
+    if memory:
+        size = int(memory) << 20
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+    cpu = limits.get("cpu_seconds")
+    if cpu:
+        # The soft limit raises SIGXCPU, turned into an exception below; the
+        # hard limit kills a run that ignores it
+        signal.signal(signal.SIGXCPU, _limit_handler)
+        resource.setrlimit(resource.RLIMIT_CPU, (int(cpu), int(cpu) + 5))
+    wall = limits.get("wall_seconds")
+    if wall:
+        signal.signal(signal.SIGALRM, _limit_handler)
+        signal.alarm(int(wall))
+
+
+def execute(params: Dict, limits: Optional[Dict] = None) -> Dict:
+    """Run one configuration and summarize it; meant for a fresh process.
+
+    Errors, including exceeded limits, are reported in the result instead of
+    being raised, so one failing run never stops the sweep.
+    """
+    from nbody import BarnesHutSimulation
+    from profiling import Profiler
+
+    result = {"run_id": run_id(params), "params": params, "pid": os.getpid()}
+    t0 = time.perf_counter()
+    try:
+        _apply_limits(limits or {})
+        kwargs = {k: v for k, v in params.items() if k not in RUN_KEYS}
+        iterations = int(params.get("iterations", 100))
+        every = int(params.get("diagnostics_every", max(1, iterations // 10)))
+        profiler = Profiler()
+        with BarnesHutSimulation(diagnostics_every=every, profiler=profiler, **kwargs) as sim:
+            start = sim.record_diagnostics()
+            for _ in range(iterations):
+                sim.step()
+            # The drift is measured on the final state even if it was not due
+            if sim.diagnostics[-1].step != sim.step_count:
+                sim.record_diagnostics()
+        totals = profiler.totals()
+        end = sim.diagnostics[-1]
+        result.update(
+            status="ok",
+            steps=iterations,
+            step_s=totals.wall / max(iterations, 1),
+            phases_s=totals.phases,
+            interactions_per_step=(totals.particle_node + totals.particle_particle) / max(iterations, 1),
+            energy_drift=(end.energy - start.energy) / abs(start.energy) if start.energy else 0.0,
+            diagnostics=[[d.step, d.time, d.kinetic, d.potential] for d in sim.diagnostics],
+        )
+    except Exception as exc:
+        result.update(status="failed", error="%s: %s" % (type(exc).__name__, exc))
+    finally:
+        signal.alarm(0)
+    result["wall_s"] = time.perf_counter() - t0
+    return result
+
+
+def completed(path: str) -> set:
+    """Ids of runs recorded as successful in a results table."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interruption
+            if record.get("status") == "ok":
+                done.add(record["run_id"])
+    return done
+
+
+def run_sweep(runs: Iterable[Dict], results: str, workers: Optional[int] = None,
+              limits: Optional[Dict] = None, log=None) -> List[Dict]:
+    """Execute ``runs`` on a process pool, appending each result to ``results``.
+
+    Every run gets a fresh worker process, so resource limits and memory use
+    do not carry over between runs. Returns the results of this invocation.
+    """
+    done = completed(results)
+    todo = [p for p in runs if run_id(p) not in done]
+    if log:
+        log("%d runs, %d already done" % (len(todo) + len(done), len(done)))
+    out = []
+    if not todo:
+        return out
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    with open(results, "a") as table:
+        for result in _execute_all(todo, workers, limits):
+            table.write(json.dumps(result) + "\n")
+            table.flush()
+            out.append(result)
+            if log:
+                log(_format(result))
+    return out
+
+
+def _execute_all(todo: List[Dict], workers: int, limits: Optional[Dict]):
+    """Yield the results of ``todo`` as they finish, each run in a fresh process."""
+    context = get_context("spawn")
+    if RECYCLE_WORKERS:
+        with ProcessPoolExecutor(workers, mp_context=context, max_tasks_per_child=1) as pool:
+            for future in as_completed([pool.submit(execute, p, limits) for p in todo]):
+                yield future.result()
+        return
+    # Without worker recycling every run gets a single-use pool, with at
+    # most ``workers`` of them running at a time
+    queue = iter(todo)
+    pending = set()
+    while True:
+        for params in itertools.islice(queue, workers - len(pending)):
+            pool = ProcessPoolExecutor(1, mp_context=context)
+            pending.add(pool.submit(execute, params, limits))
+            pool.shutdown(wait=False)
+        if not pending:
+            return
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def _format(result: Dict) -> str:
+    params = " ".join("%s=%s" % (k, result["params"][k]) for k in sorted(result["params"]))
+    if result["status"] != "ok":
+        return "%s FAILED %s  [%s]" % (result["run_id"], result["error"], params)
+    return "%s ok  %.4f s/step  drift %+.2e  [%s]" % (result["run_id"], result["step_s"],
+                                                        result["energy_drift"], params)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of Barnes-Hut simulations")
+    parser.add_argument("grid", help="Grid file (.toml or .json)")
+    parser.add_argument("-o", "--results", default="sweep.jsonl", help="Results table (JSON Lines, appended to)")
+    parser.add_argument("--workers", type=int, default=None, help="Concurrent runs (default: all cores)")
+    parser.add_argument("--memory-mb", type=float, default=None, help="Address space limit per run")
+    parser.add_argument("--cpu-seconds", type=float, default=None, help="CPU time limit per run")
+    parser.add_argument("--wall-seconds", type=float, default=None, help="Wall-clock limit per run")
+    args = parser.parse_args(argv)
+
+    base, grid, limits = load_grid(args.grid)
+    for key in ("memory_mb", "cpu_seconds", "wall_seconds"):
+        if getattr(args, key) is not None:
+            limits[key] = getattr(args, key)
+    results = run_sweep(expand(base, grid), args.results, args.workers, limits, log=print)
+    return 1 if any(r["status"] != "ok" for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
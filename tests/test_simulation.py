@@ -1,10 +1,39 @@
+import asyncio
 import os
 import sys
 import unittest
 import random
+import tempfile
+
+import numpy as np
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))  # noqa: E402
-from nbody import BarnesHutSimulation, compute_total_energy  # noqa: E402
+from checkpoint import Checkpointer  # noqa: E402
+from backends import available_backends  # noqa: E402
+from benchmark import BenchmarkConfig, compare, configurations, run_case  # noqa: E402
+from nbody import (  # noqa: E402
+    BarnesHutSimulation,
+    compute_potential_energy,
+    compute_total_energy,
+    compute_total_momentum,
+    direct_accelerations,
+)
+from distributed import DistributedSimulation  # noqa: E402
+from initial_conditions import MODELS, generate  # noqa: E402
+from octree import LinearOctree  # noqa: E402
+from particles import ParticleSet  # noqa: E402
+from profiling import Profiler  # noqa: E402
+from recorder import Recording, SimulationRecorder  # noqa: E402
+from render import density_colors, rasterize  # noqa: E402
+from spatial import SpatialIndex  # noqa: E402
+from streaming import FrameStream  # noqa: E402
+from sweep import expand, run_sweep  # noqa: E402
+from tuning import AutoTuner, force_errors  # noqa: E402
+
+try:
+    import torch
+except ImportError:  # pragma: no cover - optional dependency
+    torch = None
 
 
 class TestSimulation(unittest.TestCase):
@@ -16,6 +45,483 @@ class TestSimulation(unittest.TestCase):
         e1 = compute_total_energy(sim.particles, eps=sim.eps)
         self.assertAlmostEqual(e0, e1, delta=10.0)
 
+    def test_particle_views_write_through(self):
+        random.seed(0)
+        sim = BarnesHutSimulation(num_particles=10)
+        self.assertIsInstance(sim.particles, ParticleSet)
+        p = sim.particles[3]
+        p.vx = 2.0
+        self.assertEqual(sim.particles.vel[3, 0], 2.0)
+        self.assertIs(sim.particles[3], p)
+        px, _, _ = compute_total_momentum(sim.particles)
+        self.assertAlmostEqual(px, sum(q.mass * q.vx for q in sim.particles))
+
+    def test_linear_octree_matches_direct(self):
+        random.seed(1)
+        sim = BarnesHutSimulation(num_particles=300)
+        exact = sim._direct_forces()
+        tree = LinearOctree(sim.particles.pos, sim.particles.mass, leaf_size=8)
+        self.assertAlmostEqual(tree.mass[0], sim.particles.mass.sum())
+        approx = tree.accelerations(theta=0.5, eps=sim.eps)
+        err = np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)
+        self.assertLess(np.median(err), 0.05)
+        exact_tree = tree.accelerations(theta=0.0, eps=sim.eps)
+        np.testing.assert_allclose(exact_tree, exact, rtol=1e-9, atol=1e-9)
+
+    def test_group_walk_is_accurate(self):
+        random.seed(1)
+        sim = BarnesHutSimulation(num_particles=300, mode="group")
+        exact = sim._direct_forces()
+        approx = sim._compute_forces()
+        err = np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)
+        self.assertLess(np.median(err), 0.05)
+        tree = sim._build_tree()
+        subset = np.array([7, 3, 250])
+        np.testing.assert_array_equal(
+            tree.accelerations(sim.theta, eps=sim.eps, mode="group", targets=subset),
+            tree.accelerations(sim.theta, eps=sim.eps, mode="group")[subset],
+        )
+
+    def test_tree_energy_and_diagnostics_series(self):
+        random.seed(4)
+        sim = BarnesHutSimulation(num_particles=400, integrator="leapfrog", diagnostics_every=2)
+        exact = compute_potential_energy(sim.particles, eps=sim.eps)
+        estimate = compute_potential_energy(sim.particles, eps=sim.eps, method="tree", theta=0.3)
+        self.assertAlmostEqual(estimate / exact, 1.0, delta=0.01)
+        for _ in range(4):
+            sim.step()
+        self.assertEqual([r.step for r in sim.diagnostics], [2, 4])
+        self.assertAlmostEqual(sim.diagnostics[-1].time, 4 * sim.dt)
+
+    def test_leapfrog_reuses_accelerations(self):
+        random.seed(5)
+        sim = BarnesHutSimulation(num_particles=50, integrator="leapfrog")
+        sim.step()
+        np.testing.assert_allclose(sim.accelerations, sim._compute_forces())
+
+    def test_block_timesteps(self):
+        random.seed(6)
+        plain = BarnesHutSimulation(num_particles=50, dt=1e-6, integrator="leapfrog")
+        random.seed(6)
+        block = BarnesHutSimulation(num_particles=50, dt=1e-6, integrator="leapfrog", timestep_levels=3)
+        plain.step()
+        block.step()
+        # Tiny steps keep every particle on the coarsest level, which is
+        # plain kick-drift-kick leapfrog
+        self.assertEqual(block.levels.max(), 0)
+        np.testing.assert_allclose(block.particles.pos, plain.particles.pos, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(block.particles.vel, plain.particles.vel, rtol=1e-9)
+
+        random.seed(6)
+        sim = BarnesHutSimulation(num_particles=50, dt=0.01, integrator="leapfrog", timestep_levels=3)
+        sim.step()
+        sim.step()
+        self.assertGreater(sim.levels.max(), 0)
+        self.assertLessEqual(sim.levels.max(), 3)
+        self.assertTrue(np.isfinite(sim.particles.pos).all())
+
+    def test_tree_refit_between_steps(self):
+        random.seed(7)
+        sim = BarnesHutSimulation(num_particles=300, dt=1e-5, integrator="leapfrog")
+        sim.step()
+        tree = sim.tree
+        sim.step()
+        self.assertIs(sim.tree, tree)
+        self.assertTrue(tree.contains(sim.particles.pos))
+        fresh = LinearOctree(sim.particles.pos, sim.particles.mass)
+        np.testing.assert_allclose(tree.mass[0], fresh.mass[0])
+        np.testing.assert_allclose(tree.com[0], fresh.com[0])
+        exact = sim._direct_forces()
+        err = np.linalg.norm(sim.accelerations - exact, axis=1) / np.linalg.norm(exact, axis=1)
+        self.assertLess(np.median(err), 0.05)
+
+        # Particles leaving the root cube force a rebuild with a larger root
+        sim.particles.pos *= 4.0
+        sim._build_tree()
+        self.assertIsNot(sim.tree, tree)
+        self.assertGreater(sim.tree.half_size, tree.half_size)
+
+    def test_streaming_recording(self):
+        random.seed(8)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "run.bin")
+            rec = SimulationRecorder(20, path=path, every=2, velocities=True, masses=True)
+            sim = BarnesHutSimulation(num_particles=20, recorder=rec)
+            for _ in range(3):
+                sim.step()
+            # The first frame is on disk before the recorder is closed
+            self.assertEqual(len(Recording(path)), 1)
+            sim.close()
+            recording = Recording(path)
+            self.assertEqual(len(recording), 2)
+            self.assertEqual(recording.steps.tolist(), [1, 3])
+            np.testing.assert_allclose(recording[-1], sim.particles.pos, rtol=1e-6)
+            np.testing.assert_allclose(recording.velocities[-1], sim.particles.vel, rtol=1e-6)
+            np.testing.assert_array_equal(recording.masses, sim.particles.mass)
+
+            memory = SimulationRecorder(20, every=2)
+            sim.recorder = memory
+            sim.step()
+            memory.save(path)
+            loaded = SimulationRecorder.load(path)
+            np.testing.assert_array_equal(loaded.frames[0], memory.frames[0])
+            self.assertEqual(loaded.every, 2)
+
+            # Recorders that only take the particles and have no close() still work
+            class Frames(list):
+                def add_frame(self, particles):
+                    self.append(particles.pos.copy())
+
+            sim.recorder = Frames()
+            sim.step()
+            sim.close()
+            self.assertEqual(len(sim.recorder), 1)
+            del recording, loaded
+
+    def test_frame_stream_subscribers(self):
+        sim = BarnesHutSimulation(num_particles=100, seed=5, integrator="leapfrog")
+        self.assertEqual([snap.step for snap in sim.stream(7, stride=3)], [0, 3, 6])
+
+        reference = BarnesHutSimulation(num_particles=100, seed=6)
+        reference.run(12)
+        sim = BarnesHutSimulation(num_particles=100, seed=6)
+        stream = FrameStream(sim, iterations=12)
+        every = stream.subscribe(policy="block", maxsize=2)
+        latest = stream.subscribe(policy="drop", maxsize=1, stride=2)
+        rec = SimulationRecorder(100)
+        consumer = stream.attach(lambda s: rec.add_frame(s, s.step, s.time), stride=4)
+        stream.start()
+        snaps = list(every)
+        consumer.join()
+        self.assertEqual([s.step for s in snaps], list(range(13)))
+        np.testing.assert_array_equal(snaps[-1].pos, reference.particles.pos)
+        self.assertFalse(snaps[-1].pos.flags.writeable)
+        self.assertEqual(rec.steps, [0, 4, 8, 12])
+        # The dropping subscriber was never read while the run went on
+        self.assertEqual(latest.get().step, 12)
+        self.assertEqual(latest.dropped, 6)
+        self.assertIsNone(latest.get())
+
+        # Densities are computed by the producer when asked for
+        sim = BarnesHutSimulation(num_particles=100, seed=6, mode="group")
+        stream = FrameStream(sim, iterations=2, density_neighbors=8)
+        sub = stream.subscribe()
+        stream.start()
+        snaps = list(sub)
+        np.testing.assert_array_equal(snaps[-1].density, sim.densities(8))
+
+        # Leaving an async for early closes the subscription and stops the run
+        async def first(sub):
+            async for snap in sub:
+                break
+            await asyncio.sleep(0.3)
+            return snap, sub.closed, sub.stream.running
+
+        sim = BarnesHutSimulation(num_particles=50, seed=5)
+        snap, closed, running = asyncio.run(first(sim.stream(50, maxsize=2)))
+        self.assertEqual(snap.step, 0)
+        self.assertTrue(closed)
+        self.assertFalse(running)
+        self.assertLess(sim.step_count, 50)
+
+    def test_rasterize_modes(self):
+        pos = np.array([[0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, -1.0, 0.5], [5.0, 0.0, 0.0]])
+        points = rasterize(pos, size=21, mode="points")
+        self.assertEqual(int((points.sum(axis=2) > 0).sum()), 2)
+        additive = rasterize(pos, size=21, mode="additive")
+        self.assertTrue((additive[10, 10] >= points[10, 10]).all())
+        density = rasterize(pos, size=21, mode="density")
+        self.assertEqual(density[10, 10].tolist(), [255, 255, 255])
+        self.assertEqual(density[0, 0].tolist(), [0, 0, 0])
+
+    def test_process_pool_matches_serial(self):
+        random.seed(2)
+        with BarnesHutSimulation(num_particles=200, workers=2) as sim:
+            parallel = sim._compute_forces()
+            serial = sim._build_tree().accelerations(sim.theta, eps=sim.eps)
+        np.testing.assert_array_equal(parallel, serial)
+
+    def test_quadrupole_moments(self):
+        random.seed(3)
+        sim = BarnesHutSimulation(num_particles=400, eps=0.01, model="plummer")
+        exact = sim._direct_forces()
+        errors = {}
+        for quadrupole in (False, True):
+            tree = LinearOctree(sim.particles.pos, sim.particles.mass, quadrupole=quadrupole)
+            for mode in ("particle", "group"):
+                approx = tree.accelerations(theta=0.5, eps=sim.eps, mode=mode)
+                err = np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)
+                errors[quadrupole, mode] = np.median(err)
+        self.assertLess(errors[True, "particle"], 0.5 * errors[False, "particle"])
+        self.assertAlmostEqual(errors[True, "particle"], errors[True, "group"], delta=0.01)
+        with BarnesHutSimulation(num_particles=200, quadrupole=True, workers=2) as sim:
+            parallel = sim._compute_forces()
+            serial = sim._build_tree().accelerations(sim.theta, eps=sim.eps)
+        np.testing.assert_array_equal(parallel, serial)
+
+    def test_auto_tuner_meets_target(self):
+        tuner = AutoTuner(target=0.02, percentile=90, sample=100, every=2, leaf_sizes=(4, 8))
+        sim = BarnesHutSimulation(num_particles=400, model="plummer", seed=4, integrator="leapfrog",
+                                  tuner=tuner)
+        sim.run(3)
+        self.assertEqual([r.step for r in tuner.history], [0, 2])
+        result = tuner.history[-1]
+        self.assertTrue(result.met)
+        self.assertEqual((sim.theta, sim.leaf_size), (result.theta, result.leaf_size))
+        # The choice is the cheapest candidate meeting the target
+        cheaper = [c for c in result.candidates if c.cost < result.cost]
+        self.assertTrue(all(c.error > 0.02 for c in cheaper))
+        sample = np.arange(0, 400, 7)
+        exact = direct_accelerations(sim.particles.pos, sim.particles.mass, eps=sim.eps, targets=sample)
+        tree = LinearOctree(sim.particles.pos, sim.particles.mass, leaf_size=sim.leaf_size)
+        self.assertLess(np.percentile(force_errors(tree, exact, sample, sim.theta, sim.eps), 90), 0.04)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tuned.npz")
+            sim.save_checkpoint(path)
+            tuner = AutoTuner(target=0.02, percentile=90, sample=100, every=2, leaf_sizes=(4, 8))
+            resumed = BarnesHutSimulation.from_checkpoint(path, tuner=tuner)
+        resumed.step()
+        self.assertEqual(tuner.history, [])
+        resumed.step()
+        self.assertEqual([r.step for r in tuner.history], [4])
+
+    def test_distributed_matches_single_tree(self):
+        params = dict(seed=7, model="plummer", model_params={"total_mass": 1.0}, eps=0.02)
+        single = BarnesHutSimulation(num_particles=600, **params)
+        with DistributedSimulation(600, ranks=3, imbalance=1.0, **params) as sim:
+            pos, _, mass, acc = sim.gather()
+            # Ranks recenter with summed per-rank moments, so only rounding differs
+            np.testing.assert_allclose(pos, single.particles.pos, rtol=0, atol=1e-12)
+            exact = direct_accelerations(pos, mass, eps=sim.eps)
+            err = np.linalg.norm(acc - exact, axis=1) / np.linalg.norm(exact, axis=1)
+            single_err = np.linalg.norm(single._compute_forces() - exact, axis=1) / np.linalg.norm(exact, axis=1)
+            self.assertLessEqual(np.median(err), np.median(single_err) * 1.05)
+            owned = sim.counts()
+            self.assertEqual(sum(owned), 600)
+            self.assertTrue(all(150 < n < 250 for n in owned))
+            exact_energy = compute_total_energy(sim.particles, eps=sim.eps)
+            self.assertLess(abs(sim.energy() - exact_energy), 0.01 * abs(exact_energy))
+            rebalances = sim.rebalances
+            for _ in range(3):
+                sim.step()
+            # imbalance=1.0 rebalances whenever the work differs at all
+            self.assertGreater(sim.rebalances, rebalances)
+            self.assertEqual(len(sim.particles), 600)
+
+    @unittest.skipIf(torch is None, "PyTorch is not installed")
+    def test_tensor_octree_matches_direct(self):
+        import gpu_sim
+
+        pos, vel, mass = gpu_sim.generate_spiral_galaxy(300, device="cpu", seed=0)
+        pos, mass = pos.double(), mass.double()
+        tree = gpu_sim.TensorOctree(pos, mass, leaf_size=4)
+        exact = direct_accelerations(pos.numpy(), mass.numpy(), eps=0.05)
+        np.testing.assert_allclose(tree.accelerations(0.0, eps=0.05, batch=64).numpy(), exact, rtol=1e-9, atol=1e-9)
+        approx = tree.accelerations(0.5, eps=0.05).numpy()
+        err = np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)
+        self.assertLess(np.median(err), 0.1)
+
+    @unittest.skipIf(torch is None, "PyTorch is not installed")
+    def test_tiled_direct_summation(self):
+        import gpu_sim
+
+        pos, vel, mass = (t.double() for t in gpu_sim.generate_spiral_galaxy(200, device="cpu", seed=1))
+        exact = direct_accelerations(pos.numpy(), mass.numpy(), eps=0.05)
+        # A tiny budget forces many small tiles
+        tiled = gpu_sim.direct_accelerations(pos, mass, eps=0.05, memory_budget=4096)
+        np.testing.assert_allclose(tiled.numpy(), exact, rtol=1e-10, atol=1e-10)
+        mixed = gpu_sim.direct_accelerations(pos, mass, eps=0.05, compute_dtype=torch.float32)
+        self.assertEqual(mixed.dtype, torch.float64)
+        np.testing.assert_allclose(mixed.numpy(), exact, rtol=1e-4, atol=1e-3)
+        ps = ParticleSet(pos.numpy(), vel.numpy(), mass.numpy())
+        self.assertAlmostEqual(gpu_sim.potential_energy(pos, mass, memory_budget=4096),
+                               compute_potential_energy(ps, eps=0.05), delta=1e-6)
+
+    @unittest.skipIf(torch is None, "PyTorch is not installed")
+    def test_gpu_kernels_attract(self):
+        import gpu_sim
+
+        pos = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=torch.float64)
+        mass = torch.ones(2, dtype=torch.float64)
+        for acc in (gpu_sim.direct_accelerations(pos, mass, eps=0.05),
+                    gpu_sim.TensorOctree(pos, mass, leaf_size=1).accelerations(0.5, eps=0.05)):
+            self.assertGreater(acc[0, 0].item(), 0.0)
+            self.assertLess(acc[1, 0].item(), 0.0)
+        vel = torch.zeros_like(pos)
+        gpu_sim.step_direct(pos, vel, mass, 0.01)
+        self.assertLess(float(pos[1, 0] - pos[0, 0]), 1.0)
+
+    def test_benchmark_case_and_baseline(self):
+        result = run_case(BenchmarkConfig("nbody-bh", 64, theta=0.5, steps=3, warmup=0))
+        self.assertEqual(len(result["times"]), 3)
+        self.assertGreater(result["particles_per_s"], 0)
+        slower = dict(result, median_s=result["median_s"] * 2)
+        (row,) = compare([slower], [result], tolerance=0.1)
+        self.assertTrue(row["regression"])
+        self.assertFalse(compare([result], [result])[0]["regression"])
+        configs = configurations(["nbody-bh", "nbody-direct"], [100], [0.5], [1, 4], ["euler"])
+        self.assertEqual([(c.case, c.threads) for c in configs],
+                         [("nbody-bh", 1), ("nbody-bh", 4), ("nbody-direct", 1)])
+
+    def test_profiler_phases_and_counters(self):
+        random.seed(3)
+        seen = []
+        profiler = Profiler(callback=seen.append)
+        sim = BarnesHutSimulation(num_particles=300, mode="group", integrator="leapfrog", profiler=profiler)
+        sim.step()
+        sim.step()
+        self.assertEqual([s.step for s in seen], [1, 2])
+        stats = profiler.history[-1]
+        self.assertGreater(stats.particle_node + stats.particle_particle, 0)
+        self.assertGreater(stats.nodes_opened, 0)
+        self.assertEqual(stats.nodes, len(sim.tree))
+        self.assertGreater(stats.phases["forces"], 0.0)
+        self.assertLessEqual(sum(stats.phases.values()), stats.wall + 1e-9)
+
+        counts = {}
+        sim.tree.accelerations(sim.theta, eps=sim.eps, counts=counts)
+        self.assertGreater(counts["particle_node"] + counts["particle_particle"], 0)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "profile.csv")
+            profiler.save(path)
+            with open(path) as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+
+    def test_checkpoint_resume_is_exact(self):
+        random.seed(4)
+        full = BarnesHutSimulation(num_particles=150, integrator="leapfrog", diagnostics_every=2)
+        for _ in range(6):
+            full.step()
+        random.seed(4)
+        with tempfile.TemporaryDirectory() as tmp:
+            pattern = os.path.join(tmp, "ck-{step}.npz")
+            first = BarnesHutSimulation(num_particles=150, integrator="leapfrog", diagnostics_every=2,
+                                        checkpointer=Checkpointer(pattern, every=3))
+            for _ in range(3):
+                first.step()
+            first.close()
+            resumed = BarnesHutSimulation.from_checkpoint(pattern.format(step=3))
+            for _ in range(3):
+                resumed.step()
+            np.testing.assert_array_equal(resumed.particles.pos, full.particles.pos)
+            np.testing.assert_array_equal(resumed.particles.vel, full.particles.vel)
+            self.assertEqual(resumed.step_count, 6)
+            self.assertEqual(resumed.diagnostics, full.diagnostics)
+
+            if torch is not None:
+                import gpu_sim
+
+                pos, _ = gpu_sim.run(0, 1, 0.01, device="cpu", dtype=torch.float64,
+                                     resume=pattern.format(step=3), checkpoint=os.path.join(tmp, "gpu.npz"))
+                self.assertEqual(pos.shape, (150, 3))
+                moved = BarnesHutSimulation.from_checkpoint(os.path.join(tmp, "gpu.npz"))
+                self.assertEqual(moved.step_count, 4)
+
+    def test_initial_condition_models(self):
+        for model in MODELS:
+            pos, vel, mass = generate(model, 500, seed=7, chunk_size=128)
+            self.assertEqual(pos.shape, (500, 3))
+            self.assertTrue(np.isfinite(pos).all() and np.isfinite(vel).all())
+            np.testing.assert_allclose(mass @ vel / mass.sum(), 0.0, atol=1e-9)
+            again = generate(model, 500, seed=7, chunk_size=128)
+            np.testing.assert_array_equal(again[0], pos)
+        sim = BarnesHutSimulation(num_particles=200, model="plummer", seed=3)
+        np.testing.assert_array_equal(sim.particles.pos, generate("plummer", 200, seed=3)[0])
+        raw = BarnesHutSimulation(num_particles=200, seed=3, model_params={"recenter": False}).particles
+        self.assertGreater(np.abs(raw.mass @ raw.vel).max(), 1e-9)
+
+    def test_sweep_runs_and_resumes(self):
+        runs = expand({"num_particles": 40, "iterations": 3, "diagnostics_every": 2},
+                      {"theta": [0.5, 0.8], "seed": [1]})
+        self.assertEqual(len(runs), 2)
+        with self.assertRaises(ValueError):
+            expand({"no_such_option": 1}, {})
+        with tempfile.TemporaryDirectory() as tmp:
+            table = os.path.join(tmp, "results.jsonl")
+            results = run_sweep(runs, table, workers=2, limits={"wall_seconds": 60})
+            self.assertEqual(sorted(r["status"] for r in results), ["ok", "ok"])
+            # The final step is recorded even when it is not a multiple of diagnostics_every
+            self.assertEqual([d[0] for d in results[0]["diagnostics"]], [0, 2, 3])
+            self.assertEqual(run_sweep(runs, table, workers=2), [])
+
+    def test_spatial_queries_match_brute_force(self):
+        sim = BarnesHutSimulation(num_particles=500, model="plummer", seed=4, leaf_size=8)
+        sim.step()
+        pos = sim.particles.pos
+        index = sim.spatial_index()
+        self.assertIs(index.tree, sim.tree)
+        dist = np.linalg.norm(pos[:, None] - pos[None], axis=2)
+        np.fill_diagonal(dist, np.inf)
+        d, idx = index.knn(6)
+        np.testing.assert_allclose(d, np.sort(dist, axis=1)[:, :6])
+        np.testing.assert_array_equal(idx, np.argsort(dist, axis=1, kind="stable")[:, :6])
+
+        points = np.random.default_rng(0).normal(scale=0.5, size=(40, 3))
+        qdist = np.linalg.norm(points[:, None] - pos[None], axis=2)
+        d, idx = index.knn(3, points)
+        np.testing.assert_allclose(d, np.sort(qdist, axis=1)[:, :3])
+        for row, found in zip(qdist, index.radius(points, 0.3)):
+            self.assertEqual(sorted(found), list(np.flatnonzero(row <= 0.3)))
+            self.assertTrue(np.all(np.diff(row[found]) >= 0))
+
+        rho = sim.densities(k=8)
+        h = np.sort(dist, axis=1)[:, 7]
+        enclosed = sim.particles.mass + sim.particles.mass[np.argsort(dist, axis=1)[:, :8]].sum(axis=1)
+        np.testing.assert_allclose(rho, enclosed / (4.0 / 3.0 * np.pi * h ** 3))
+        self.assertEqual(density_colors(rho).shape, (500, 3))
+        np.testing.assert_array_equal(SpatialIndex.from_points(pos).knn(6)[1], index.knn(6)[1])
+        # Replacing the particles drops the tree; the index must rebuild it
+        sim.particles = sim.particles.copy()
+        np.testing.assert_array_equal(sim.spatial_index().knn(6)[1], index.knn(6)[1])
+
+    def test_backends_agree_and_share_the_pipeline(self):
+        final = {}
+        for backend in available_backends():
+            if backend == "cuda":
+                continue
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "run.bin")
+                recorder = SimulationRecorder(60, path)
+                sim = BarnesHutSimulation(num_particles=60, seed=5, mode="direct", integrator="leapfrog",
+                                          timestep_levels=1, diagnostics_every=2, recorder=recorder,
+                                          backend=backend)
+                for _ in range(4):
+                    sim.step()
+                recorder.close()
+                self.assertEqual(len(Recording(path)), 4)
+                self.assertEqual(len(sim.diagnostics), 2)
+                np.testing.assert_allclose(Recording(path)[-1], sim.particles.pos, rtol=1e-6)
+                sim.save_checkpoint(os.path.join(tmp, "state.npz"))
+                resumed = BarnesHutSimulation.from_checkpoint(os.path.join(tmp, "state.npz"), backend=backend)
+            sim.step()
+            resumed.step()
+            np.testing.assert_array_equal(resumed.particles.pos, sim.particles.pos)
+            final[backend] = sim.particles.pos
+        for pos in final.values():
+            np.testing.assert_allclose(pos, final["numpy"], atol=1e-12)
+        # Tree forces with non-unit masses stay close to direct summation
+        for backend in final:
+            sim = BarnesHutSimulation(num_particles=200, seed=5, mode="bh", model="plummer",
+                                      model_params={"total_mass": 1.0}, backend=backend)
+            ps = sim.particles
+            exact = direct_accelerations(ps.pos, ps.mass, eps=sim.eps)
+            err = np.linalg.norm(np.asarray(sim._compute_forces()) - exact, axis=1) / np.linalg.norm(exact, axis=1)
+            self.assertLess(np.median(err), 0.05, backend)
+        # Edits through sim.particles reach the state on every backend
+        for backend in final:
+            sim = BarnesHutSimulation(num_particles=20, seed=5, mode="direct", backend=backend)
+            sim.step()
+            # Stepping without consumers never copies the state to the host
+            self.assertFalse(getattr(sim.backend, "_lent", False))
+            sim.particles[0].x = 50.0
+            sim.particles.vel[1] = 0.0
+            sim.step()
+            self.assertGreater(sim.particles.pos[0, 0], 49.0)
+        with self.assertRaises(ValueError):
+            BarnesHutSimulation(num_particles=10, backend="fortran")
+        with self.assertRaises(ValueError):
+            BarnesHutSimulation(num_particles=10, backend="python", mode="group")
+
 
 if __name__ == "__main__":
     unittest.main()
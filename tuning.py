@@ -0,0 +1,131 @@
+"""Automatic choice of the opening angle and leaf size of the Barnes-Hut tree.
+
+An :class:`AutoTuner` attached to :class:`nbody.BarnesHutSimulation` draws a
+random sample of particles, computes their exact accelerations by direct
+summation and measures the relative Barnes-Hut force error of every candidate
+``(theta, leaf_size)`` on that sample. The cheapest candidate whose error
+percentile stays below the target is applied to the simulation. Tuning runs
+before the first step and again every ``every`` steps, so the setting follows
+the system as it collapses or spreads out.
+
+The cost of a candidate is the number of tree-walk operations (nodes opened
+plus interactions) per particle by default, which makes the choice
+deterministic; ``cost="time"`` uses the measured build and walk time instead.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from nbody import direct_accelerations
+from octree import LinearOctree
+
+THETAS = (0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+@dataclass
+class Candidate:
+    theta: float
+    leaf_size: int
+    error: float
+    cost: float
+
+
+@dataclass
+class TuningResult:
+    step: int
+    theta: float
+    leaf_size: int
+    error: float
+    cost: float
+    # False if no candidate met the target and the most accurate one was used
+    met: bool
+    candidates: List[Candidate] = field(default_factory=list)
+
+
+def force_errors(tree: LinearOctree, exact: np.ndarray, sample: np.ndarray, theta: float, eps: float,
+                 mode: str = "particle", group_size: int = 32,
+                 counts: Optional[Dict[str, int]] = None) -> np.ndarray:
+    """Relative Barnes-Hut force errors of the particles ``sample``."""
+    approx = tree.accelerations(theta, eps=eps, targets=sample, mode=mode, group_size=group_size,
+                                counts=counts)
+    norm = np.linalg.norm(exact, axis=1)
+    return np.linalg.norm(approx - exact, axis=1) / np.where(norm > 0.0, norm, 1.0)
+
+
+class AutoTuner:
+    """Keep ``theta`` (and ``leaf_size``) at the cheapest setting meeting an error target.
+
+    ``target`` bounds the ``percentile`` of the relative force error over
+    ``sample`` random particles. ``leaf_sizes`` defaults to the simulation's
+    current leaf size only. The sample is drawn from ``seed`` and the step
+    number. Checkpoints store the step of the last tuning (``last_step``),
+    so a run resumed with a tuner of the same settings tunes exactly like
+    the original one.
+    """
+
+    def __init__(self, target: float = 0.01, percentile: float = 90.0, sample: int = 256, every: int = 100,
+                 thetas: Sequence[float] = THETAS, leaf_sizes: Optional[Sequence[int]] = None,
+                 cost: str = "interactions", seed: int = 0):
+        if cost not in ("interactions", "time"):
+            raise ValueError("unknown cost %r" % cost)
+        self.target = target
+        self.percentile = percentile
+        self.sample = sample
+        self.every = every
+        self.thetas = sorted(thetas)
+        self.leaf_sizes = leaf_sizes
+        self.cost = cost
+        self.seed = seed
+        self.history: List[TuningResult] = []
+        self.last_step: Optional[int] = None
+
+    def due(self, step: int) -> bool:
+        if self.last_step is None:
+            return True
+        return bool(self.every) and step % self.every == 0 and step != self.last_step
+
+    def maybe_tune(self, sim) -> Optional[TuningResult]:
+        """Tune ``sim`` if a check is due; returns the result if one ran."""
+        if sim.mode == "direct" or len(sim.backend) < 2 or not self.due(sim.step_count):
+            return None
+        return self.tune(sim)
+
+    def tune(self, sim) -> TuningResult:
+        """Measure all candidates on the current particles and apply the best one."""
+        ps = sim.particles
+        n = len(ps)
+        rng = np.random.default_rng([self.seed, sim.step_count])
+        sample = np.sort(rng.choice(n, min(self.sample, n), replace=False))
+        exact = direct_accelerations(ps.pos, ps.mass, eps=sim.eps, targets=sample)
+        mode = "group" if sim.mode == "group" else "particle"
+
+        candidates = []
+        for leaf_size in self.leaf_sizes or (sim.leaf_size,):
+            t0 = time.perf_counter()
+            tree = LinearOctree(ps.pos, ps.mass, leaf_size=leaf_size, quadrupole=sim.quadrupole)
+            build = time.perf_counter() - t0
+            for theta in self.thetas:
+                counts: Dict[str, int] = {}
+                t0 = time.perf_counter()
+                err = force_errors(tree, exact, sample, theta, sim.eps, mode, sim.group_size, counts)
+                if self.cost == "time":
+                    cost = build + (time.perf_counter() - t0) * n / len(sample)
+                else:
+                    cost = sum(counts.values()) / len(sample)
+                candidates.append(Candidate(theta, leaf_size, float(np.percentile(err, self.percentile)), cost))
+
+        good = [c for c in candidates if c.error <= self.target]
+        best = min(good, key=lambda c: (c.cost, c.error)) if good else min(candidates, key=lambda c: c.error)
+        if best.leaf_size != sim.leaf_size:
+            sim.leaf_size = best.leaf_size
+            sim.tree = None
+            sim._tree_current = False
+        sim.theta = best.theta
+        result = TuningResult(sim.step_count, best.theta, best.leaf_size, best.error, best.cost, bool(good),
+                              candidates)
+        self.history.append(result)
+        self.last_step = sim.step_count
+        return result